@@ -0,0 +1,148 @@
+'''
+Benchmark of the logging that the QA tasks do for each resource, at INFO level.
+
+For some resources that have QA results, it times the logging of them as the
+tasks used to do it (the result, resource and URL reprs, and the QA's repr,
+which looked up the dataset name) against the single summary record that
+they now log (tasks.log_resource_score). It reports, per resource:
+
+* time spent logging
+* database queries made by logging
+
+The log records are formatted, as they would be for a real log file, but
+written to /dev/null.
+
+e.g.
+    python benchmark_logging.py ckan.ini --resources=1000
+'''
+
+from optparse import OptionParser
+import os
+import sys
+import time
+import logging
+
+import common
+
+# NB put no CKAN imports here, or logging breaks
+
+
+class QueryCounter(object):
+    '''Counts the queries made on an SQLAlchemy engine.'''
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args, **kwargs):
+        self.count += 1
+
+
+def legacy_qa_repr(qa):
+    '''QA.__repr__ as it was, looking up the dataset name.'''
+    from ckan import model
+    summary = 'score=%s format=%s' % (qa.openness_score, qa.format)
+    details = unicode(qa.openness_score_reason).encode('unicode_escape')
+    package = model.Package.get(qa.package_id)
+    package_name = package.name if package else '?%s?' % qa.package_id
+    return '<QA %s /dataset/%s/resource/%s %s>' % \
+        (summary, package_name, qa.resource_id, details)
+
+
+class LegacyQA(object):
+    def __init__(self, qa):
+        self.qa = qa
+
+    def __repr__(self):
+        return legacy_qa_repr(self.qa)
+
+
+def log_legacy(log, resource, qa, qa_result):
+    '''The logging done for each resource before it was summarised.'''
+    log.info('Score: %s Reason: %s', qa_result['openness_score'],
+             qa_result['openness_score_reason'])
+    log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result, resource,
+             resource.url)
+    log.info(u'QA from before: %r', LegacyQA(qa))
+    log.info('QA results updated ok')
+    log.info('CKAN updated with openness score')
+
+
+def log_summary(log, resource, qa, qa_result):
+    from ckanext.qa.tasks import log_resource_score
+    log_resource_score(log, resource, qa_result, 0.1)
+    log.debug(u'QA from before: %r', qa)
+
+
+def benchmark(resources_and_qas, log_function, log, query_counter):
+    seconds = 0
+    queries = 0
+    for resource, qa in resources_and_qas:
+        qa_result = {
+            'openness_score': qa.openness_score,
+            'openness_score_reason': qa.openness_score_reason,
+            'format': qa.format,
+            'archival_timestamp': qa.archival_timestamp,
+            'format_scores_version': qa.format_scores_version,
+            }
+        start_queries = query_counter.count
+        start = time.time()
+        log_function(log, resource, qa, qa_result)
+        seconds += time.time() - start
+        queries += query_counter.count - start_queries
+    return seconds, queries
+
+
+def main(options):
+    from ckan import model
+    from ckanext.qa.model import QA
+
+    resources_and_qas = model.Session.query(model.Resource, QA) \
+        .join(QA, QA.resource_id == model.Resource.id) \
+        .filter(model.Resource.state == 'active') \
+        .limit(options.resources) \
+        .all()
+    if not resources_and_qas:
+        print 'No resources with QA results'
+        return 1
+    query_counter = QueryCounter(model.meta.engine)
+
+    log = logging.getLogger('ckanext.qa.benchmark')
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(levelname)s [%(name)s] %(message)s'))
+    log.addHandler(handler)
+
+    num = len(resources_and_qas)
+    print 'Resources: %i' % num
+    print '%-10s %16s %16s' % ('Logging', 'ms per resource',
+                               'queries per res')
+    for name, log_function in (('before', log_legacy),
+                               ('after', log_summary)):
+        seconds, queries = benchmark(resources_and_qas, log_function, log,
+                                     query_counter)
+        print '%-10s %16.3f %16.2f' % (name, seconds * 1000 / num,
+                                       float(queries) / num)
+    return 0
+
+
+if __name__ == '__main__':
+    usage = """Benchmark of the QA tasks' logging for each resource
+
+    usage: %prog [options] <ckan.ini>
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option('--resources', dest='resources', type='int',
+                      default=1000,
+                      help='Number of resources to log (default: %default)')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Wrong number of arguments (%i)' % len(args))
+    config_ini = args[0]
+    print 'Loading CKAN config...'
+    common.load_config(config_ini)
+    print 'Done'
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(options))
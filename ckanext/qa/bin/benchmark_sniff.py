@@ -0,0 +1,389 @@
+'''
+Benchmark of how fast sniff_format.sniff_file_format detects file formats.
+
+It sniffs the test data files, plus optionally some large generated CSV, XLS,
+ZIP and XML files, and reports:
+
+* files per second
+* bytes read by this process (Linux only - from /proc/self/io)
+* peak memory (RSS)
+* calls and time spent in each detector (e.g. magic, xlrd, is_csv, is_ttl)
+
+The detector times are inclusive, so the time of an archive detector includes
+sniffing its members. The results can be written as JSON, and compared with
+the results of an earlier run to catch the sniffer getting slower.
+
+e.g.
+    python benchmark_sniff.py ckan.ini --synthetic-mb=200 --output=after.json \\
+        --baseline=before.json
+'''
+
+from optparse import OptionParser
+from collections import defaultdict
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import logging
+import resource
+import tempfile
+import datetime
+
+import common
+
+# NB put no CKAN imports here, or logging breaks
+
+TEST_DATA_DIR = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..', 'tests', 'data'))
+
+SYNTHETIC_FORMATS = ('csv', 'xls', 'zip', 'xml')
+
+# functions in sniff_format that are timed
+DETECTORS = (
+    'get_xml_variant_including_xml_declaration',
+    'get_xml_variant_without_xml_declaration',
+    'get_zipped_format',
+    'get_tarred_format',
+    'get_compressed_format',
+    'run_bsd_file',
+    'is_excel',
+    'is_html',
+    'is_iati',
+    'is_json',
+    'is_csv',
+    'is_psv',
+    'is_xml_but_without_declaration',
+    'is_ttl',
+    'has_rdfa',
+    )
+
+# files smaller than this are not compared with the baseline, as their times
+# are mostly noise
+BASELINE_MIN_SECONDS = 0.01
+
+log = logging.getLogger(__name__)
+
+
+class DetectorTimer(object):
+    '''Wraps the detector functions of the sniff_format module, and
+    magic.from_file, recording the number of calls and time spent in each,
+    while it is in use as a context manager.'''
+    def __init__(self, sniff_format):
+        self.targets = [(sniff_format, name) for name in DETECTORS] + \
+            [(sniff_format.magic, 'from_file')]
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self._originals = []
+
+    def _wrap(self, name, func):
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.calls[name] += 1
+                self.seconds[name] += time.time() - start
+        return timed
+
+    def __enter__(self):
+        for module, attr in self.targets:
+            original = getattr(module, attr)
+            self._originals.append((module, attr, original))
+            name = attr if attr != 'from_file' else 'magic.from_file'
+            setattr(module, attr, self._wrap(name, original))
+        return self
+
+    def __exit__(self, *exc_info):
+        for module, attr, original in self._originals:
+            setattr(module, attr, original)
+        self._originals = []
+
+    def as_dict(self):
+        return dict((name, {'calls': self.calls[name],
+                            'seconds': round(self.seconds[name], 4)})
+                    for name in self.calls)
+
+
+def bytes_read_by_process():
+    '''Returns the number of bytes this process has read (from any file), or
+    None if that is not available on this platform.'''
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+
+def peak_rss_kb():
+    '''Returns the peak resident memory of this process (and the peak of its
+    child processes, e.g. "file"), in KB.'''
+    units = 1024 if sys.platform == 'darwin' else 1  # ru_maxrss is in bytes
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / units,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / units)
+
+
+def write_synthetic_files(dir_, size_mb, formats):
+    '''Writes large files of the given formats to dir_, returning their
+    filepaths.'''
+    size = size_mb * 1024 * 1024
+    filepaths = []
+    for format_ in formats:
+        filepath = os.path.join(dir_, 'synthetic-%smb.%s' % (size_mb, format_))
+        print 'Writing %s' % filepath
+        if format_ == 'csv':
+            write_csv(filepath, size)
+        elif format_ == 'xml':
+            write_xml(filepath, size)
+        elif format_ == 'zip':
+            write_zip(filepath, size)
+        elif format_ == 'xls':
+            try:
+                write_xls(filepath, size)
+            except ImportError:
+                print 'Skipping XLS - "pip install xlwt" to generate it'
+                continue
+        else:
+            raise ValueError('Unknown synthetic format: %s' % format_)
+        filepaths.append(filepath)
+    return filepaths
+
+
+def _csv_rows():
+    yield 'id,name,region,value,date\n'
+    i = 0
+    while True:
+        i += 1
+        yield '%d,Name %d,Region %d,%d.%02d,2016-%02d-%02d\n' % (
+            i, i, i % 50, i * 7, i % 100, i % 12 + 1, i % 28 + 1)
+
+
+def write_csv(filepath, size):
+    with open(filepath, 'wb') as f:
+        for row in _csv_rows():
+            f.write(row)
+            if f.tell() >= size:
+                break
+
+
+def write_xml(filepath, size):
+    with open(filepath, 'wb') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<rows>\n')
+        i = 0
+        while f.tell() < size:
+            i += 1
+            f.write('  <row id="%d"><name>Name %d</name>'
+                    '<value>%d</value></row>\n' % (i, i, i * 7))
+        f.write('</rows>\n')
+
+
+def write_zip(filepath, size):
+    '''A zip containing a CSV of the given (uncompressed) size.'''
+    csv_filepath = filepath + '.csv'
+    write_csv(csv_filepath, size)
+    try:
+        with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as zip_:
+            zip_.write(csv_filepath, 'data.csv')
+    finally:
+        os.remove(csv_filepath)
+
+
+def write_xls(filepath, size):
+    '''An XLS of roughly the given size, limited by the XLS maximum of 65536
+    rows and 256 columns.'''
+    import xlwt
+    num_columns = 20
+    num_rows = min(65535, size / (num_columns * 12) or 1)
+    workbook = xlwt.Workbook()
+    sheet = workbook.add_sheet('Data')
+    for column in range(num_columns):
+        sheet.write(0, column, 'Column %d' % column)
+    for row in range(1, num_rows + 1):
+        for column in range(num_columns):
+            sheet.write(row, column, row * column)
+        if row % 1000 == 0:
+            sheet.flush_row_data()
+    workbook.save(filepath)
+
+
+def benchmark(filepaths, repeat):
+    import ckanext.qa.sniff_format as sniff_format
+    # the sniffer logs a lot at INFO, which would distort the times
+    sniff_log = logging.getLogger('ckanext.qa.sniff_format')
+    sniff_log.setLevel(logging.WARNING)
+
+    # load ckan's resource formats, so it is not counted in the first file
+    sniff_format.lib.format_index()
+
+    files = []
+    bytes_read_start = bytes_read_by_process()
+    start = time.time()
+    with DetectorTimer(sniff_format) as timer:
+        for filepath in filepaths:
+            file_start = time.time()
+            for i in range(repeat):
+                format_ = sniff_format.sniff_file_format(filepath, sniff_log)
+            seconds = (time.time() - file_start) / repeat
+            files.append({
+                'file': os.path.basename(filepath),
+                'bytes': os.path.getsize(filepath),
+                'format': format_['format'] if format_ else None,
+                'container': format_.get('container') if format_ else None,
+                'seconds': round(seconds, 4),
+                })
+    total_seconds = time.time() - start
+    bytes_read_end = bytes_read_by_process()
+    rss_kb, children_rss_kb = peak_rss_kb()
+    num_sniffs = len(filepaths) * repeat
+    return {
+        'date': datetime.datetime.now().isoformat(),
+        'repeat': repeat,
+        'files': files,
+        'num_files': len(filepaths),
+        'total_bytes': sum(file_['bytes'] for file_ in files),
+        'bytes_read': (bytes_read_end - bytes_read_start) / repeat
+        if bytes_read_start is not None else None,
+        'seconds': round(total_seconds / repeat, 4),
+        'files_per_second': round(num_sniffs / total_seconds, 2)
+        if total_seconds else None,
+        'peak_rss_kb': rss_kb,
+        'peak_children_rss_kb': children_rss_kb,
+        'detectors': timer.as_dict(),
+        }
+
+
+def print_report(results):
+    for file_ in results['files']:
+        format_ = file_['format'] or '-'
+        if file_['container']:
+            format_ = '%s (in %s)' % (format_, file_['container'])
+        print '%8.3fs %12d bytes  %-12s %s' % (
+            file_['seconds'], file_['bytes'], format_, file_['file'])
+    print
+    print 'Detector                                     calls   seconds'
+    for name, detector in sorted(results['detectors'].items(),
+                                 key=lambda item: -item[1]['seconds']):
+        print '%-42s %7d %9.3f' % (name, detector['calls'],
+                                   detector['seconds'])
+    print
+    print 'Files: %s  Bytes: %s  Bytes read: %s' % (
+        results['num_files'], results['total_bytes'], results['bytes_read'])
+    print 'Seconds: %s  Files per second: %s' % (
+        results['seconds'], results['files_per_second'])
+    print 'Peak RSS: %s KB (child processes: %s KB)' % (
+        results['peak_rss_kb'], results['peak_children_rss_kb'])
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    '''Returns a list of descriptions of how results are slower than the
+    baseline by more than the tolerance (a fraction).'''
+    regressions = []
+    if baseline.get('files_per_second') and results['files_per_second'] and \
+            results['files_per_second'] < \
+            baseline['files_per_second'] * (1 - tolerance):
+        regressions.append('Files per second: %s (was %s)' % (
+            results['files_per_second'], baseline['files_per_second']))
+    baseline_files = dict((file_['file'], file_)
+                          for file_ in baseline.get('files', []))
+    for file_ in results['files']:
+        baseline_file = baseline_files.get(file_['file'])
+        if not baseline_file:
+            continue
+        if file_['format'] != baseline_file['format']:
+            regressions.append('%s: format %s (was %s)' % (
+                file_['file'], file_['format'], baseline_file['format']))
+        if file_['seconds'] > BASELINE_MIN_SECONDS and \
+                file_['seconds'] > baseline_file['seconds'] * (1 + tolerance):
+            regressions.append('%s: %ss (was %ss)' % (
+                file_['file'], file_['seconds'], baseline_file['seconds']))
+    return regressions
+
+
+def main(options):
+    baseline = None
+    if options.baseline:
+        # read it first, in case it is also the output file
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    filepaths = []
+    if not options.no_test_data:
+        filepaths.extend(sorted(
+            os.path.join(TEST_DATA_DIR, filename)
+            for filename in os.listdir(TEST_DATA_DIR)))
+    synthetic_dir = None
+    try:
+        if options.synthetic_mb:
+            synthetic_dir = options.synthetic_dir or tempfile.mkdtemp()
+            if not os.path.exists(synthetic_dir):
+                os.makedirs(synthetic_dir)
+            formats = options.synthetic_formats.split(',')
+            filepaths.extend(write_synthetic_files(
+                synthetic_dir, options.synthetic_mb, formats))
+        if not filepaths:
+            print 'No files to sniff'
+            return 1
+        results = benchmark(filepaths, options.repeat)
+    finally:
+        if synthetic_dir and not options.synthetic_dir:
+            shutil.rmtree(synthetic_dir)
+
+    print_report(results)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print 'Written %s' % options.output
+
+    if baseline:
+        regressions = compare_with_baseline(results, baseline,
+                                            options.tolerance)
+        if regressions:
+            print 'Slower than the baseline %s:' % options.baseline
+            for regression in regressions:
+                print '  ' + regression
+            return 1
+        print 'No regressions compared with the baseline %s' % \
+            options.baseline
+    return 0
+
+
+if __name__ == '__main__':
+    usage = """Benchmark of the file format sniffer
+
+    usage: %prog [options] <ckan.ini>
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option('--repeat', dest='repeat', type='int', default=1,
+                      help='Sniff each file this many times')
+    parser.add_option('--no-test-data', dest='no_test_data',
+                      action='store_true',
+                      help='Don\'t sniff the files in %s' % TEST_DATA_DIR)
+    parser.add_option('--synthetic-mb', dest='synthetic_mb', type='int',
+                      default=0,
+                      help='Also sniff generated files of this size (MB)')
+    parser.add_option('--synthetic-formats', dest='synthetic_formats',
+                      default=','.join(SYNTHETIC_FORMATS),
+                      help='Formats of generated files (default: %default)')
+    parser.add_option('--synthetic-dir', dest='synthetic_dir',
+                      help='Keep the generated files in this directory, '
+                      'rather than a temporary one')
+    parser.add_option('-o', '--output', dest='output',
+                      help='Write the results as JSON to this file')
+    parser.add_option('--baseline', dest='baseline',
+                      help='JSON results of an earlier run to compare with')
+    parser.add_option('--tolerance', dest='tolerance', type='float',
+                      default=0.2,
+                      help='Fraction slower than the baseline that counts '
+                      'as a regression (default: %default)')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Wrong number of arguments (%i)' % len(args))
+    config_ini = args[0]
+    print 'Loading CKAN config...'
+    common.load_config(config_ini)
+    print 'Done'
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(options))
@@ -23,6 +23,16 @@ def register_translator():
 
 def get_resources(state='active', publisher_ref=None, resource_id=None, dataset_name=None):
     ''' Returns all active resources, or filtered by the given criteria. '''
+    resources, criteria = get_resources_query(
+        state=state, publisher_ref=publisher_ref, resource_id=resource_id,
+        dataset_name=dataset_name)
+    resources = resources.all()
+    print '%i resources (%s)' % (len(resources), ' '.join(criteria))
+    return resources
+
+def get_resources_query(state='active', publisher_ref=None, resource_id=None, dataset_name=None):
+    ''' Returns a query of the active resources, or filtered by the given
+    criteria, and a list of the criteria (for display). '''
     from ckan import model
     resources = model.Session.query(model.Resource) \
         .filter_by(state=state)
@@ -44,6 +54,25 @@ def get_resources(state='active', publisher_ref=None, resource_id=None, dataset_
     if resource_id:
         resources = resources.filter(model.Resource.id==resource_id)
         criteria.append('Resource:%s' % resource_id)
-    resources = resources.all()
-    print '%i resources (%s)' % (len(resources), ' '.join(criteria))
-    return resources
+    return resources, criteria
+
+def iter_pages(query, id_column, page_size, after_id=None, get_id=None):
+    ''' Yields the results of a query a page at a time, ordered by the given
+    (unique) id column. Each page is selected by the ids after the last page
+    (keyset paging), so is a quick query however far through you are.
+
+    :param get_id: function returning the id of a result, if it is not the
+                   attribute of the id column's name e.g. for a query of
+                   several entities
+    '''
+    if get_id is None:
+        get_id = lambda row: getattr(row, id_column.key)
+    while True:
+        page_query = query
+        if after_id is not None:
+            page_query = page_query.filter(id_column > after_id)
+        page = page_query.order_by(id_column).limit(page_size).all()
+        if not page:
+            return
+        yield page
+        after_id = get_id(page[-1])
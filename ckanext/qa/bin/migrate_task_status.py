@@ -10,6 +10,7 @@ from optparse import OptionParser
 import logging
 import json
 import datetime
+import os
 
 import common
 from running_stats import StatsList
@@ -26,105 +27,177 @@ TODAY = datetime.datetime.now()
 
 def migrate(options):
     from ckan import model
+    from sqlalchemy import and_
     from ckanext.archiver.model import Archival
     from ckanext.qa.model import QA
 
-    resources = common.get_resources(state='active',
-                                     publisher_ref=options.publisher,
-                                     resource_id=options.resource,
-                                     dataset_name=options.dataset)
-    stats = StatsList()
+    resources, criteria = common.get_resources_query(
+        state='active',
+        publisher_ref=options.publisher,
+        resource_id=options.resource,
+        dataset_name=options.dataset)
+    after_id = read_checkpoint(options.checkpoint)
+    if after_id:
+        print 'Resuming after resource %s' % after_id
+        num_resources = resources \
+            .filter(model.Resource.id > after_id).count()
+    else:
+        num_resources = resources.count()
+    print '%i resources (%s)' % (num_resources, ' '.join(criteria))
+    # Gather the details of QA from TaskStatus and the Archival with the
+    # resource, in the same query
+    resources = resources \
+        .outerjoin(model.TaskStatus, and_(
+            model.TaskStatus.entity_id == model.Resource.id,
+            model.TaskStatus.task_type == 'qa',
+            model.TaskStatus.key == 'status')) \
+        .outerjoin(Archival, Archival.resource_id == model.Resource.id) \
+        .add_entity(model.TaskStatus) \
+        .add_entity(Archival) \
+        .add_columns(model.Package.id, model.Package.name)
+
+    # keep a sample of the resources for each outcome, not all of them
+    stats = StatsList(sample_size=100)
     widgets = ['Resources: ', Percentage(), ' ', Bar(), ' ', ETA()]
-    progress = ProgressBar(widgets=widgets)
-    for res in progress(resources):
-        # Gather the details of QA from TaskStatus
-        # to fill all properties of QA apart from:
-        # * package_id
-        # * resource_id
-        fields = {}
-        qa_task_status = model.Session.query(model.TaskStatus)\
-                                    .filter_by(entity_id=res.id)\
-                                    .filter_by(task_type='qa')\
-                                    .filter_by(key='status')\
-                                    .first()
-        if not qa_task_status:
-            add_stat('No QA data', res, stats)
-            continue
-        qa_error = json.loads(qa_task_status.error)
-        fields['openness_score'] = int(qa_task_status.value)
-        fields['openness_score_reason'] = qa_error['reason']
-        fields['format'] = qa_error['format']
-        qa_date = qa_task_status.last_updated
-        # NB qa_task_status.last_updated appears to be 1hr ahead of the revision
-        # time, so some timezone nonesense going on. Can't do much.
-        archival = Archival.get_for_resource(res.id)
-        if not archival:
-            print add_stat('QA but no Archival data', res, stats)
-            continue
-        archival_date = archival.updated
-        # the state of the resource was as it was archived on the date of
-        # the QA update but we only know when the latest archival was. So
-        # if it was archived before the QA update thenwe know that was the
-        # archival, otherwise we don't know when the relevant archival was.
-        if archival_date and qa_date >= archival_date:
-            fields['archival_timestamp'] = archival_date
-            fields['updated'] = archival_date
-            fields['created'] = archival_date
-            # Assume the resource URL archived was the one when the
-            # archival was done (it may not be if the URL was queued and
-            # there was significant delay before it was archived)
-            get_resource_as_at = archival_date
-        else:
-            # This is common for when a resource is created and qa runs just
-            # before archiver and you get:
-            # "This file had not been downloaded at the time of scoring it."
-            # Just put sensible datetimes since we don't really know the exact
-            # ones
-            fields['archival_timestamp'] = qa_date
-            fields['updated'] = qa_date
-            fields['created'] = qa_date
-            get_resource_as_at = qa_date
-        res_rev = model.Session.query(model.ResourceRevision).\
-            filter_by(id=res.id).\
-            filter(model.ResourceRevision.revision_timestamp < get_resource_as_at).\
-            order_by(model.ResourceRevision.revision_timestamp.desc()).\
-            first()
-        fields['resource_timestamp'] = res_rev.revision_timestamp
-
-        # Compare with any existing data in the Archival table
-        qa = QA.get_for_resource(res.id)
-        if qa:
-            changed = None
-            for field, value in fields.items():
-                if getattr(qa, field) != value:
-                    if options.write:
-                        setattr(qa, field, value)
-                    changed = True
-            if not changed:
-                add_stat('Already exists correctly in QA table', res, stats)
-                continue
-            add_stat('Updated in QA table', res, stats)
-        else:
-            qa = QA.create(res.id)
-            if options.write:
-                for field, value in fields.items():
-                    setattr(qa, field, value)
-                model.Session.add(qa)
-            add_stat('Added to QA table', res, stats)
+    progress = ProgressBar(widgets=widgets, maxval=num_resources or 1).start()
+    num_done = 0
+    for page in common.iter_pages(resources, model.Resource.id,
+                                  options.batch_size, after_id=after_id,
+                                  get_id=lambda row: row[0].id):
+        resource_ids = [row[0].id for row in page]
+        qas = dict((qa.resource_id, qa) for qa in
+                   model.Session.query(QA)
+                   .filter(QA.resource_id.in_(resource_ids)))
+        revision_timestamps = get_revision_timestamps(resource_ids)
+        for res, qa_task_status, archival, package_id, package_name in page:
+            migrate_resource(res, qa_task_status, archival, package_id,
+                             package_name, qas.get(res.id),
+                             revision_timestamps, stats, options)
+        if options.write:
+            model.Session.commit()
+            write_checkpoint(options.checkpoint, resource_ids[-1])
+        # don't keep this page's objects in memory
+        model.Session.expunge_all()
+        num_done += len(page)
+        progress.update(min(num_done, progress.maxval))
+    progress.finish()
 
     print 'Summary\n', stats.report()
     if options.write:
         model.repo.commit_and_remove()
         print 'Written'
+        if options.checkpoint and os.path.exists(options.checkpoint):
+            # finished, so the next run should start from the beginning
+            os.remove(options.checkpoint)
+
+
+def migrate_resource(res, qa_task_status, archival, package_id, package_name,
+                     qa, revision_timestamps, stats, options):
+    from ckan import model
+    from ckanext.qa.model import QA
 
+    # Gather the details of QA from TaskStatus
+    # to fill all properties of QA apart from:
+    # * package_id
+    # * resource_id
+    fields = {}
+    if not qa_task_status:
+        add_stat('No QA data', res, package_name, stats)
+        return
+    qa_error = json.loads(qa_task_status.error)
+    fields['openness_score'] = int(qa_task_status.value)
+    fields['openness_score_reason'] = qa_error['reason']
+    fields['format'] = qa_error['format']
+    qa_date = qa_task_status.last_updated
+    # NB qa_task_status.last_updated appears to be 1hr ahead of the revision
+    # time, so some timezone nonesense going on. Can't do much.
+    if not archival:
+        print add_stat('QA but no Archival data', res, package_name, stats)
+        return
+    archival_date = archival.updated
+    # the state of the resource was as it was archived on the date of
+    # the QA update but we only know when the latest archival was. So
+    # if it was archived before the QA update thenwe know that was the
+    # archival, otherwise we don't know when the relevant archival was.
+    if archival_date and qa_date >= archival_date:
+        fields['archival_timestamp'] = archival_date
+        fields['updated'] = archival_date
+        fields['created'] = archival_date
+        # Assume the resource URL archived was the one when the
+        # archival was done (it may not be if the URL was queued and
+        # there was significant delay before it was archived)
+        get_resource_as_at = archival_date
+    else:
+        # This is common for when a resource is created and qa runs just
+        # before archiver and you get:
+        # "This file had not been downloaded at the time of scoring it."
+        # Just put sensible datetimes since we don't really know the exact
+        # ones
+        fields['archival_timestamp'] = qa_date
+        fields['updated'] = qa_date
+        fields['created'] = qa_date
+        get_resource_as_at = qa_date
+    earlier_timestamps = [
+        timestamp for timestamp in revision_timestamps.get(res.id, [])
+        if timestamp < get_resource_as_at]
+    fields['resource_timestamp'] = max(earlier_timestamps) \
+        if earlier_timestamps else None
+
+    # Compare with any existing data in the Archival table
+    if qa:
+        changed = None
+        for field, value in fields.items():
+            if getattr(qa, field) != value:
+                if options.write:
+                    setattr(qa, field, value)
+                changed = True
+        if not changed:
+            add_stat('Already exists correctly in QA table', res,
+                     package_name, stats)
+            return
+        add_stat('Updated in QA table', res, package_name, stats)
+    else:
+        # (rather than QA.create, which queries for the package_id)
+        qa = QA(resource_id=res.id, package_id=package_id)
+        if options.write:
+            for field, value in fields.items():
+                setattr(qa, field, value)
+            model.Session.add(qa)
+        add_stat('Added to QA table', res, package_name, stats)
 
-def add_stat(outcome, res, stats, extra_info=None):
-    try:
-        # pre CKAN 2.3 model
-        package_name = res.resource_group.package.name
-    except AttributeError:
-        # CKAN 2.3+ model
-        package_name = res.package.name
+
+def get_revision_timestamps(resource_ids):
+    '''Returns the timestamps of the revisions of the given resources, as a
+    dict of resource_id: [timestamps].'''
+    from ckan import model
+    revision_timestamps = {}
+    for resource_id, timestamp in model.Session.query(
+            model.ResourceRevision.id,
+            model.ResourceRevision.revision_timestamp) \
+            .filter(model.ResourceRevision.id.in_(resource_ids)):
+        revision_timestamps.setdefault(resource_id, []).append(timestamp)
+    return revision_timestamps
+
+
+def read_checkpoint(filepath):
+    '''Returns the id of the last resource written by a previous run, or
+    None.'''
+    if not filepath or not os.path.exists(filepath):
+        return None
+    with open(filepath) as f:
+        return f.read().strip() or None
+
+
+def write_checkpoint(filepath, resource_id):
+    if not filepath:
+        return
+    # write then rename, so that a crash doesn't leave it half-written
+    with open(filepath + '.tmp', 'w') as f:
+        f.write(resource_id)
+    os.rename(filepath + '.tmp', filepath)
+
+
+def add_stat(outcome, res, package_name, stats, extra_info=None):
     res_id = '%s %s' % (package_name, res.id[:4])
     if extra_info:
         res_id += ' %s' % extra_info
@@ -149,6 +222,13 @@ if __name__ == '__main__':
     parser.add_option('-p', '--publisher', dest='publisher')
     parser.add_option('-d', '--dataset', dest='dataset')
     parser.add_option('-r', '--resource', dest='resource')
+    parser.add_option('-b', '--batch-size', dest='batch_size', type='int',
+                      default=1000,
+                      help='Number of resources to read and write at a time')
+    parser.add_option('-c', '--checkpoint', dest='checkpoint',
+                      help='File to record progress in, so that if the '
+                      'migration is interrupted, running it again (with '
+                      'this option) resumes where it got to')
     (options, args) = parser.parse_args()
     if len(args) != 1:
         parser.error('Wrong number of arguments (%i)' % len(args))
@@ -30,10 +30,20 @@ print package_stats.report()
 > deleted: 30 pollution-uk, flood-regions, river-quality, ...
 > not deleted: 70 spending-bristol, ... 
 
+When there are too many objects to remember all their IDs, keep a random
+sample of them for each outcome (the counts are still exact):
+
+package_stats = StatsList(sample_size=100)
+
+Stats gathered in several processes can be combined:
+
+package_stats.merge(other_process_package_stats)
+
 '''
 
 import copy
 import datetime
+import random
 
 class StatsCount(dict):
     # {category:count}
@@ -52,6 +62,13 @@ class StatsCount(dict):
         self._init_category(category)
         self[category] += 1
 
+    def merge(self, other):
+        '''Adds the counts of another StatsCount to this one.'''
+        for category, value in other.items():
+            self._init_category(category)
+            self[category] += value
+        self._start_time = min(self._start_time, other._start_time)
+
     def report_value(self, category):
         '''Returns the value for a category and value to sort categories by.'''
         value = repr(self[category])
@@ -87,14 +104,68 @@ class StatsList(StatsCount):
     # {category:[values]}
     _init_value = []
 
+    def __init__(self, *args, **kwargs):
+        # If sample_size is given, only that many values are kept for each
+        # category - a random sample of them (a 'reservoir sample')
+        self.sample_size = kwargs.pop('sample_size', None)
+        # {category:number of values} for categories with more values than
+        # are kept
+        self._counts = {}
+        super(StatsList, self).__init__(*args, **kwargs)
+
     def add(self, category, value):
         self._init_category(category)
-        self[category].append(value)
+        values = self[category]
+        count = self.count(category) + 1
+        if self.sample_size is None or len(values) < self.sample_size:
+            values.append(value)
+        else:
+            # keep each of the values so far with equal probability
+            i = random.randrange(count)
+            if i < self.sample_size:
+                values[i] = value
+        if count != len(values):
+            self._counts[category] = count
         return '%s: %s' % (category, value) # so you can log it too
 
+    def count(self, category):
+        '''Returns the number of values added for a category.'''
+        return self._counts.get(category, len(self.get(category, [])))
+
+    def merge(self, other):
+        '''Adds the values of another StatsList to this one. If this one
+        keeps a sample, the values kept are a random sample of the values of
+        both.'''
+        for category, other_values in other.items():
+            self._init_category(category)
+            count = self.count(category)
+            other_count = other.count(category)
+            values = self[category] + list(other_values)
+            if self.sample_size is not None and \
+                    len(values) > self.sample_size:
+                values = self._merge_samples(
+                    self[category], count, other_values, other_count)
+            self[category][:] = values
+            if count + other_count != len(values):
+                self._counts[category] = count + other_count
+        self._start_time = min(self._start_time, other._start_time)
+
+    def _merge_samples(self, values, count, other_values, other_count):
+        # take values from each in proportion to the number they represent
+        values = random.sample(values, len(values))
+        other_values = random.sample(other_values, len(other_values))
+        sample = []
+        while len(sample) < self.sample_size and (values or other_values):
+            if values and (not other_values or
+                           random.random() * (count + other_count) < count):
+                sample.append(values.pop())
+            else:
+                sample.append(other_values.pop())
+        return sample
+
     def report_value(self, category):
         value = self[category]
-        number_of_values = len(value)
+        number_of_values = self.count(category)
         value_str = '%i %r' % (number_of_values, value)
         if len(value_str) > self.report_value_limit:
             value_str = value_str[:self.report_value_limit] + '...'
@@ -110,3 +181,9 @@ if __name__ == '__main__':
     print package_stats.report()
 
     print StatsList().report()
+
+    sampled_stats = StatsList(sample_size=3)
+    for i in range(1000):
+        sampled_stats.add('Success', 'good%i' % i)
+    sampled_stats.merge(package_stats)
+    print sampled_stats.report()
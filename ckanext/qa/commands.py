@@ -1,5 +1,9 @@
 import logging
 import sys
+import os
+import glob
+import json
+import time
 
 from sqlalchemy import or_
 
@@ -27,8 +31,59 @@ class QACommand(p.toolkit.CkanCommand):
            - QA analysis on all resources in a given dataset, or on all
            datasets if no dataset given
 
-        paster qa sniff {filepath}
-           - Opens the file and determines its type by the contents
+        paster qa [options] rescore-formats [--old-scores=<filepath>]
+           - After a change to the resource format scores file, updates the
+           scores of results with formats whose scores changed, from their
+           stored formats (without looking at the files again), and
+           reindexes those datasets. Score tables are compared with the
+           versions recorded when results were saved. Use --old-scores to
+           give the previous scores file, for results saved before versions
+           were recorded. Results that can only be rescored by running the
+           full QA (e.g. their format no longer has a score) are queued.
+
+        paster qa [options] rescore-local [--processes=N]
+           - Runs the QA scoring of all resources in this process (and a
+           pool of others), rather than queuing Celery tasks, for a full
+           rescore of a large site. Resources and their archivals are read
+           a page at a time, the results are saved in bulk and the datasets
+           are reindexed together at the end.
+
+        paster qa [options] daemon [--processes=N]
+           - Runs continuously, scoring resources as they are archived or
+           their datasets are edited, in this process (and a pool of
+           others), rather than in Celery tasks. Changes are read in
+           batches, the results are saved in bulk and the datasets are
+           reindexed together. It carries on from where it stopped, when
+           restarted. See ckanext/qa/daemon.py for its settings.
+
+        paster qa stats [--hours=24]
+           - Summarises the QA tasks run in the last few hours: how long
+           they waited in the queue and took, how that time was split
+           between scoring, saving and search indexing, and counts of
+           resources scored and database queries. Requires
+           qa.metrics.task_store to be configured.
+
+        paster qa [options] sniff {filepath/directory/glob/-} [--ndjson]
+                                  [--processes=N]
+           - Opens the files and determines their types by the contents.
+           Directories are searched recursively, and with '-' the paths are
+           read from stdin (one per line). Files are sniffed in parallel
+           (by default a process per CPU). With --ndjson, a JSON object is
+           printed per file, as it is sniffed: path, format, container,
+           seconds (and error, if sniffing failed).
+
+        paster qa shards [dataset name/id ...] [--shards="<shard> ..."]
+           - Shows which shard (qa.shards) QA work for datasets is sent to.
+           Given datasets, it prints each one's shard, otherwise it counts
+           the datasets in each shard. With --shards, compares with
+           another list of shards, e.g. to see how many datasets would
+           move to a new node.
+
+        paster qa drain [--rate=50]
+           - Runs continuously, queuing the QA of datasets that was held
+           back because the queue was too long (see
+           qa.dispatch.max_queue_length), at up to the given number of
+           datasets per second, whilst there is room in the queue.
 
         paster qa view [dataset name/id]
            - See package score information
@@ -59,6 +114,43 @@ class QACommand(p.toolkit.CkanCommand):
                                action='store',
                                dest='queue',
                                help='Send to a particular queue')
+        self.parser.add_option('--old-scores',
+                               action='store',
+                               dest='old_scores',
+                               help='Previous resource format scores JSON '
+                               'file (for rescore-formats)')
+        self.parser.add_option('--hours',
+                               action='store',
+                               dest='hours',
+                               type='float',
+                               default=24,
+                               help='Number of hours of task runs to '
+                               'summarise (for stats)')
+        self.parser.add_option('--ndjson',
+                               action='store_true',
+                               dest='ndjson',
+                               default=False,
+                               help='Print a JSON object per line (for '
+                               'sniff)')
+        self.parser.add_option('--shards',
+                               action='store',
+                               dest='shards',
+                               help='Space-separated names of shards to '
+                               'compare with qa.shards (for shards)')
+        self.parser.add_option('--rate',
+                               action='store',
+                               dest='rate',
+                               type='int',
+                               default=50,
+                               help='Datasets to queue per second (for '
+                               'drain, default: %default)')
+        self.parser.add_option('-j', '--processes',
+                               action='store',
+                               dest='processes',
+                               type='int',
+                               help='Number of processes (for sniff, '
+                               'rescore-local and daemon) - defaults to the '
+                               'number of CPUs')
 
     def command(self):
         """
@@ -77,8 +169,20 @@ class QACommand(p.toolkit.CkanCommand):
 
         if cmd == 'update':
             self.update()
+        elif cmd == 'rescore-formats':
+            self.rescore_formats()
+        elif cmd == 'rescore-local':
+            self.rescore_local()
+        elif cmd == 'daemon':
+            self.daemon()
+        elif cmd == 'stats':
+            self.stats()
         elif cmd == 'sniff':
             self.sniff()
+        elif cmd == 'shards':
+            self.shards()
+        elif cmd == 'drain':
+            self.drain()
         elif cmd == 'view':
             if len(self.args) == 2:
                 self.view(self.args[1])
@@ -95,8 +199,16 @@ class QACommand(p.toolkit.CkanCommand):
 
     def init_db(self):
         import ckan.model as model
-        from ckanext.qa.model import init_tables
+        from ckanext.qa.model import init_tables, populate_package_qa, \
+            populate_qa_history
         init_tables(model.meta.engine)
+        num_packages = populate_package_qa()
+        if num_packages:
+            self.log.info('Aggregated the QA of %i datasets', num_packages)
+        num_results = populate_qa_history()
+        if num_results:
+            self.log.info('Started the QA history with %i results',
+                          num_results)
 
     def update(self):
         from ckan import model
@@ -173,20 +285,310 @@ class QACommand(p.toolkit.CkanCommand):
 
         self.log.info('Completed queueing')
 
+    def rescore_formats(self):
+        import datetime
+        from ckan import model
+        from ckanext.qa import lib
+        from ckanext.qa.model import QA, FormatScores, update_package_qa, \
+            record_qa_change, qa_change_fields
+        from ckanext.qa.tasks import rescore_qa_by_format, \
+            _update_search_index_in_batches
+
+        batch_size = 1000
+        format_index = lib.format_index()
+        version = lib.resource_format_scores_version()
+        FormatScores.record(version, format_index.scores)
+        model.Session.commit()
+
+        # Work out which formats have changed score since the results were
+        # saved
+        old_versions = [row[0] for row in
+                        model.Session.query(FormatScores.version)
+                        .filter(FormatScores.version != version)]
+        changed_formats = set()
+        for old_version in old_versions:
+            changed_formats |= lib.changed_format_scores(
+                FormatScores.get_scores(old_version), format_index.scores)
+        if self.options.old_scores:
+            with open(self.options.old_scores) as f:
+                old_scores = lib.parse_resource_format_scores(
+                    f.read(), self.options.old_scores)
+            changed_formats |= lib.changed_format_scores(
+                old_scores, format_index.scores)
+        elif model.Session.query(QA) \
+                .filter(QA.format_scores_version == None).first():
+            self.log.warning('Some results were saved before score versions '
+                             'were recorded. Use --old-scores to rescore '
+                             'them too.')
+        self.log.info('Formats with changed scores: %s',
+                      ', '.join(sorted(changed_formats)) or 'None')
+
+        old_version_filter = QA.format_scores_version.in_(old_versions) \
+            if old_versions else None
+        if self.options.old_scores:
+            null_version_filter = QA.format_scores_version == None
+            old_version_filter = or_(old_version_filter,
+                                     null_version_filter) \
+                if old_versions else null_version_filter
+
+        qa_ids = []
+        if changed_formats and old_version_filter is not None:
+            qa_ids = [row[0] for row in model.Session.query(QA.id)
+                      .filter(QA.format.in_(changed_formats))
+                      .filter(old_version_filter)]
+        self.log.info('Results with those formats: %i', len(qa_ids))
+
+        now = datetime.datetime.now()
+        package_ids_to_reindex = set()
+        package_ids_to_update = set()
+        for i in range(0, len(qa_ids), batch_size):
+            changed_package_ids = set()
+            for qa in model.Session.query(QA) \
+                    .filter(QA.id.in_(qa_ids[i:i + batch_size])):
+                before = qa_change_fields(qa)
+                changed = rescore_qa_by_format(qa, format_index, self.log)
+                if changed is None:
+                    package_ids_to_update.add(qa.package_id)
+                    continue
+                if changed:
+                    qa.updated = now
+                    record_qa_change(qa, before)
+                    changed_package_ids.add(qa.package_id)
+                qa.format_scores_version = version
+            for package_id in changed_package_ids:
+                update_package_qa(package_id)
+            package_ids_to_reindex |= changed_package_ids
+            model.Session.commit()
+            self.log.info('Rescored %i/%i results',
+                          min(i + batch_size, len(qa_ids)), len(qa_ids))
+
+        # The other results from old score tables are unaffected by the change
+        if old_version_filter is not None:
+            unaffected = model.Session.query(QA).filter(old_version_filter)
+            if changed_formats:
+                unaffected = unaffected.filter(or_(
+                    ~QA.format.in_(changed_formats), QA.format == None))
+            num_unaffected = unaffected.update(
+                {'format_scores_version': version},
+                synchronize_session=False)
+            model.Session.commit()
+            self.log.info('Results unaffected by the change: %i',
+                          num_unaffected)
+
+        self.log.info('Datasets with changed scores: %i',
+                      len(package_ids_to_reindex))
+        _update_search_index_in_batches(package_ids_to_reindex, self.log)
+
+        if package_ids_to_update:
+            queue = self.options.queue or 'bulk'
+            self.log.info('Datasets needing a full QA update: %i (queue: %s)',
+                          len(package_ids_to_update), queue)
+            for package_id in package_ids_to_update:
+                package = model.Package.get(package_id)
+                if package:
+                    lib.create_qa_update_package_task(package, queue)
+        self.log.info('Completed rescoring')
+
+    def rescore_local(self):
+        import multiprocessing
+        from ckan import model
+        from ckanext.qa.tasks import iter_resource_id_pages, \
+            score_resources, save_qa_results_in_bulk, \
+            init_score_resources_worker, _update_search_index_in_batches
+
+        page_size = 1000
+        chunk_size = 100
+        processes = self.options.processes or multiprocessing.cpu_count()
+        pool = None
+        if processes > 1:
+            # don't let the pool's processes share this one's connections
+            model.Session.remove()
+            model.meta.engine.dispose()
+            pool = multiprocessing.Pool(processes,
+                                        init_score_resources_worker)
+        package_ids = set()
+        num_scored = 0
+        try:
+            for resource_ids in iter_resource_id_pages(page_size):
+                chunks = [resource_ids[i:i + chunk_size]
+                          for i in range(0, len(resource_ids), chunk_size)]
+                if pool:
+                    results = pool.imap_unordered(score_resources, chunks)
+                else:
+                    results = (score_resources(chunk) for chunk in chunks)
+                for chunk_results in results:
+                    save_qa_results_in_bulk(chunk_results, self.log)
+                    package_ids.update(package_id for resource_id, package_id,
+                                       qa_result in chunk_results)
+                    num_scored += len(chunk_results)
+                self.log.info('Resources scored: %i', num_scored)
+        finally:
+            if pool:
+                pool.terminate()
+
+        self.log.info('Datasets to reindex: %i', len(package_ids))
+        _update_search_index_in_batches(package_ids, self.log)
+        self.log.info('Completed rescoring')
+
+    def daemon(self):
+        import multiprocessing
+        from ckan import model
+        from ckanext.qa import daemon
+        from ckanext.qa.tasks import init_score_resources_worker
+
+        processes = self.options.processes or multiprocessing.cpu_count()
+        pool = None
+        if processes > 1:
+            # don't let the pool's processes share this one's connections
+            model.Session.remove()
+            model.meta.engine.dispose()
+            pool = multiprocessing.Pool(processes,
+                                        init_score_resources_worker)
+        self.log.info('QA daemon started (%i processes)', processes)
+        try:
+            daemon.run(pool)
+        finally:
+            if pool:
+                pool.terminate()
+
+    def stats(self):
+        import time
+        from pylons import config
+        from ckanext.qa import metrics
+
+        filepath = config.get('qa.metrics.task_store')
+        if not filepath:
+            print 'Set qa.metrics.task_store in the CKAN config, for QA ' \
+                'workers to record their tasks'
+            sys.exit(1)
+        runs = metrics.TaskStore(filepath).get_since(
+            time.time() - self.options.hours * 60 * 60)
+        print 'QA task runs in the last %s hours: %s' % (self.options.hours,
+                                                       len(runs))
+
+        def format_stats(stats):
+            if not stats:
+                return '-'
+            return 'mean %.2fs  p50 %.2fs  p95 %.2fs  max %.2fs' % (
+                stats['mean'], stats['p50'], stats['p95'], stats['max'])
+        summary = metrics.summarise_task_runs(runs)
+        for task, task_summary in sorted(summary.items()):
+            print
+            print '%s: %s runs, %s errors' % (task, task_summary['runs'],
+                                              task_summary['errors'])
+            print '  Queue wait: %s' % format_stats(task_summary['queue_wait'])
+            print '  Duration:   %s' % format_stats(task_summary['seconds'])
+            for span, span_summary in sorted(task_summary['spans'].items()):
+                print '  %-10s  total %.1fs  mean %.2fs  p95 %.2fs  ' \
+                    '(%.0f%% of the time)' % (
+                        span + ':', span_summary['total'],
+                        span_summary['mean'], span_summary['p95'],
+                        (span_summary['share'] or 0) * 100)
+            for name, value in sorted(task_summary['counts'].items()):
+                print '  %s: %s (%.1f per run)' % (
+                    name.replace('_', ' ').capitalize(), value,
+                    float(value) / task_summary['runs'])
+
     def sniff(self):
-        from ckanext.qa.sniff_format import sniff_file_format
+        import multiprocessing
+        from ckanext.qa import lib
 
         if len(self.args) < 2:
             print 'Not enough arguments', self.args
             sys.exit(1)
-        for filepath in self.args[1:]:
-            format_ = sniff_file_format(
-                filepath, logging.getLogger('ckanext.qa.sniffer'))
-            if format_:
-                print 'Detected as: %s - %s' % (format_['display_name'],
-                                                filepath)
-            else:
-                print 'ERROR: Could not recognise format of: %s' % filepath
+        processes = self.options.processes or multiprocessing.cpu_count()
+        if self.options.ndjson:
+            # keep the sniffer's logging out of the way of the results
+            logging.getLogger('ckanext.qa.sniffer').setLevel(logging.WARNING)
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        filepaths = iter_filepaths(self.args[1:], sys.stdin)
+        try:
+            for result in sniff_files(filepaths, pool):
+                if self.options.ndjson:
+                    print json.dumps(result)
+                elif result['format']:
+                    resource_format = lib.format_index().get(
+                        result['format'])
+                    print 'Detected as: %s - %s' % (
+                        resource_format.display_name if resource_format
+                        else result['format'], result['path'])
+                elif result.get('error'):
+                    print 'ERROR: %s - %s' % (result['error'], result['path'])
+                else:
+                    print 'ERROR: Could not recognise format of: %s' % \
+                        result['path']
+                sys.stdout.flush()
+        finally:
+            if pool:
+                pool.terminate()
+
+    def shards(self):
+        from collections import defaultdict
+        from ckan import model
+        from ckanext.qa import lib
+
+        ring = lib.shard_ring()
+        other_ring = lib.HashRing(self.options.shards.split()) \
+            if self.options.shards else None
+        if not (ring or other_ring):
+            self.log.error('QA work is not sharded - set qa.shards in the '
+                           'config, or give --shards')
+            sys.exit(1)
+        rings = [r for r in (ring, other_ring) if r]
+
+        if len(self.args) > 1:
+            for package_ref in self.args[1:]:
+                package = model.Package.get(package_ref)
+                if not package:
+                    self.log.error('Dataset not found: %s', package_ref)
+                    continue
+                print '%s %s' % (package.name, ' -> '.join(
+                    r.get(package.id) for r in rings))
+            return
+
+        counts = [defaultdict(int) for r in rings]
+        moved = 0
+        total = 0
+        for package_id, in model.Session.query(model.Package.id) \
+                .filter_by(state='active').yield_per(1000):
+            shards = [r.get(package_id) for r in rings]
+            for shard, counts_ in zip(shards, counts):
+                counts_[shard] += 1
+            if len(shards) == 2 and shards[0] != shards[1]:
+                moved += 1
+            total += 1
+
+        all_shards = []
+        for r in rings:
+            all_shards += [shard for shard in r.shards
+                           if shard not in all_shards]
+        headings = ['qa.shards', '--shards'] if len(rings) == 2 else \
+            ['qa.shards' if ring else '--shards']
+        print '%-20s' % 'Shard' + ''.join('%16s' % h for h in headings)
+        for shard in all_shards:
+            print '%-20s' % shard + ''.join(
+                '%16s' % (counts_.get(shard, 0) if shard in r.shards
+                          else '-')
+                for r, counts_ in zip(rings, counts))
+        print 'Datasets: %i' % total
+        if len(rings) == 2 and total:
+            print 'Datasets that would move shard: %i (%.1f%%)' % \
+                (moved, 100.0 * moved / total)
+
+    def drain(self):
+        from ckanext.qa import dispatch
+        from ckanext.qa.model import PendingTask
+
+        rate = max(self.options.rate, 1)
+        self.log.info('Datasets pending: %i', PendingTask.count())
+        self.log.info('Queuing them at up to %i per second', rate)
+        while True:
+            start = time.time()
+            num_queued = dispatch.drain_pending_tasks(rate)
+            if num_queued:
+                self.log.info('Queued %i datasets (%i pending)',
+                              num_queued, PendingTask.count())
+            time.sleep(max(1 - (time.time() - start), 0))
 
     def view(self, package_ref=None):
         from ckan import model
@@ -277,3 +679,63 @@ class QACommand(p.toolkit.CkanCommand):
         model.Session.flush()
         model.Session.remove()
         print 'Migration succeeded'
+
+
+# Number of files given to each process in the pool at a time
+SNIFF_CHUNK_SIZE = 16
+
+
+def iter_filepaths(args, stdin):
+    '''Yields the file paths given by the args, which may be files,
+    directories (searched recursively), globs or '-' for paths listed in
+    stdin (one per line).'''
+    for arg in args:
+        if arg == '-':
+            paths = (line.rstrip('\r\n') for line in stdin)
+        elif os.path.exists(arg):
+            paths = [arg]
+        else:
+            paths = sorted(glob.glob(arg)) or [arg]
+        for path in paths:
+            if not path:
+                continue
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirnames.sort()
+                    for filename in sorted(filenames):
+                        yield os.path.join(dirpath, filename)
+            else:
+                yield path
+
+
+def sniff_files(filepaths, pool=None):
+    '''Sniffs the files, yielding a result dict for each (see sniff_file).
+    With a multiprocessing pool, they are sniffed in parallel, the pool
+    being handed the paths as they are found, and the results are yielded as
+    they finish.'''
+    if not pool:
+        for filepath in filepaths:
+            yield sniff_file(filepath)
+        return
+    for result in pool.imap_unordered(sniff_file, filepaths,
+                                      SNIFF_CHUNK_SIZE):
+        yield result
+
+
+def sniff_file(filepath):
+    '''Sniffs a file, returning a dict of its path, format, container and
+    the seconds it took. If it fails, the error is included.'''
+    from ckanext.qa.sniff_format import sniff_file_format
+    start = time.time()
+    result = {'path': filepath, 'format': None, 'container': None}
+    try:
+        format_ = sniff_file_format(
+            filepath, logging.getLogger('ckanext.qa.sniffer'))
+    except Exception, e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    else:
+        if format_:
+            result['format'] = format_['format']
+            result['container'] = format_.get('container')
+    result['seconds'] = round(time.time() - start, 4)
+    return result
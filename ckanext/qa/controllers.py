@@ -3,17 +3,51 @@ Link Checker Controller - DEPRECATED
 
 This controller exposes only one action: check_link
 """
+import datetime
 import json
+import logging
 import mimetypes
 import posixpath
+import threading
+import time
 import urllib
 import urlparse
 
+from pylons import config
+
+from ckan import plugins as p
 from ckan.lib.base import request, BaseController
 from ckan.lib.helpers import parse_rfc_2822_date
-from ckan.lib import helpers as ckan_helpers
 
 from ckanext.archiver.tasks import link_checker, LinkCheckerError
+from ckanext.qa import lib
+
+log = logging.getLogger(__name__)
+
+# Defaults for checking the urls of a request concurrently. They can be
+# overridden with qa.link_checker.max_workers, qa.link_checker.max_per_host
+# and qa.link_checker.deadline (seconds).
+LINK_CHECKER_MAX_WORKERS = 8
+LINK_CHECKER_MAX_PER_HOST = 2
+LINK_CHECKER_DEADLINE = 15
+LINK_CHECKER_DEADLINE_ERROR = 'Link check did not complete in time'
+LINK_CHECKER_ERROR = 'Link check failed: %s'
+
+# Defaults for caching the results of checking a url, in seconds. Results
+# with url_errors are kept for less time, as they are more likely to change.
+# Overridden with qa.link_checker.cache_ttl, qa.link_checker.cache_error_ttl
+# and qa.link_checker.cache_size. A TTL of 0 means don't cache.
+LINK_CHECKER_CACHE_TTL = 300
+LINK_CHECKER_CACHE_ERROR_TTL = 30
+LINK_CHECKER_CACHE_SIZE = 1000
+
+# Results for the url of a resource are taken from its Archival and QA,
+# instead of checking the url, if archiver downloaded it within this many
+# seconds. Overridden with qa.link_checker.archival_max_age (0 to disable).
+LINK_CHECKER_ARCHIVAL_MAX_AGE = 24 * 60 * 60
+
+_link_check_cache = None
+_link_check_cache_lock = threading.Lock()
 
 
 class LinkCheckerController(BaseController):
@@ -58,6 +92,12 @@ class LinkCheckerController(BaseController):
 
         size / last_modified: Just taken from the response headers.
 
+        The urls are checked concurrently (see _check_links). Any that are
+        not checked by the deadline are returned with a url_error saying so.
+        Results are cached for a short time (see _check_link). Urls of
+        resources recently archived are not checked, but given the results of
+        the archival (see _results_from_archival).
+
         TODO:
         =====
 
@@ -68,12 +108,111 @@ class LinkCheckerController(BaseController):
              [2] http://www.ons.gov.uk/ons/rel/regional-trends/region-and-country-profiles/social-indicators/index.html
         """
         urls = request.GET.getall('url')
-        result = [ self._check_link(url) for url in urls ]
+        result = self._check_links(urls)
         return json.dumps(result)
 
+    def _check_links(self, urls):
+        """
+        Checks the given urls concurrently, returning a list of results in
+        the same order as the urls.
+
+        At most qa.link_checker.max_workers urls are checked at once, and no
+        more than qa.link_checker.max_per_host of those on the same host. If
+        qa.link_checker.deadline seconds pass then the results so far are
+        returned, and the rest are given a url_error.
+        """
+        max_workers = p.toolkit.asint(config.get(
+            'qa.link_checker.max_workers', LINK_CHECKER_MAX_WORKERS))
+        max_per_host = p.toolkit.asint(config.get(
+            'qa.link_checker.max_per_host', LINK_CHECKER_MAX_PER_HOST))
+        deadline = float(config.get('qa.link_checker.deadline',
+                                    LINK_CHECKER_DEADLINE))
+        archived_results = self._results_from_archival(urls)
+        results = [archived_results.get(url) for url in urls]
+        unchecked = [i for i, result in enumerate(results) if result is None]
+        checked_results = check_concurrently(
+            self._check_link, [urls[i] for i in unchecked], key=url_host,
+            max_workers=max_workers, max_per_key=max_per_host,
+            timeout=deadline, on_error=self._error_result)
+        for i, result in zip(unchecked, checked_results):
+            results[i] = result
+        for i, url in enumerate(urls):
+            if results[i] is None:
+                log.info('Link check did not complete within %ss: %r',
+                         deadline, url)
+                results[i] = self._empty_result()
+                results[i]['url_errors'].append(LINK_CHECKER_DEADLINE_ERROR)
+        return results
+
+    def _results_from_archival(self, urls):
+        """
+        Returns a dict of url: result for those urls that are the url of a
+        resource that archiver has successfully downloaded within
+        qa.link_checker.archival_max_age seconds.
+
+        The result is made from the Archival (mimetype, size and
+        last-modified) and the format that QA sniffed from the download, if
+        QA has been done on it.
+        """
+        max_age = p.toolkit.asint(config.get(
+            'qa.link_checker.archival_max_age', LINK_CHECKER_ARCHIVAL_MAX_AGE))
+        if not max_age:
+            return {}
+        from ckanext.qa.model import get_archived_resources_by_url
+        archived_since = datetime.datetime.now() - \
+            datetime.timedelta(seconds=max_age)
+        results = {}
+        for url, (archival, qa) in get_archived_resources_by_url(
+                urls, archived_since).items():
+            result = self._empty_result()
+            mimetype = archival.mimetype or ''
+            if qa and qa.format and \
+                    qa.archival_timestamp == archival.updated:
+                result['format'] = qa.format
+            else:
+                result['format'] = self._extract_file_format(
+                    url, {'content-type': mimetype})
+            result['mimetype'] = mimetype
+            if archival.size is not None:
+                result['size'] = unicode(archival.size)
+            last_modified = archival.last_modified
+            if isinstance(last_modified, datetime.datetime):
+                result['last_modified'] = last_modified.isoformat()
+            elif last_modified:
+                result['last_modified'] = \
+                    self._parse_and_format_date(last_modified)
+            results[url] = result
+        return results
+
     def _check_link(self, url):
         """
-        Synchronously check the given link, and return dict representing results.
+        Check the given link, and return dict representing results, using
+        the cached result if there is one.
+
+        Results are cached by the normalised url for qa.link_checker.cache_ttl
+        seconds, or qa.link_checker.cache_error_ttl if it has url_errors.
+        """
+        ttl = p.toolkit.asint(config.get('qa.link_checker.cache_ttl',
+                                         LINK_CHECKER_CACHE_TTL))
+        error_ttl = p.toolkit.asint(config.get(
+            'qa.link_checker.cache_error_ttl', LINK_CHECKER_CACHE_ERROR_TTL))
+        if not ttl and not error_ttl:
+            return self._check_link_uncached(url)[0]
+        cache = link_check_cache()
+        key = normalise_url(url)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached['result']
+        result, headers = self._check_link_uncached(url)
+        ttl = error_ttl if result['url_errors'] else ttl
+        if ttl:
+            cache.set(key, {'result': result, 'headers': headers}, ttl=ttl)
+        return result
+
+    def _check_link_uncached(self, url):
+        """
+        Synchronously check the given link, and return dict representing results
+        and the headers of the HEAD request (None if it failed).
         Does not handle 30x redirects.
         """
 
@@ -87,14 +226,8 @@ class LinkCheckerController(BaseController):
             'url_timeout': 10,
             'url': url
         }
-        result = {
-            'errors': [],
-            'url_errors': [],
-            'format': '',
-            'mimetype': '',
-            'size': '',
-            'last_modified': '',
-        }
+        result = self._empty_result()
+        headers = None
 
         try:
             headers = json.loads(link_checker(json.dumps(context), json.dumps(data)))
@@ -104,8 +237,23 @@ class LinkCheckerController(BaseController):
             result['last_modified'] = self._parse_and_format_date(headers.get('last-modified', ''))
         except LinkCheckerError, e:
             result['url_errors'].append(str(e))
+        return result, headers
+
+    def _error_result(self, url, error):
+        result = self._empty_result()
+        result['url_errors'].append(LINK_CHECKER_ERROR % error)
         return result
 
+    def _empty_result(self):
+        return {
+            'errors': [],
+            'url_errors': [],
+            'format': '',
+            'mimetype': '',
+            'size': '',
+            'last_modified': '',
+        }
+
     def _extract_file_format(self, url, headers):
         """
         Makes a best guess at the file format.
@@ -126,16 +274,16 @@ class LinkCheckerController(BaseController):
             base, extension = posixpath.splitext(base)
         if formats:
             extension = '.'.join(formats[::-1]).lower()
-            format_tuple = ckan_helpers.resource_formats().get(extension)
-            if format_tuple:
-                return format_tuple[1]
+            resource_format = lib.format_index().get(extension)
+            if resource_format:
+                return resource_format.name
             return ' / '.join(formats[::-1])
 
         # No file extension found, attempt to extract format using the mimetype
         stripped_mimetype = self._extract_mimetype(headers) # stripped of charset
-        format_tuple = ckan_helpers.resource_formats().get(stripped_mimetype)
-        if format_tuple:
-            return format_tuple[1]
+        resource_format = lib.format_index().get(stripped_mimetype)
+        if resource_format:
+            return resource_format.name
 
         extension = mimetypes.guess_extension(stripped_mimetype)
         if extension:
@@ -159,3 +307,128 @@ class LinkCheckerController(BaseController):
         if dt and dt.tzinfo:
             dt = (dt - dt.utcoffset()).replace(tzinfo=None)
         return dt.isoformat() if dt else ''
+
+
+def link_check_cache():
+    """
+    The cache of link check results. It is kept in this process, unless
+    qa.link_checker.cache_file is set, which is a SQLite file to share the
+    cache between processes.
+    """
+    global _link_check_cache
+    filepath = config.get('qa.link_checker.cache_file')
+    max_size = p.toolkit.asint(config.get('qa.link_checker.cache_size',
+                                          LINK_CHECKER_CACHE_SIZE))
+    cache_key = (filepath, max_size)
+    with _link_check_cache_lock:
+        if _link_check_cache is None or _link_check_cache[0] != cache_key:
+            if filepath:
+                cache = lib.SqliteCache(filepath, max_size)
+            else:
+                cache = lib.LRUCache(max_size)
+            _link_check_cache = (cache_key, cache)
+        return _link_check_cache[1]
+
+
+def normalise_url(url):
+    """
+    Normalises a url, as entered by the user, for use as a cache key.
+    Surrounding whitespace and the fragment are removed, the scheme and host
+    are lower-cased, and a url without a scheme is assumed to be http.
+    """
+    url = url.strip()
+    scheme, path = urllib.splittype(url)
+    if not scheme:
+        url = 'http://' + path
+    parsed = urlparse.urlsplit(url)
+    return urlparse.urlunsplit((parsed.scheme.lower(), parsed.netloc.lower(),
+                                parsed.path, parsed.query, ''))
+
+
+def url_host(url):
+    """
+    The host (and port) of a url, lower-cased, as entered by the user -
+    i.e. a url without a scheme is assumed to be http.
+    """
+    scheme, path = urllib.splittype(url)
+    if not scheme:
+        url = 'http://' + path
+    return urlparse.urlparse(url).netloc.lower()
+
+
+def check_concurrently(func, args, key=None, max_workers=8, max_per_key=None,
+                       timeout=None, on_error=None):
+    """
+    Calls func(arg) for each of the args in a pool of threads, returning the
+    list of return values in the same order as the args.
+
+    :param key: function of an arg, e.g. its host. No more than max_per_key
+                calls with the same key run at once - other args are called
+                in the meantime.
+    :param max_workers: the maximum number of calls that run at once
+    :param timeout: seconds to wait for all the calls. Any that have not
+                    returned by then are given as None in the returned list.
+                    Calls still running are left to finish in the
+                    background, but those not yet started are dropped.
+    :param on_error: function(arg, exception) giving the return value for a
+                     call of func that raised an exception. The exception is
+                     logged, and without on_error, the value given is None.
+    """
+    results = [None] * len(args)
+    if not args:
+        return results
+    # (index, arg, key) still to be called, in order
+    pending = [(i, arg, key(arg) if key else None)
+               for i, arg in enumerate(args)]
+    running = {}  # key: number of calls running with that key
+    state = {'remaining': len(args)}
+    changed = threading.Condition()
+
+    def next_job():
+        for i, job in enumerate(pending):
+            if not max_per_key or running.get(job[2], 0) < max_per_key:
+                del pending[i]
+                running[job[2]] = running.get(job[2], 0) + 1
+                return job
+
+    def worker():
+        while True:
+            with changed:
+                job = next_job()
+                while job is None:
+                    if not pending:
+                        return
+                    changed.wait()
+                    job = next_job()
+            index, arg, arg_key = job
+            try:
+                result = func(arg)
+            except Exception, e:
+                log.exception('Error checking %r', arg)
+                result = on_error(arg, e) if on_error else None
+            with changed:
+                results[index] = result
+                running[arg_key] -= 1
+                state['remaining'] -= 1
+                changed.notify_all()
+
+    for i in range(min(max_workers, len(args))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    end = time.time() + timeout if timeout is not None else None
+    with changed:
+        while state['remaining']:
+            if end is None:
+                changed.wait()
+                continue
+            wait = end - time.time()
+            if wait <= 0:
+                # so that the workers stop after their current calls
+                del pending[:]
+                changed.notify_all()
+                break
+            changed.wait(wait)
+        # a copy, so that late results don't change what is returned
+        return list(results)
@@ -0,0 +1,182 @@
+'''
+"paster qa daemon" - QA of resources as they change, without Celery tasks.
+
+Rather than a task per dataset, queued when the archiver asks for it (see
+QAPlugin.receive_data), it polls for resources that have changed, scores them
+in batches in a pool of processes (score_resources), saves the results in
+bulk (save_qa_results_in_bulk) and reindexes the datasets together.
+
+Changes are read from two streams, each in order of time:
+
+* archivals, by Archival.updated - the resource's file was (re)downloaded
+* datasets, by Package.metadata_modified - e.g. a resource's URL or format
+  was edited, which changes the dataset's metadata_modified
+
+How far it has got in each stream is stored as a Watermark, which is saved
+in the same transaction as the results of the batch, so that after a restart
+it carries on where it stopped, neither missing changes nor scoring them
+again. Changes from the last few seconds are left for the next poll, since
+transactions that are still running could yet commit changes with times
+before them:
+
+    qa.daemon.delay = 60
+
+Its other settings are the number of changes read at a time, and how often
+it polls (seconds) when there are none:
+
+    qa.daemon.batch_size = 1000
+    qa.daemon.poll_interval = 10
+'''
+import time
+import logging
+import datetime
+
+from pylons import config
+from sqlalchemy import or_, and_, func
+
+from ckan import model
+from ckan.plugins import toolkit
+
+from ckanext.archiver.model import Archival
+from ckanext.qa.model import QA, Watermark
+from ckanext.qa.tasks import score_resources, save_qa_results_in_bulk, \
+    _update_search_index_in_batches
+
+log = logging.getLogger(__name__)
+
+# Defaults of the config options (see above)
+DELAY = 60
+BATCH_SIZE = 1000
+POLL_INTERVAL = 10
+
+# Resources scored by each process in the pool at a time
+SCORE_CHUNK_SIZE = 100
+
+STREAMS = ('archival', 'package')
+
+
+def _stream_columns(stream):
+    '''Returns the (timestamp, id) columns of a stream, and the function
+    giving the current time in the timestamps' time zone.'''
+    if stream == 'archival':
+        # the archiver records local time
+        return Archival.updated, Archival.resource_id, datetime.datetime.now
+    elif stream == 'package':
+        return model.Package.metadata_modified, model.Package.id, \
+            datetime.datetime.utcnow
+    raise ValueError('Unknown stream: %r' % stream)
+
+
+def read_changes(stream, after, until, limit):
+    '''Returns up to "limit" changes in a stream, as (timestamp, id), in
+    order, after the watermark "after" (a (timestamp, id)) and before the
+    datetime "until".
+
+    Changes are ordered by id as well as time, so that if more changes have
+    the same time than are read at once, the rest are read next time.
+    '''
+    time_column, id_column = _stream_columns(stream)[:2]
+    timestamp, id_ = after
+    q = model.Session.query(time_column, id_column) \
+        .filter(time_column < until) \
+        .filter(or_(time_column > timestamp,
+                    and_(time_column == timestamp, id_column > id_)))
+    return q.order_by(time_column, id_column).limit(limit).all()
+
+
+def resource_ids_to_score(stream, ids):
+    '''Returns the ids of the active resources (of active datasets) that the
+    ids of changes in a stream refer to.'''
+    q = model.Session.query(model.Resource.id)
+    if toolkit.check_ckan_version(max_version='2.2.99'):
+        q = q.join(model.ResourceGroup)
+    q = q.join(model.Package) \
+        .filter(model.Resource.state == 'active') \
+        .filter(model.Package.state == 'active')
+    if stream == 'archival':
+        q = q.filter(model.Resource.id.in_(ids))
+    else:
+        q = q.filter(model.Package.id.in_(ids))
+    return [row[0] for row in q]
+
+
+def start_watermark(stream):
+    '''Returns the watermark of a stream, as (timestamp, id).
+
+    When the daemon is first run, it starts from the time of the most recent
+    QA result, since the changes before that have been scored by the Celery
+    tasks (or from the start, if there are no results). This is saved, so
+    that it doesn't move on as the daemon saves results.
+    '''
+    watermark = Watermark.get(stream)
+    if watermark is None:
+        timestamp = model.Session.query(func.max(QA.updated)).scalar()
+        if timestamp is None:
+            timestamp = datetime.datetime.min
+        elif stream == 'package':
+            # QA.updated is local time
+            timestamp += datetime.datetime.utcnow() - \
+                datetime.datetime.now()
+        watermark = Watermark.set(stream, timestamp, u'')
+        model.Session.commit()
+        log.info('Starting %s changes from %s', stream, timestamp)
+    return (watermark.timestamp, watermark.key)
+
+
+def score(resource_ids, pool=None):
+    '''Scores resources, in the pool if there is one, returning the
+    results of score_resources.'''
+    chunks = [resource_ids[i:i + SCORE_CHUNK_SIZE]
+              for i in range(0, len(resource_ids), SCORE_CHUNK_SIZE)]
+    if pool:
+        chunk_results = pool.imap_unordered(score_resources, chunks)
+    else:
+        chunk_results = (score_resources(chunk) for chunk in chunks)
+    return [result for results in chunk_results for result in results]
+
+
+def process_changes(stream, changes, pool=None):
+    '''Scores the resources of a batch of changes in a stream, saves the
+    results along with the stream's new watermark, and reindexes the
+    datasets. Returns the number of resources scored.'''
+    resource_ids = resource_ids_to_score(
+        stream, list(set(id_ for timestamp, id_ in changes)))
+    results = score(resource_ids, pool)
+    # committed with the results
+    Watermark.set(stream, *changes[-1])
+    if results:
+        save_qa_results_in_bulk(results, log)
+    else:
+        model.Session.commit()
+    package_ids = set(package_id for resource_id, package_id, qa_result
+                      in results)
+    if package_ids:
+        _update_search_index_in_batches(package_ids, log)
+    return len(results)
+
+
+def run(pool=None, once=False):
+    '''Polls the streams for changes and processes them, until stopped, or
+    if "once", until there are no more changes.'''
+    delay = toolkit.asint(config.get('qa.daemon.delay', DELAY))
+    batch_size = toolkit.asint(config.get('qa.daemon.batch_size',
+                                          BATCH_SIZE))
+    poll_interval = toolkit.asint(config.get('qa.daemon.poll_interval',
+                                             POLL_INTERVAL))
+    while True:
+        num_changes = 0
+        for stream in STREAMS:
+            now = _stream_columns(stream)[2]
+            until = now() - datetime.timedelta(seconds=delay)
+            changes = read_changes(stream, start_watermark(stream), until,
+                                   batch_size)
+            if not changes:
+                continue
+            num_scored = process_changes(stream, changes, pool)
+            log.info('Changes to %ss: %i, resources scored: %i (up to %s)',
+                     stream, len(changes), num_scored, changes[-1][0])
+            num_changes += len(changes)
+        if not num_changes:
+            if once:
+                return
+            time.sleep(poll_interval)
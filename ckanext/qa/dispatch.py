@@ -0,0 +1,172 @@
+'''
+Dispatch of the QA tasks that the archiver asks for, holding them back when
+their queue is long.
+
+During a mass archive, the archiver asks for the QA of each dataset as it
+finishes, which could put hundreds of thousands of tasks in the queue, and
+tasks put in the priority queue would wait behind them. So when a queue has
+more than this many tasks (0 to never hold them back):
+
+    qa.dispatch.max_queue_length = 10000
+
+the dataset is recorded in the qa_pending table (PendingTask) instead, which
+is quick and doesn't block the archiver. "paster qa drain" queues the
+pending datasets (priority ones first, then the oldest) at a steady rate,
+whilst there is room in their queue.
+
+Queue lengths come from the broker, but to avoid asking it for every task,
+they are only refreshed every so often (seconds), and in between the tasks
+sent are added to them. Whether any datasets are pending is checked as
+often, so that a dataset queued directly is only looked for in qa_pending
+when there may be some:
+
+    qa.dispatch.queue_length_check_interval = 10
+'''
+import time
+import logging
+
+from pylons import config
+
+from ckan import model
+from ckan.lib.celery_app import celery
+from ckan.plugins import toolkit
+
+from ckanext.qa import lib
+from ckanext.qa.model import PendingTask
+
+log = logging.getLogger(__name__)
+
+# Defaults of the config options (see above)
+MAX_QUEUE_LENGTH = 10000
+QUEUE_LENGTH_CHECK_INTERVAL = 10
+
+_queue_lengths = None
+
+
+def max_queue_length():
+    return toolkit.asint(config.get('qa.dispatch.max_queue_length',
+                                    MAX_QUEUE_LENGTH))
+
+
+def broker_queue_length(queue):
+    '''Returns the number of tasks in a queue, asking the broker, or None if
+    it can't tell.'''
+    try:
+        connection = celery.broker_connection()
+        try:
+            # returns (queue, message_count, consumer_count)
+            return connection.default_channel.queue_declare(
+                queue=queue, passive=True)[1]
+        finally:
+            connection.release()
+    except Exception, e:
+        log.warning('Could not get the length of queue %s: %s', queue, e)
+        return None
+
+
+class QueueLengths(object):
+    '''Estimates of the queue lengths, from the broker's counts, refreshed
+    every check_interval seconds, plus the tasks this process has sent
+    since. Also whether there are pending datasets, refreshed as often.'''
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._lengths = {}  # queue: (length or None, time.time() checked)
+        self._pending = (None, None)  # (any pending, time.time() checked)
+
+    def get(self, queue):
+        length, checked = self._lengths.get(queue, (None, None))
+        now = time.time()
+        if checked is None or now - checked >= self.check_interval:
+            length = broker_queue_length(queue)
+            self._lengths[queue] = (length, now)
+        return length
+
+    def sent(self, queue, num_tasks=1):
+        length, checked = self._lengths.get(queue, (None, None))
+        if length is not None:
+            self._lengths[queue] = (length + num_tasks, checked)
+
+    def is_full(self, queue, max_length):
+        if not max_length:
+            return False
+        length = self.get(queue)
+        return length is not None and length >= max_length
+
+    def any_pending(self):
+        any_pending, checked = self._pending
+        now = time.time()
+        if checked is None or now - checked >= self.check_interval:
+            any_pending = PendingTask.any()
+            self._pending = (any_pending, now)
+        return any_pending
+
+    def added_pending(self):
+        self._pending = (True, self._pending[1])
+
+
+def queue_lengths():
+    global _queue_lengths
+    check_interval = toolkit.asint(config.get(
+        'qa.dispatch.queue_length_check_interval',
+        QUEUE_LENGTH_CHECK_INTERVAL))
+    if _queue_lengths is None or \
+            _queue_lengths.check_interval != check_interval:
+        _queue_lengths = QueueLengths(check_interval)
+    return _queue_lengths
+
+
+def dispatch_package_task(package, queue):
+    '''Queues the QA of a dataset, or if the queue is too long, records it
+    as pending. It is called by the archiver, so it leaves the session
+    alone - pending datasets are written in transactions of their own.
+
+    With qa.dispatch.max_queue_length = 0 it is always queued, and the
+    qa_pending table is not used (so it needn't exist).
+
+    Returns True if it was queued, False if it is pending.
+    '''
+    max_length = max_queue_length()
+    if not max_length:
+        lib.create_qa_update_package_task(package, queue)
+        return True
+    lengths = queue_lengths()
+    shard_queue = lib.shard_queue(queue, package.id)
+    if lengths.is_full(shard_queue, max_length):
+        PendingTask.add(package.id, queue)
+        lengths.added_pending()
+        log.debug('Queue %s is full - QA of package is pending: %s',
+                  shard_queue, package.name)
+        return False
+    lib.create_qa_update_package_task(package, queue)
+    lengths.sent(shard_queue)
+    # it may have been held back before, but needn't be QA'd again
+    if lengths.any_pending():
+        PendingTask.remove(package.id)
+    return True
+
+
+def drain_pending_tasks(max_tasks):
+    '''Queues up to max_tasks of the pending datasets (priority ones first,
+    then the oldest), skipping those whose queue is (still) too long.
+
+    Returns the number of tasks queued.
+    '''
+    lengths = queue_lengths()
+    max_length = max_queue_length()
+    full_queues = set()
+    num_queued = 0
+    for pending in PendingTask.get_next(max_tasks):
+        shard_queue = lib.shard_queue(pending.queue, pending.package_id)
+        if shard_queue in full_queues:
+            continue
+        if lengths.is_full(shard_queue, max_length):
+            full_queues.add(shard_queue)
+            continue
+        package = model.Package.get(pending.package_id)
+        if package and package.state == 'active':
+            lib.create_qa_update_package_task(package, pending.queue)
+            lengths.sent(shard_queue)
+            num_queued += 1
+        model.Session.delete(pending)
+    model.Session.commit()
+    return num_queued
@@ -1,6 +1,54 @@
-import copy
+import hashlib
+
+from pylons import config
+
+from ckan.lib import i18n
 from ckan.plugins import toolkit as tk
 
+from ckanext.qa import lib
+
+# The QA fields that the openness stars templates display
+STARS_TEMPLATE_FIELDS = ('openness_score', 'openness_score_reason', 'updated')
+
+# Number of rendered openness stars to keep, by default
+STARS_CACHE_SIZE = 1000
+
+_stars_cache = None
+
+
+def stars_cache():
+    '''Returns the cache of rendered openness stars. Many resources have the
+    same score, reason and time checked (e.g. all those in a dataset QA'd
+    together), so they are rendered once, rather than once per resource.'''
+    global _stars_cache
+    if _stars_cache is None:
+        _stars_cache = lib.LRUCache(tk.asint(
+            config.get('qa.stars_cache_size', STARS_CACHE_SIZE)))
+    return _stars_cache
+
+
+def render_stars(template, qa):
+    '''Renders an openness stars template for a QA dict, or returns it from
+    the cache.'''
+    reason = qa.get('openness_score_reason')
+    reason_hash = hashlib.sha1(reason.encode('utf8')).hexdigest() \
+        if isinstance(reason, basestring) else repr(reason)
+    key = (template, qa.get('openness_score'), reason_hash,
+           unicode(qa.get('updated')), i18n.get_lang())
+    cache = stars_cache()
+    html = cache.get(key)
+    if html is None:
+        # Pass only the fields the templates use, in a new dict, because
+        # weirdly the renderer appears to add keys to it like _ and
+        # app_globals. This is bad because when it comes to render the debug
+        # in the footer those extra keys take about 30s to render, for some
+        # reason.
+        extra_vars = dict((field, qa.get(field))
+                          for field in STARS_TEMPLATE_FIELDS)
+        html = tk.render(template, extra_vars=extra_vars)
+        cache.set(key, html)
+    return tk.literal(html)
+
 
 def qa_openness_stars_resource_html(resource):
     qa = resource.get('qa')
@@ -8,15 +56,7 @@ def qa_openness_stars_resource_html(resource):
         return tk.literal('<!-- No qa info for this resource -->')
     if not isinstance(qa, dict):
         return tk.literal('<!-- QA info was of the wrong type -->')
-
-    # Take a copy of the qa dict, because weirdly the renderer appears to add
-    # keys to it like _ and app_globals. This is bad because when it comes to
-    # render the debug in the footer those extra keys take about 30s to render,
-    # for some reason.
-    extra_vars = copy.deepcopy(qa)
-    return tk.literal(
-        tk.render('qa/openness_stars.html',
-                  extra_vars=extra_vars))
+    return render_stars('qa/openness_stars.html', qa)
 
 
 def qa_openness_stars_dataset_html(dataset):
@@ -25,7 +65,4 @@ def qa_openness_stars_dataset_html(dataset):
         return tk.literal('<!-- No qa info for this dataset -->')
     if not isinstance(qa, dict):
         return tk.literal('<!-- QA info was of the wrong type -->')
-    extra_vars = copy.deepcopy(qa)
-    return tk.literal(
-        tk.render('qa/openness_stars_brief.html',
-                  extra_vars=extra_vars))
+    return render_stars('qa/openness_stars_brief.html', qa)
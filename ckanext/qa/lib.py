@@ -1,11 +1,19 @@
 import os
 import json
+import bisect
 import re
+import time
+import hashlib
 import logging
+import sqlite3
+import threading
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 
 from pylons import config
 
 from ckan import plugins as p
+from ckan.lib import helpers as ckan_helpers
 from ckan.lib.celery_app import celery
 from ckan.model.types import make_uuid
 
@@ -13,6 +21,13 @@ from ckan.model.types import make_uuid
 log = logging.getLogger(__name__)
 
 _RESOURCE_FORMAT_SCORES = None
+_RESOURCE_FORMAT_SCORES_VERSION = None
+# (filepath, mtime, size) of the scores file when it was last loaded
+_resource_format_scores_file = None
+_resource_format_scores_checked = 0  # time.time() of the last check
+
+# How often (seconds) to check whether the scores file has changed, by default
+RESOURCE_FORMAT_SCORES_CHECK_INTERVAL = 10
 
 
 def resource_format_scores():
@@ -27,39 +42,108 @@ def resource_format_scores():
 
     Fuller description of the fields are described in
     `ckan/config/resource_formats.json`.
+
+    The file is reloaded if it has changed, checking no more often than
+    qa.resource_format_openness_scores_check_interval seconds. A reload
+    returns a new dict, rather than changing the old one.
+    '''
+    global _resource_format_scores_checked
+    now = time.time()
+    if _RESOURCE_FORMAT_SCORES is None or \
+            now - _resource_format_scores_checked >= p.toolkit.asint(config.get(
+                'qa.resource_format_openness_scores_check_interval',
+                RESOURCE_FORMAT_SCORES_CHECK_INTERVAL)):
+        _resource_format_scores_checked = now
+        _load_resource_format_scores()
+    return _RESOURCE_FORMAT_SCORES
+
+
+def resource_format_scores_version():
+    '''Returns the version of the resource format scores table, as returned
+    by resource_format_scores(). It is a hash of the file\'s content, so is the
+    same for all processes using the same table.'''
+    resource_format_scores()
+    return _RESOURCE_FORMAT_SCORES_VERSION
+
+
+def resource_format_scores_filepath():
+    json_filepath = config.get('qa.resource_format_openness_scores_json')
+    if not json_filepath:
+        json_filepath = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)),
+            'resource_format_openness_scores.json'
+        )
+    return json_filepath
+
+
+def _load_resource_format_scores():
+    '''(Re)loads the scores file, if it has changed since it was loaded.
+
+    If a changed file can't be read or is invalid, the error is logged and
+    the scores already loaded are kept. It is only raised if there are none.
     '''
-    global _RESOURCE_FORMAT_SCORES
-    if not _RESOURCE_FORMAT_SCORES:
-        _RESOURCE_FORMAT_SCORES = {}
-        json_filepath = config.get('qa.resource_format_openness_scores_json')
-        import ckanext.qa.plugin
-        if not json_filepath:
-            json_filepath = os.path.join(
-                os.path.dirname(os.path.realpath(ckanext.qa.plugin.__file__)),
-                'resource_format_openness_scores.json'
-            )
+    global _RESOURCE_FORMAT_SCORES, _RESOURCE_FORMAT_SCORES_VERSION, \
+        _resource_format_scores_file
+    json_filepath = resource_format_scores_filepath()
+    try:
+        stat = os.stat(json_filepath)
+        file_key = (json_filepath, stat.st_mtime, stat.st_size)
+        if file_key == _resource_format_scores_file:
+            return
         with open(json_filepath) as format_file:
-            try:
-                file_resource_formats = json.loads(format_file.read())
-            except ValueError, e:
-                # includes simplejson.decoder.JSONDecodeError
-                raise ValueError('Invalid JSON syntax in %s: %s' %
-                                 (json_filepath, e))
-
-            for format_line in file_resource_formats:
-                if format_line[0] == '_comment':
-                    continue
-                format_, score = format_line
-                if not isinstance(score, int):
-                    raise ValueError('Score must be integer in %s: %s: %r'
-                                     % json_filepath, format_, score)
-                if format_ in _RESOURCE_FORMAT_SCORES:
-                    raise ValueError('Duplicate resource format '
-                                     'identifier in %s: %s' %
-                                     (json_filepath, format_))
-                _RESOURCE_FORMAT_SCORES[format_] = score
+            content = format_file.read()
+        # don't try again until the file changes again
+        _resource_format_scores_file = file_key
+        version = unicode(hashlib.sha1(content).hexdigest()[:12])
+        if version == _RESOURCE_FORMAT_SCORES_VERSION:
+            # e.g. the file was touched, but not changed
+            return
+        scores = parse_resource_format_scores(content, json_filepath)
+    except (ValueError, IOError, OSError), e:
+        if _RESOURCE_FORMAT_SCORES is None:
+            raise
+        log.error('Could not reload the resource format scores - keeping '
+                  'version %s: %s', _RESOURCE_FORMAT_SCORES_VERSION, e)
+        return
+    if _RESOURCE_FORMAT_SCORES_VERSION:
+        log.info('Resource format scores changed from version %s to %s',
+                 _RESOURCE_FORMAT_SCORES_VERSION, version)
+    _RESOURCE_FORMAT_SCORES, _RESOURCE_FORMAT_SCORES_VERSION = \
+        scores, version
+
+
+def parse_resource_format_scores(content, json_filepath):
+    '''Parses the content of a resource format scores JSON file, returning a
+    dict of format shortname: score.'''
+    try:
+        file_resource_formats = json.loads(content)
+    except ValueError, e:
+        # includes simplejson.decoder.JSONDecodeError
+        raise ValueError('Invalid JSON syntax in %s: %s' %
+                         (json_filepath, e))
+
+    scores = {}
+    for format_line in file_resource_formats:
+        if format_line[0] == '_comment':
+            continue
+        format_, score = format_line
+        if not isinstance(score, int):
+            raise ValueError('Score must be integer in %s: %s: %r'
+                             % (json_filepath, format_, score))
+        if format_ in scores:
+            raise ValueError('Duplicate resource format '
+                             'identifier in %s: %s' %
+                             (json_filepath, format_))
+        scores[format_] = score
+    return scores
 
-    return _RESOURCE_FORMAT_SCORES
+
+def changed_format_scores(old_scores, new_scores):
+    '''Returns the set of formats whose score differs between two versions
+    of the scores table (including formats added or removed).'''
+    formats = set(old_scores) | set(new_scores)
+    return set(format_ for format_ in formats
+               if old_scores.get(format_) != new_scores.get(format_))
 
 
 def munge_format_to_be_canonical(format_name):
@@ -72,11 +156,240 @@ def munge_format_to_be_canonical(format_name):
     return re.sub('[^a-z/+]', '', format_name)
 
 
+# A resource format, as defined in ckan's resource_formats.json, with the
+# openness score it receives (None if it is not configured)
+ResourceFormat = namedtuple('ResourceFormat',
+                            ['name', 'display_name', 'mimetype', 'score'])
+
+
+class FormatIndex(object):
+    '''Lookup of resource formats by any of their names, extensions or
+    mimetypes, combined with their openness scores.
+
+    It is built once from ckan's resource_formats() and
+    resource_format_scores(), so that looking up a format and its score is a
+    single dict access, rather than repeated calls to both.
+    '''
+    def __init__(self, resource_formats, scores):
+        self.scores = scores
+        self._formats = {}
+        # resource_formats() has the same format line for each of its keys
+        formats_by_line = {}
+        for key, line in resource_formats.items():
+            if id(line) not in formats_by_line:
+                mimetype, name, display_name = line[:3]
+                formats_by_line[id(line)] = ResourceFormat(
+                    name, display_name, mimetype, scores.get(name))
+            self._formats[key] = formats_by_line[id(line)]
+
+    def get(self, key, munge=False):
+        '''Returns the ResourceFormat for the given key, or None.
+
+        :param key: format extension / mimetype / title e.g. 'CSV',
+                    'application/msword', 'Word document'
+        :param munge: if the key is not found, also try it munged by
+                      munge_format_to_be_canonical (for user-entered values)
+        '''
+        format_ = self._formats.get(key.lower())
+        if format_ is None and munge:
+            format_ = self._formats.get(munge_format_to_be_canonical(key))
+        return format_
+
+    def score(self, format_name):
+        '''Returns the openness score for a format's short name (e.g. 'CSV'),
+        or None if it is not configured.'''
+        return self.scores.get(format_name)
+
+
+_FORMAT_INDEX = None
+
+
+def format_index():
+    '''Returns the FormatIndex. It is built the first time it is needed and
+    only rebuilt if resource_format_scores() returns a different table.'''
+    global _FORMAT_INDEX
+    scores = resource_format_scores()
+    if _FORMAT_INDEX is None or _FORMAT_INDEX.scores is not scores:
+        _FORMAT_INDEX = FormatIndex(ckan_helpers.resource_formats(), scores)
+    return _FORMAT_INDEX
+
+
+class LRUCache(object):
+    '''A cache of up to max_size items, which discards the least recently
+    used item when it is full. Items can also be given a time to live.
+
+    It is thread-safe, but only shared within a process - see SqliteCache.
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()  # key: (value, expiry time or None)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._items.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                return default
+            self._items[key] = (value, expires)  # now the most recently used
+            return value
+
+    def set(self, key, value, ttl=None):
+        ''':param ttl: seconds until the item expires, or None for never'''
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value,
+                                time.time() + ttl if ttl is not None else None)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SqliteCache(object):
+    '''Like LRUCache, but stored in a SQLite file, so it is shared between
+    the processes on a machine. Values must be JSON-serializable.
+
+    Errors using the file are logged and treated as a cache miss, so that a
+    problem with the cache does not stop the caller working.
+    '''
+    def __init__(self, filepath, max_size):
+        self.filepath = filepath
+        self.max_size = max_size
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                         'key TEXT PRIMARY KEY, value TEXT, '
+                         'expires REAL, used REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_used '
+                         'ON cache (used)')
+
+    @contextmanager
+    def _transaction(self):
+        conn = sqlite3.connect(self.filepath, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key, default=None):
+        now = time.time()
+        try:
+            with self._transaction() as conn:
+                row = conn.execute('SELECT value, expires FROM cache '
+                                   'WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return default
+                value, expires = row
+                if expires is not None and expires <= now:
+                    conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+                    return default
+                conn.execute('UPDATE cache SET used = ? WHERE key = ?',
+                             (now, key))
+        except sqlite3.Error, e:
+            log.warning('Error reading cache %s: %s', self.filepath, e)
+            return default
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ''':param ttl: seconds until the item expires, or None for never'''
+        now = time.time()
+        try:
+            with self._transaction() as conn:
+                conn.execute('INSERT OR REPLACE INTO cache '
+                             '(key, value, expires, used) VALUES (?, ?, ?, ?)',
+                             (key, json.dumps(value),
+                              now + ttl if ttl is not None else None, now))
+                conn.execute('DELETE FROM cache WHERE key IN '
+                             '(SELECT key FROM cache ORDER BY used DESC '
+                             'LIMIT -1 OFFSET ?)', (self.max_size,))
+        except sqlite3.Error, e:
+            log.warning('Error writing cache %s: %s', self.filepath, e)
+
+    def clear(self):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM cache')
+
+    def __len__(self):
+        with self._transaction() as conn:
+            return conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+
+# Points on the hash ring for each shard. The more there are, the more evenly
+# the datasets are shared out.
+SHARD_VIRTUAL_NODES = 100
+
+_shard_ring = None
+
+
+class HashRing(object):
+    '''Consistent hashing of keys (dataset ids) to shards.
+
+    Each shard has many points around a ring of hash values, and a key
+    belongs to the shard with the first point after the key's hash. So when
+    a shard is added it takes only the keys just before its points - about
+    1/N of them - and the rest stay where they were.
+    '''
+    def __init__(self, shards, virtual_nodes=SHARD_VIRTUAL_NODES):
+        self.shards = list(shards)
+        points = sorted((self._hash('%s-%i' % (shard, i)), shard)
+                        for shard in self.shards
+                        for i in xrange(virtual_nodes))
+        self._hashes = [hash_ for hash_, shard in points]
+        self._shards = [shard for hash_, shard in points]
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def get(self, key):
+        '''Returns the shard for a key, or None if there are no shards.'''
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(key))
+        return self._shards[index % len(self._hashes)]
+
+
+def shard_ring():
+    '''Returns the HashRing of the shards named in qa.shards, or None if QA
+    work is not sharded.'''
+    global _shard_ring
+    from pylons import config
+    shards = tuple(config.get('qa.shards', '').split())
+    if not shards:
+        return None
+    if _shard_ring is None or _shard_ring.shards != list(shards):
+        _shard_ring = HashRing(shards)
+    return _shard_ring
+
+
+def shard_queue(queue, package_id):
+    '''Returns the queue to put a dataset's QA task in. When QA work is
+    sharded, it is the queue's name followed by the dataset's shard, e.g.
+    "bulk-node2", so that it is done on the node with that shard of the
+    archived files.'''
+    ring = shard_ring()
+    if ring is None:
+        return queue
+    return '%s-%s' % (queue, ring.get(package_id))
+
+
 def create_qa_update_package_task(package, queue):
     from pylons import config
     task_id = '%s-%s' % (package.name, make_uuid()[:4])
     ckan_ini_filepath = os.path.abspath(config.__file__)
+    queue = shard_queue(queue, package.id)
     celery.send_task('qa.update_package', args=[ckan_ini_filepath, package.id],
+                     kwargs={'queued_at': time.time()},
                      task_id=task_id, queue=queue)
     log.debug('QA of package put into celery queue %s: %s',
               queue, package.name)
@@ -90,7 +403,9 @@ def create_qa_update_task(resource, queue):
         package = resource.package
     task_id = '%s/%s/%s' % (package.name, resource.id[:4], make_uuid()[:4])
     ckan_ini_filepath = os.path.abspath(config.__file__)
+    queue = shard_queue(queue, package.id)
     celery.send_task('qa.update', args=[ckan_ini_filepath, resource.id],
+                     kwargs={'queued_at': time.time()},
                      task_id=task_id, queue=queue)
     log.debug('QA of resource put into celery queue %s: %s/%s url=%r',
               queue, package.name, resource.id, resource.url)
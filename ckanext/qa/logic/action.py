@@ -1,12 +1,18 @@
 import logging
 
 import ckan.plugins as p
+from ckan.lib.helpers import date_str_to_datetime
 from ckanext.archiver.model import Archival
-from ckanext.qa.model import QA, aggregate_qa_for_a_dataset
+from ckanext.qa.model import QA, PackageQA, QAHistory, QAChange, \
+    aggregate_qa_for_a_dataset
 
 log = logging.getLogger(__name__)
 _ = p.toolkit._
 
+# Number of changes returned by qa_changes_since, by default and at most
+CHANGES_LIMIT = 100
+CHANGES_MAX_LIMIT = 1000
+
 
 @p.toolkit.side_effect_free
 def qa_resource_show(context, data_dict):
@@ -51,6 +57,119 @@ def qa_package_openness_show(context, data_dict):
     if not dataset:
         raise p.toolkit.ObjectNotFound
 
-    qa_objs = QA.get_for_package(dataset.id)
-    qa_dict = aggregate_qa_for_a_dataset(qa_objs)
-    return qa_dict
+    package_qa = PackageQA.get(dataset.id)
+    if not package_qa:
+        # there may be QA from before PackageQA was populated
+        return aggregate_qa_for_a_dataset(QA.get_for_package(dataset.id))
+    return package_qa.as_dict()
+
+
+@p.toolkit.side_effect_free
+def qa_resource_history(context, data_dict):
+    '''
+    Returns the changes over time to the openness score and format of a
+    resource, oldest first.
+
+    :param id: resource id
+    :param since: only changes at or after this time (ISO format), optional
+    :param until: only changes before this time (ISO format), optional
+    :returns: list of dicts with keys: resource_id, timestamp,
+              openness_score, format
+    '''
+    model = context['model']
+    session = context['session']
+    p.toolkit.check_access('qa_resource_history', context, data_dict)
+
+    res_id = p.toolkit.get_or_bust(data_dict, 'id')
+    res = session.query(model.Resource).get(res_id)
+    if not res:
+        raise p.toolkit.ObjectNotFound
+    since, until = _get_time_range(data_dict)
+    return [history.as_dict() for history in
+            QAHistory.get_for_resource(res.id, since=since, until=until)]
+
+
+@p.toolkit.side_effect_free
+def qa_package_history(context, data_dict):
+    '''
+    Returns the changes over time to the openness score and format of a
+    dataset\'s resources, oldest first.
+
+    :param id: dataset id or name
+    :param since: only changes at or after this time (ISO format), optional
+    :param until: only changes before this time (ISO format), optional
+    :returns: list of dicts with keys: resource_id, timestamp,
+              openness_score, format
+    '''
+    model = context['model']
+    p.toolkit.check_access('qa_package_history', context, data_dict)
+
+    dataset_id = p.toolkit.get_or_bust(data_dict, 'id')
+    dataset = model.Package.get(dataset_id)
+    if not dataset:
+        raise p.toolkit.ObjectNotFound
+    since, until = _get_time_range(data_dict)
+    return [history.as_dict() for history in
+            QAHistory.get_for_package(dataset.id, since=since, until=until)]
+
+
+@p.toolkit.side_effect_free
+def qa_changes_since(context, data_dict):
+    '''
+    Returns the changes to resources\' QA results (score, format or reason),
+    in the order they were made, after a cursor. Start with a cursor of 0,
+    and for the next call use the cursor returned, to get only the changes
+    since. They include the changes to private datasets, so only sysadmins
+    can call it.
+
+    :param cursor: the "cursor" returned by the previous call (default 0)
+    :param limit: maximum number of changes to return (default 100, max 1000)
+    :returns: dict with keys:
+              changes - list of dicts with keys: seq, timestamp,
+                  resource_id, package_id, openness_score, format,
+                  openness_score_reason, previous_openness_score,
+                  previous_format
+              cursor - to pass in the next call
+              more - whether there are more changes after these
+    '''
+    p.toolkit.check_access('qa_changes_since', context, data_dict)
+    errors = {}
+    cursor = _get_int(data_dict, 'cursor', 0, errors)
+    limit = _get_int(data_dict, 'limit', CHANGES_LIMIT, errors)
+    if errors:
+        raise p.toolkit.ValidationError(errors)
+    limit = max(1, min(limit, CHANGES_MAX_LIMIT))
+
+    # get one more than the limit, to know if there are more
+    changes = QAChange.get_since(cursor, limit + 1)
+    more = len(changes) > limit
+    changes = changes[:limit]
+    return {
+        'changes': [change.as_dict() for change in changes],
+        'cursor': changes[-1].seq if changes else cursor,
+        'more': more,
+        }
+
+
+def _get_int(data_dict, key, default, errors):
+    value = data_dict.get(key)
+    if value in (None, ''):
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        errors[key] = [_('Must be an integer')]
+
+
+def _get_time_range(data_dict):
+    times = []
+    for key in ('since', 'until'):
+        value = data_dict.get(key)
+        if value:
+            try:
+                value = date_str_to_datetime(value)
+            except (TypeError, ValueError):
+                raise p.toolkit.ValidationError(
+                    {key: [_('Date format incorrect')]})
+        times.append(value or None)
+    return times
@@ -4,3 +4,18 @@ def qa_resource_show(context, data_dict):
 
 def qa_package_openness_show(context, data_dict):
     return {'success': True}
+
+
+def qa_resource_history(context, data_dict):
+    return {'success': True}
+
+
+def qa_package_history(context, data_dict):
+    return {'success': True}
+
+
+def qa_changes_since(context, data_dict):
+    # the changes are of every dataset, including private ones, so only
+    # sysadmins (who are not asked) can see them
+    return {'success': False,
+            'msg': 'Only sysadmins can see the changes to QA results'}
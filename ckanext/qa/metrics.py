@@ -0,0 +1,573 @@
+'''
+Counts and timings of what QA does, to find out where the time goes.
+
+The file format detectors and scoring functions are instrumented with
+@stage, which records each call's duration, bytes read and verdict (what it
+detected) in the Trace of the resource being scored, if there is one (see
+tracing). The trace is then attached to the QA result, and record_trace
+adds it to the counters and histograms, which are sent to the configured
+sinks:
+
+    qa.metrics.statsd = <host>:<port>
+        sends each count and timing to StatsD, as they happen
+
+    qa.metrics.prometheus_textfile = /var/lib/prometheus/qa-{pid}.prom
+        writes the totals for this process, for Prometheus\'s node exporter
+        textfile collector. {pid} is replaced by the process id, since each
+        worker process has its own totals. It is rewritten at most every
+        qa.metrics.prometheus_textfile_interval seconds (default 15).
+
+    qa.metrics.task_store = /var/lib/ckan/qa-metrics.sqlite
+        stores a record of each task run (see task_run) in a SQLite file,
+        which "paster qa stats" summarises
+
+    qa.metrics.sinks = mypackage.metrics:MySink
+        other sinks (space separated), each a class which is instantiated
+        with the config and has the methods of Sink
+
+The sinks are created from the config when first used in each process, and
+then kept (see configure).
+
+Each QA task is recorded with task_run, which times how long it waited in
+the queue, the spans of its work (e.g. scoring, saving, search indexing) and
+counts things such as resources scored and database queries.
+'''
+import os
+import json
+import math
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from collections import defaultdict
+from functools import wraps
+from contextlib import contextmanager
+
+from pylons import config
+
+log = logging.getLogger(__name__)
+
+METRIC_PREFIX = 'ckanext_qa'
+
+# upper bounds (seconds) of the histogram buckets
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+
+class Trace(object):
+    '''The stages run (e.g. format detectors) while scoring one resource, with
+    the duration, bytes read and verdict of each.'''
+    def __init__(self):
+        self.stages = []
+
+    def record(self, name, seconds, bytes_read=None, verdict=None):
+        stage_ = {'stage': name, 'seconds': round(seconds, 4),
+                  'verdict': verdict}
+        if bytes_read is not None:
+            stage_['bytes_read'] = bytes_read
+        self.stages.append(stage_)
+
+    def as_list(self):
+        return list(self.stages)
+
+
+_local = threading.local()
+
+
+def current_trace():
+    '''Returns the Trace being recorded in this thread, or None.'''
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def tracing():
+    '''Records the stages run in this thread in a new Trace, which is
+    yielded. Traces don't nest - an inner one is not recorded in the outer.'''
+    previous = current_trace()
+    _local.trace = trace = Trace()
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def summarise_verdict(value):
+    '''Returns a short, JSON-serializable description of what a detector or
+    scoring function returned. It is "false" (e.g. None) if it did not
+    detect anything.'''
+    if isinstance(value, dict):
+        return value.get('format')
+    if isinstance(value, tuple) and len(value) == 2:
+        # (score, format) of a score_by_* function
+        score, format_ = value
+        return '%s:%s' % (format_, score) if score is not None else None
+    if isinstance(value, (bool, int, long, basestring)) or value is None:
+        return value
+    return bool(value)
+
+
+def stage(name, reads='buffer'):
+    '''Decorator that records each call of the function as a stage of the
+    current trace (if any).
+
+    :param reads: 'buffer' if the function's first argument is the data it
+                  looks at, so its length is recorded as the bytes read.
+                  Otherwise None.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def recorded(*args, **kwargs):
+            trace = current_trace()
+            if trace is None:
+                return func(*args, **kwargs)
+            start = time.time()
+            result = func(*args, **kwargs)
+            bytes_read = len(args[0]) \
+                if reads == 'buffer' and args and \
+                isinstance(args[0], basestring) else None
+            trace.record(name, time.time() - start, bytes_read,
+                         summarise_verdict(result))
+            return result
+        return recorded
+    return decorator
+
+
+class Registry(object):
+    '''Counters and histograms, totalled in this process. Each is keyed by its
+    name and labels (a dict).'''
+    def __init__(self):
+        self.counters = {}  # (name, labels): value
+        self.histograms = {}  # (name, labels): [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = \
+                    [[0] * len(HISTOGRAM_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def prometheus_text(self):
+        '''Returns the metrics in Prometheus\'s text exposition format.'''
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(buckets), sum_, count))
+                                for key, (buckets, sum_, count)
+                                in self.histograms.items())
+        types_written = set()
+        for (name, labels), value in counters:
+            name = '%s_%s' % (METRIC_PREFIX, name)
+            if name not in types_written:
+                lines.append('# TYPE %s counter' % name)
+                types_written.add(name)
+            lines.append('%s%s %s' % (name, _prometheus_labels(labels),
+                                      value))
+        for (name, labels), (buckets, sum_, count) in histograms:
+            name = '%s_%s' % (METRIC_PREFIX, name)
+            if name not in types_written:
+                lines.append('# TYPE %s histogram' % name)
+                types_written.add(name)
+            for bound, bucket_count in zip(HISTOGRAM_BUCKETS, buckets):
+                lines.append('%s_bucket%s %s' % (
+                    name, _prometheus_labels(labels + (('le', bound),)),
+                    bucket_count))
+            lines.append('%s_bucket%s %s' % (
+                name, _prometheus_labels(labels + (('le', '+Inf'),)), count))
+            lines.append('%s_sum%s %s' % (name, _prometheus_labels(labels),
+                                          sum_))
+            lines.append('%s_count%s %s' % (name, _prometheus_labels(labels),
+                                            count))
+        return '\n'.join(lines) + '\n'
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, unicode(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels)
+
+
+registry = Registry()
+
+
+class Sink(object):
+    '''A destination for metrics. Sinks are told each count and timing, and
+    about each task run, and then flushed, which is after each resource
+    scored and task run.'''
+    def increment(self, name, value, labels):
+        pass
+
+    def observe(self, name, value, labels):
+        pass
+
+    def record_task(self, task_run):
+        ''':param task_run: dict, as returned by TaskRun.as_dict()'''
+        pass
+
+    def flush(self):
+        pass
+
+
+class StatsdSink(Sink):
+    '''Sends counts and timings to a StatsD server over UDP. Labels are added
+    to the name, as StatsD has no labels.'''
+    def __init__(self, address):
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, name, labels, value, type_):
+        name = '.'.join([METRIC_PREFIX, name] +
+                        [unicode(value_).replace('.', '_').replace(':', '_')
+                         for key, value_ in sorted((labels or {}).items())])
+        try:
+            self.socket.sendto(('%s:%s|%s' % (name, value, type_))
+                               .encode('utf8'), self.address)
+        except socket.error, e:
+            log.debug('Could not send metric to StatsD: %s', e)
+
+    def increment(self, name, value, labels):
+        self._send(name, labels, value, 'c')
+
+    def observe(self, name, value, labels):
+        # StatsD timings are in milliseconds
+        self._send(name, labels, int(value * 1000), 'ms')
+
+
+class PrometheusTextfileSink(Sink):
+    '''Writes the registry\'s totals to a file, in Prometheus\'s text format,
+    when it is flushed, if it hasn't written them in the last "interval"
+    seconds.'''
+    def __init__(self, filepath, interval=15):
+        self.filepath = filepath.replace('{pid}', str(os.getpid()))
+        self.interval = interval
+        self.written = None  # time.time() last written
+
+    def flush(self):
+        now = time.time()
+        if self.written is not None and now - self.written < self.interval:
+            return
+        self.written = now
+        # write to a temporary file and rename it, so that the collector
+        # never reads half a file
+        tmp_filepath = '%s.%s.tmp' % (self.filepath, os.getpid())
+        try:
+            with open(tmp_filepath, 'w') as f:
+                f.write(registry.prometheus_text())
+            os.rename(tmp_filepath, self.filepath)
+        except (IOError, OSError), e:
+            log.warning('Could not write metrics file %s: %s',
+                        self.filepath, e)
+
+
+class TaskStoreSink(Sink):
+    '''Stores a record of each task run in a SQLite file, for "paster qa
+    stats". Records older than qa.metrics.task_store_days (default 7) are
+    deleted.'''
+    def __init__(self, filepath, keep_days=7):
+        self.store = TaskStore(filepath)
+        self.keep_days = keep_days
+
+    def record_task(self, task_run):
+        try:
+            self.store.add(task_run)
+            self.store.delete_before(time.time() - self.keep_days * 86400)
+        except sqlite3.Error, e:
+            log.warning('Could not store task metrics in %s: %s',
+                        self.store.filepath, e)
+
+
+class TaskStore(object):
+    '''A SQLite file of task runs.'''
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS task_run ('
+                         'started REAL, task TEXT, run TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS task_run_started '
+                         'ON task_run (started)')
+
+    @contextmanager
+    def _transaction(self):
+        conn = sqlite3.connect(self.filepath, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, task_run):
+        with self._transaction() as conn:
+            conn.execute('INSERT INTO task_run (started, task, run) '
+                         'VALUES (?, ?, ?)',
+                         (task_run['started'], task_run['task'],
+                          json.dumps(task_run)))
+
+    def delete_before(self, timestamp):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM task_run WHERE started < ?',
+                         (timestamp,))
+
+    def get_since(self, timestamp):
+        '''Returns the task runs (dicts) started since the given time.'''
+        with self._transaction() as conn:
+            rows = conn.execute('SELECT run FROM task_run WHERE started >= ? '
+                                'ORDER BY started', (timestamp,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+
+_sinks = None  # (process id, sinks)
+
+
+def _import_class(path):
+    module_name, class_name = path.split(':')
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)
+
+
+def configure():
+    '''Creates the sinks from the config, replacing any created before (e.g.
+    after the config has changed).'''
+    global _sinks
+    sinks_ = []
+    statsd = config.get('qa.metrics.statsd')
+    if statsd:
+        sinks_.append(StatsdSink(statsd))
+    prometheus_textfile = config.get('qa.metrics.prometheus_textfile')
+    if prometheus_textfile:
+        sinks_.append(PrometheusTextfileSink(
+            prometheus_textfile,
+            float(config.get('qa.metrics.prometheus_textfile_interval',
+                             15))))
+    task_store = config.get('qa.metrics.task_store')
+    if task_store:
+        sinks_.append(TaskStoreSink(
+            task_store, int(config.get('qa.metrics.task_store_days') or 7)))
+    for path in (config.get('qa.metrics.sinks') or '').split():
+        sinks_.append(_import_class(path)(config))
+    _sinks = (os.getpid(), sinks_)
+    return sinks_
+
+
+def sinks():
+    '''Returns the sinks configured, creating them the first time they are
+    used in this process (a forked worker makes its own, e.g. for the
+    {pid} of its Prometheus textfile).'''
+    if _sinks is None or _sinks[0] != os.getpid():
+        return configure()
+    return _sinks[1]
+
+
+def increment(name, value=1, **labels):
+    registry.increment(name, value, labels)
+    for sink in sinks():
+        sink.increment(name, value, labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, labels)
+    for sink in sinks():
+        sink.observe(name, value, labels)
+
+
+def flush():
+    for sink in sinks():
+        sink.flush()
+
+
+def record_trace(trace):
+    '''Adds the stages of a trace to the counters and histograms:
+
+    stage_seconds (histogram) - duration of each stage
+    stage_total - number of times each stage ran, by whether it detected
+                  something (outcome="hit") or not (outcome="miss")
+    stage_bytes_read_total - bytes looked at by each stage
+    '''
+    for stage_ in trace.stages:
+        name = stage_['stage']
+        observe('stage_seconds', stage_['seconds'], stage=name)
+        increment('stage_total', stage=name,
+                  outcome='hit' if stage_['verdict'] else 'miss')
+        if stage_.get('bytes_read') is not None:
+            increment('stage_bytes_read_total', stage_['bytes_read'],
+                      stage=name)
+    flush()
+
+
+class TaskRun(object):
+    '''Timings and counts of one run of a QA task.'''
+    def __init__(self, task, queued_at=None):
+        self.task = task
+        self.started = time.time()
+        # time between the task being put on the queue and starting (the
+        # clocks of the machine queuing it and the worker may differ)
+        self.queue_wait = max(self.started - queued_at, 0) \
+            if queued_at else None
+        self.seconds = None
+        self.outcome = None
+        self.spans = defaultdict(float)  # name: seconds
+        self.counts = defaultdict(int)  # name: count
+
+    @contextmanager
+    def span(self, name):
+        '''Adds the time spent in the with block to the named span.'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.spans[name] += time.time() - start
+
+    def increment(self, name, value=1):
+        self.counts[name] += value
+
+    def as_dict(self):
+        return {'task': self.task,
+                'started': self.started,
+                'queue_wait': self.queue_wait,
+                'seconds': self.seconds,
+                'outcome': self.outcome,
+                'spans': dict(self.spans),
+                'counts': dict(self.counts)}
+
+
+def current_task_run():
+    '''Returns the TaskRun being recorded in this thread, or None.'''
+    return getattr(_local, 'task_run', None)
+
+
+@contextmanager
+def task_run(task, queued_at=None):
+    '''Records a run of a task, yielding the TaskRun, for recording spans and
+    counts. When it finishes it is sent to the sinks:
+
+    task_total - number of runs, by task and outcome ("ok" or "error")
+    task_seconds (histogram) - duration of each run
+    task_queue_wait_seconds (histogram) - time waiting in the queue
+    task_span_seconds (histogram) - duration of each span of a run
+    task_<count>_total - each count, e.g. task_resources_scored_total
+
+    Database queries made during it are counted as "db_queries".
+    '''
+    _count_db_queries()
+    run = TaskRun(task, queued_at)
+    previous = current_task_run()
+    _local.task_run = run
+    try:
+        yield run
+        run.outcome = 'ok'
+    except:
+        run.outcome = 'error'
+        raise
+    finally:
+        _local.task_run = previous
+        run.seconds = time.time() - run.started
+        record_task_run(run)
+
+
+def record_task_run(run):
+    increment('task_total', task=run.task, outcome=run.outcome)
+    observe('task_seconds', run.seconds, task=run.task)
+    if run.queue_wait is not None:
+        observe('task_queue_wait_seconds', run.queue_wait, task=run.task)
+    for span, seconds in run.spans.items():
+        observe('task_span_seconds', seconds, task=run.task, span=span)
+    for name, value in run.counts.items():
+        increment('task_%s_total' % name, value, task=run.task)
+    run_dict = run.as_dict()
+    for sink in sinks():
+        sink.record_task(run_dict)
+    flush()
+
+
+_db_query_counter_engine = None
+
+
+def _count_db_queries():
+    '''Counts each query on CKAN\'s database engine in the current
+    TaskRun\'s "db_queries" count.'''
+    global _db_query_counter_engine
+    from ckan import model
+    engine = model.meta.engine
+    if engine is None or engine is _db_query_counter_engine:
+        return
+    from sqlalchemy import event
+
+    def count_query(*args, **kwargs):
+        run = current_task_run()
+        if run:
+            run.counts['db_queries'] += 1
+    event.listen(engine, 'before_cursor_execute', count_query)
+    _db_query_counter_engine = engine
+
+
+def percentile(values, fraction):
+    '''Returns the value at the given fraction (e.g. 0.95) of the sorted
+    values (nearest rank), or None if there are none.'''
+    if not values:
+        return None
+    values = sorted(values)
+    index = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+def summarise_task_runs(runs):
+    '''Summarises task runs (as stored by TaskStoreSink), returning a dict
+    per task of:
+
+        runs, errors: number of runs, and those that raised an exception
+        queue_wait, seconds: {'mean':, 'p50':, 'p95':, 'max':}
+        spans: {span: {'total':, 'mean':, 'p95':, 'share': of the task time}}
+        counts: {count: total}
+    '''
+    def stats(values):
+        values = [value for value in values if value is not None]
+        if not values:
+            return None
+        return {'mean': float(sum(values)) / len(values),
+                'p50': percentile(values, 0.5),
+                'p95': percentile(values, 0.95),
+                'max': max(values)}
+
+    runs_by_task = defaultdict(list)
+    for run in runs:
+        runs_by_task[run['task']].append(run)
+    summary = {}
+    for task, task_runs in runs_by_task.items():
+        total_seconds = sum(run['seconds'] or 0 for run in task_runs)
+        spans = defaultdict(list)
+        counts = defaultdict(int)
+        for run in task_runs:
+            for span, seconds in run['spans'].items():
+                spans[span].append(seconds)
+            for name, value in run['counts'].items():
+                counts[name] += value
+        summary[task] = {
+            'runs': len(task_runs),
+            'errors': len([run for run in task_runs
+                           if run['outcome'] == 'error']),
+            'queue_wait': stats([run['queue_wait'] for run in task_runs]),
+            'seconds': stats([run['seconds'] for run in task_runs]),
+            'spans': dict(
+                (span, {'total': sum(values),
+                        'mean': float(sum(values)) / len(values),
+                        'p95': percentile(values, 0.95),
+                        'share': float(sum(values)) / total_seconds
+                        if total_seconds else None})
+                for span, values in spans.items()),
+            'counts': dict(counts),
+            }
+    return summary
@@ -1,8 +1,11 @@
 import uuid
+import json
+import hashlib
 import datetime
 
-from sqlalchemy import Column
-from sqlalchemy import types
+from sqlalchemy import Column, Index
+from sqlalchemy import types, func, case, text, select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 
 import ckan.model as model
@@ -33,18 +36,20 @@ class QA(Base):
 
     openness_score = Column(types.Integer)
     openness_score_reason = Column(types.UnicodeText)
-    format = Column(types.UnicodeText)
+    format = Column(types.UnicodeText, index=True)
+    # version of the resource format scores table used to score it
+    format_scores_version = Column(types.UnicodeText)
 
     created = Column(types.DateTime, default=datetime.datetime.now)
     updated = Column(types.DateTime, default=datetime.datetime.now)
 
     def __repr__(self):
+        # NB it uses the package_id, rather than looking up the package name,
+        # as a repr is no place for a database query
         summary = 'score=%s format=%s' % (self.openness_score, self.format)
         details = unicode(self.openness_score_reason).encode('unicode_escape')
-        package = model.Package.get(self.package_id)
-        package_name = package.name if package else '?%s?' % self.package_id
         return '<QA %s /dataset/%s/resource/%s %s>' % \
-            (summary, package_name, self.resource_id, details)
+            (summary, self.package_id, self.resource_id, details)
 
     def as_dict(self):
         context = {'model': model}
@@ -86,6 +91,416 @@ class QA(Base):
         return c
 
 
+class FormatScores(Base):
+    """
+    A version of the resource format openness scores table, kept so that
+    results scored with it can be compared with the current table.
+    """
+    __tablename__ = 'qa_format_scores'
+
+    version = Column(types.UnicodeText, primary_key=True)
+    scores = Column(types.UnicodeText)  # JSON dict of format: score
+    created = Column(types.DateTime, default=datetime.datetime.now)
+
+    # versions known to be in the table (per process)
+    _recorded_versions = set()
+
+    @classmethod
+    def record(cls, version, scores):
+        '''Stores this version of the scores, unless it is already stored.
+
+        It is stored straight away, in a transaction of its own, rather than
+        added to the session. When the scores file changes, all the workers
+        try to store the new version at once, and all but one get a
+        duplicate key error. That is ignored here, rather than failing the
+        commit of the QA result that is being saved.
+        '''
+        if version in cls._recorded_versions:
+            return
+        table = cls.__table__
+        try:
+            with model.Session.get_bind().begin() as connection:
+                if not connection.execute(
+                        select([table.c.version])
+                        .where(table.c.version == version)).first():
+                    connection.execute(table.insert(), version=version,
+                                       scores=json.dumps(scores))
+        except IntegrityError:
+            # another process stored it at the same time
+            pass
+        cls._recorded_versions.add(version)
+
+    @classmethod
+    def get_scores(cls, version):
+        '''Returns the scores dict for the given version, or None if it
+        was not stored.'''
+        format_scores = model.Session.query(cls).get(version)
+        if not format_scores:
+            return None
+        return json.loads(format_scores.scores)
+
+
+class PackageQA(Base):
+    """
+    The QA of a dataset, aggregated from the QA of its resources (see
+    aggregate_qa_for_a_dataset). It is updated in the same transaction as the
+    resources' QA (update_package_qa), so that it can be read directly.
+    """
+    __tablename__ = 'qa_package'
+
+    package_id = Column(types.UnicodeText, primary_key=True)
+    openness_score = Column(types.Integer)
+    openness_score_reason = Column(types.UnicodeText)
+    updated = Column(types.DateTime)
+
+    @classmethod
+    def get(cls, package_id):
+        return model.Session.query(cls).get(package_id)
+
+    def as_dict(self):
+        return {
+            'openness_score': self.openness_score,
+            'openness_score_reason': self.openness_score_reason,
+            'updated': self.updated.isoformat() if self.updated else None,
+            }
+
+
+class QAHistory(Base):
+    """
+    The history of resources' openness scores and formats. Rather than a
+    copy of every result, a row is only added when a resource's score or
+    format changes (record_qa_change), giving its value from that time.
+    """
+    __tablename__ = 'qa_history'
+    __table_args__ = (
+        Index('idx_qa_history_resource_timestamp', 'resource_id',
+              'timestamp'),
+        Index('idx_qa_history_package_timestamp', 'package_id', 'timestamp'),
+        )
+
+    id = Column(types.Integer, primary_key=True)
+    resource_id = Column(types.UnicodeText, nullable=False)
+    package_id = Column(types.UnicodeText, nullable=False)
+    timestamp = Column(types.DateTime, nullable=False, index=True)
+    openness_score = Column(types.Integer)
+    format = Column(types.UnicodeText)
+
+    def as_dict(self):
+        return {
+            'resource_id': self.resource_id,
+            'timestamp': self.timestamp.isoformat(),
+            'openness_score': self.openness_score,
+            'format': self.format,
+            }
+
+    @classmethod
+    def get_for_resource(cls, resource_id, since=None, until=None):
+        '''Returns the changes to a resource\'s QA, oldest first, optionally
+        only those from the datetime "since" and before "until".'''
+        q = model.Session.query(cls).filter(cls.resource_id == resource_id)
+        return cls._filter_time(q, since, until).all()
+
+    @classmethod
+    def get_for_package(cls, package_id, since=None, until=None):
+        '''Returns the changes to the QA of a dataset\'s resources, oldest
+        first, optionally only those from the datetime "since" and before
+        "until".'''
+        q = model.Session.query(cls).filter(cls.package_id == package_id)
+        return cls._filter_time(q, since, until).all()
+
+    @classmethod
+    def _filter_time(cls, q, since, until):
+        if since:
+            q = q.filter(cls.timestamp >= since)
+        if until:
+            q = q.filter(cls.timestamp < until)
+        return q.order_by(cls.timestamp, cls.id)
+
+
+class QAChange(Base):
+    """
+    An event for a change to a resource's QA result - its score, format or
+    reason - for other systems to pick up (with the qa_changes_since action),
+    rather than polling the results of every dataset. The seq increases with
+    each change, so is a cursor for reading the changes since the last read.
+    """
+    __tablename__ = 'qa_change'
+
+    seq = Column(types.Integer, primary_key=True)
+    timestamp = Column(types.DateTime, nullable=False)
+    resource_id = Column(types.UnicodeText, nullable=False)
+    package_id = Column(types.UnicodeText, nullable=False)
+    openness_score = Column(types.Integer)
+    format = Column(types.UnicodeText)
+    openness_score_reason = Column(types.UnicodeText)
+    # None if the resource had no QA result before
+    previous_openness_score = Column(types.Integer)
+    previous_format = Column(types.UnicodeText)
+
+    def as_dict(self):
+        return {
+            'seq': self.seq,
+            'timestamp': self.timestamp.isoformat(),
+            'resource_id': self.resource_id,
+            'package_id': self.package_id,
+            'openness_score': self.openness_score,
+            'format': self.format,
+            'openness_score_reason': self.openness_score_reason,
+            'previous_openness_score': self.previous_openness_score,
+            'previous_format': self.previous_format,
+            }
+
+    @classmethod
+    def get_since(cls, seq, limit):
+        '''Returns up to "limit" changes after the given seq, in order.'''
+        return model.Session.query(cls) \
+            .filter(cls.seq > seq) \
+            .order_by(cls.seq) \
+            .limit(limit) \
+            .all()
+
+
+class PendingTask(Base):
+    """
+    A dataset whose QA task was held back, rather than queued, because its
+    queue was too long (see dispatch.py). They are queued later, oldest
+    first, as the queue goes down. A dataset has one row, however many times
+    it is archived meanwhile.
+    """
+    __tablename__ = 'qa_pending'
+
+    package_id = Column(types.UnicodeText, primary_key=True)
+    queue = Column(types.UnicodeText, nullable=False)
+    created = Column(types.DateTime, nullable=False,
+                     default=datetime.datetime.now, index=True)
+
+    @classmethod
+    def add(cls, package_id, queue):
+        '''Records a dataset as pending, unless it already is. If it is
+        pending for the bulk queue and now asks for priority, it moves to the
+        priority queue.
+
+        Like remove, it is written straight away, in a transaction of its
+        own, rather than added to the session, because it is called from the
+        archiver's notification, whose session has work of its own.
+        '''
+        table = cls.__table__
+        try:
+            with model.Session.get_bind().begin() as connection:
+                row = connection.execute(
+                    select([table.c.queue])
+                    .where(table.c.package_id == package_id)).first()
+                if row is None:
+                    connection.execute(table.insert(), package_id=package_id,
+                                       queue=queue)
+                elif queue == 'priority' and row[0] != queue:
+                    connection.execute(
+                        table.update()
+                        .where(table.c.package_id == package_id)
+                        .values(queue=queue))
+        except IntegrityError:
+            # another process made it pending at the same time
+            pass
+
+    @classmethod
+    def remove(cls, package_id):
+        '''Removes a dataset from pending, if it is, e.g. because it has been
+        queued.'''
+        table = cls.__table__
+        with model.Session.get_bind().begin() as connection:
+            connection.execute(
+                table.delete().where(table.c.package_id == package_id))
+
+    @classmethod
+    def get_next(cls, limit):
+        '''Returns the next datasets to queue: priority ones first, then
+        oldest first.'''
+        return model.Session.query(cls) \
+            .order_by(case([(cls.queue == u'priority', 0)], else_=1),
+                      cls.created, cls.package_id) \
+            .limit(limit) \
+            .all()
+
+    @classmethod
+    def count(cls):
+        return model.Session.query(cls).count()
+
+    @classmethod
+    def any(cls):
+        return model.Session.query(cls.package_id).first() is not None
+
+
+class Watermark(Base):
+    """
+    How far "paster qa daemon" has got through a stream of changes (e.g.
+    archivals, in order of time), so that after a restart it carries on from
+    there. It is saved in the same transaction as the results of the changes
+    up to it.
+    """
+    __tablename__ = 'qa_watermark'
+
+    stream = Column(types.UnicodeText, primary_key=True)
+    timestamp = Column(types.DateTime, nullable=False)
+    # the id of the last change at that timestamp
+    key = Column(types.UnicodeText, nullable=False)
+
+    @classmethod
+    def get(cls, stream):
+        return model.Session.query(cls).get(stream)
+
+    @classmethod
+    def set(cls, stream, timestamp, key):
+        '''Moves the watermark of a stream, in the session.'''
+        watermark = cls.get(stream)
+        if watermark is None:
+            watermark = cls(stream=stream)
+            model.Session.add(watermark)
+        watermark.timestamp = timestamp
+        watermark.key = key
+        return watermark
+
+
+# The fields of a QA result whose changes are recorded
+QA_CHANGE_FIELDS = ('openness_score', 'format', 'openness_score_reason')
+
+
+def qa_change_rows(resource_id, package_id, timestamp, before, after):
+    '''Returns the rows to add to the QAHistory and QAChange tables, as
+    dicts, for a QA result that has been saved. Either is None if the result
+    has not changed in a way that it records.
+
+    :param before: dict of the QA_CHANGE_FIELDS of the result before it was
+                   saved, or None if it is new
+    :param after: dict of the QA_CHANGE_FIELDS of the result saved
+    '''
+    before = before or {}
+    history = change = None
+    if any(before.get(field) != after[field]
+           for field in ('openness_score', 'format')) or not before:
+        history = dict(resource_id=resource_id, package_id=package_id,
+                       timestamp=timestamp,
+                       openness_score=after['openness_score'],
+                       format=after['format'])
+    if any(before.get(field) != after[field]
+           for field in QA_CHANGE_FIELDS) or not before:
+        change = dict(resource_id=resource_id, package_id=package_id,
+                      timestamp=timestamp,
+                      previous_openness_score=before.get('openness_score'),
+                      previous_format=before.get('format'),
+                      **after)
+    return history, change
+
+
+def qa_change_fields(qa):
+    '''Returns a dict of the QA_CHANGE_FIELDS of a QA result.'''
+    return dict((field, getattr(qa, field)) for field in QA_CHANGE_FIELDS)
+
+
+def record_qa_change(qa, before):
+    '''Records a QA result that has been saved in the QAHistory, if its score
+    or format has changed, and as a QAChange, if its reason has changed too.
+
+    :param before: qa_change_fields() of the QA before it was changed, or
+                   None if it is new
+    :returns: whether it had changed
+    '''
+    history, change = qa_change_rows(
+        qa.resource_id, qa.package_id,
+        qa.updated or datetime.datetime.now(), before, qa_change_fields(qa))
+    if history:
+        model.Session.add(QAHistory(**history))
+    if change:
+        lock_qa_changes()
+        model.Session.add(QAChange(**change))
+    return bool(change)
+
+
+# Id of the Postgres advisory lock taken by lock_qa_changes
+QA_CHANGE_LOCK_ID = 7161636867
+
+
+def lock_qa_changes():
+    '''Waits until no other transaction is adding QAChanges, and stops others
+    adding them until this transaction ends. Call it before adding them, and
+    before looking for the QA row of a resource in order to save its result,
+    so that two transactions don't both add a row for it.
+
+    A change's seq is given when it is inserted, not when it is committed.
+    So without this, a change could be committed after one with a higher
+    seq, which a reader may already have got past (see qa_changes_since),
+    and it would never be read. Taking turns, each transaction's seqs are
+    given after the previous one has committed.
+
+    Only Postgres needs it - SQLite only has one writer at a time anyway.
+    '''
+    if model.Session.get_bind().dialect.name != 'postgresql':
+        return
+    model.Session.execute(text('SELECT pg_advisory_xact_lock(:lock_id)'),
+                          {'lock_id': QA_CHANGE_LOCK_ID})
+
+
+def populate_qa_history():
+    '''Starts the history with the current QA results, if it is empty e.g.
+    after upgrading to a version of ckanext-qa that records it.
+
+    Returns the number of results added.
+    '''
+    if model.Session.query(QAHistory).first():
+        return 0
+    select = model.Session.query(
+        QA.resource_id, QA.package_id,
+        func.coalesce(QA.updated, QA.created, func.now()),
+        QA.openness_score, QA.format)
+    result = model.Session.execute(
+        QAHistory.__table__.insert().from_select(
+            ['resource_id', 'package_id', 'timestamp', 'openness_score',
+             'format'],
+            select.statement))
+    model.Session.commit()
+    return result.rowcount
+
+
+def update_package_qa(package_id):
+    '''Updates the PackageQA for a dataset from the QA of its (active)
+    resources, or deletes it if there is none. The change is made in the
+    session, to be committed with the change to the resources' QA.
+
+    Returns the PackageQA, or None.
+    '''
+    # the session does not autoflush, and the resources' QA may have changed
+    model.Session.flush()
+    qa_objs = QA.get_for_package(package_id)
+    package_qa = PackageQA.get(package_id)
+    if not qa_objs:
+        if package_qa:
+            model.Session.delete(package_qa)
+        return None
+    if not package_qa:
+        package_qa = PackageQA(package_id=package_id)
+        model.Session.add(package_qa)
+    for key, value in _aggregate_qa(qa_objs).items():
+        setattr(package_qa, key, value)
+    return package_qa
+
+
+def populate_package_qa():
+    '''Fills in the PackageQA of datasets with QA, if none is stored yet,
+    e.g. after upgrading to a version of ckanext-qa with that table.
+
+    Returns the number of datasets updated.
+    '''
+    if model.Session.query(PackageQA).first():
+        return 0
+    package_ids = [row[0] for row in
+                   model.Session.query(QA.package_id).distinct()]
+    for i, package_id in enumerate(package_ids):
+        update_package_qa(package_id)
+        if i % 1000 == 999:
+            model.Session.commit()
+    model.Session.commit()
+    return len(package_ids)
+
+
 def aggregate_qa_for_a_dataset(qa_objs):
     '''Returns aggregated archival info for a dataset, given the archivals for
     its resources (returned by get_for_package).
@@ -97,6 +512,13 @@ def aggregate_qa_for_a_dataset(qa_objs):
                 openness_score_reason
                 updated
     '''
+    qa_dict = _aggregate_qa(qa_objs)
+    if qa_dict['updated']:
+        qa_dict['updated'] = qa_dict['updated'].isoformat()
+    return qa_dict
+
+
+def _aggregate_qa(qa_objs):
     qa_dict = {'openness_score': None, 'openness_score_reason': None,
                'updated': None}
     for qa in qa_objs:
@@ -110,11 +532,76 @@ def aggregate_qa_for_a_dataset(qa_objs):
         if qa_dict['updated'] is None or \
                 qa.updated > qa_dict['updated']:
             qa_dict['updated'] = qa.updated
-    if qa_dict['updated']:
-        qa_dict['updated'] = qa_dict['updated'].isoformat()
     return qa_dict
 
 
+def get_archived_resources_by_url(urls, archived_since):
+    '''Returns the Archival and QA (or None) of active resources whose url
+    is exactly one of the given urls, and which archiver successfully
+    downloaded since the given datetime.
+
+    Returns a dict of url: (archival, qa). Where resources share a url, the
+    most recently archived one is returned.
+    '''
+    from ckanext.archiver.model import Archival
+    if not urls:
+        return {}
+    urls = list(set(urls))
+    # the md5 condition uses the index created by create_resource_url_index
+    url_hashes = [hashlib.md5(url.encode('utf8')).hexdigest()
+                  for url in urls]
+    q = model.Session.query(model.Resource.url, Archival, QA) \
+        .join(Archival, Archival.resource_id == model.Resource.id) \
+        .outerjoin(QA, QA.resource_id == model.Resource.id) \
+        .filter(func.md5(model.Resource.url).in_(url_hashes)) \
+        .filter(model.Resource.url.in_(urls)) \
+        .filter(model.Resource.state == 'active') \
+        .filter(Archival.is_broken == False) \
+        .filter(Archival.updated >= archived_since) \
+        .order_by(Archival.updated)
+    # later (more recent) archivals overwrite earlier ones
+    return dict((url, (archival, qa)) for url, archival, qa in q)
+
+
 def init_tables(engine):
     Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    create_resource_url_index(engine)
     log.info('QA database tables are set-up')
+
+
+def create_resource_url_index(engine):
+    '''Creates an index on the md5 of the resource url, for finding
+    resources by url (get_archived_resources_by_url). The md5 is indexed,
+    rather than the url, as a url can be too long for a btree index.'''
+    if engine.dialect.name != 'postgresql':
+        return
+    index_name = 'idx_qa_resource_url_md5'
+    if engine.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s',
+                      index_name).first():
+        return
+    engine.execute('CREATE INDEX %s ON resource (md5(url))' % index_name)
+    log.info('Added index %s', index_name)
+
+
+def add_missing_columns(engine):
+    '''Adds columns and indexes that are in the model but not yet in the
+    database, since create_all only creates whole tables.'''
+    from sqlalchemy.engine.reflection import Inspector
+    inspector = Inspector.from_engine(engine)
+    for table in Base.metadata.sorted_tables:
+        existing_columns = set(column['name'] for column
+                               in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                table.name, column.name,
+                column.type.compile(dialect=engine.dialect)))
+            log.info('Added column %s.%s', table.name, column.name)
+        existing_indexes = set(index['name'] for index
+                               in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(engine)
+                log.info('Added index %s', index.name)
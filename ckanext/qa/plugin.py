@@ -6,9 +6,10 @@ import ckan.plugins as p
 
 from ckanext.archiver.interfaces import IPipe
 from ckanext.qa.logic import action, auth
-from ckanext.qa.model import QA, aggregate_qa_for_a_dataset
+from ckanext.qa.model import QA, PackageQA, update_package_qa, \
+    aggregate_qa_for_a_dataset
 from ckanext.qa import helpers
-from ckanext.qa import lib
+from ckanext.qa import dispatch
 from ckanext.report.interfaces import IReport
 
 
@@ -53,7 +54,8 @@ class QAPlugin(p.SingletonPlugin, p.toolkit.DefaultDatasetForm):
         dataset = model.Package.get(dataset_id)
         assert dataset
 
-        lib.create_qa_update_package_task(dataset, queue=queue)
+        # if the queue is long, it is held back rather than queued
+        dispatch.dispatch_package_task(dataset, queue=queue)
 
     # IReport
 
@@ -68,6 +70,9 @@ class QAPlugin(p.SingletonPlugin, p.toolkit.DefaultDatasetForm):
         return {
             'qa_resource_show': action.qa_resource_show,
             'qa_package_openness_show': action.qa_package_openness_show,
+            'qa_resource_history': action.qa_resource_history,
+            'qa_package_history': action.qa_package_history,
+            'qa_changes_since': action.qa_changes_since,
             }
 
     # IAuthFunctions
@@ -76,6 +81,9 @@ class QAPlugin(p.SingletonPlugin, p.toolkit.DefaultDatasetForm):
         return {
             'qa_resource_show': auth.qa_resource_show,
             'qa_package_openness_show': auth.qa_package_openness_show,
+            'qa_resource_history': auth.qa_resource_history,
+            'qa_package_history': auth.qa_package_history,
+            'qa_changes_since': auth.qa_changes_since,
             }
 
     # ITemplateHelpers
@@ -100,9 +108,9 @@ class QAPlugin(p.SingletonPlugin, p.toolkit.DefaultDatasetForm):
         qa_objs = QA.get_for_package(pkg_dict['id'])
         if not qa_objs:
             return
-        # dataset
-        dataset_qa = aggregate_qa_for_a_dataset(qa_objs)
-        pkg_dict['qa'] = dataset_qa
+        # dataset - aggregated from the resources' QA, which are needed
+        # anyway, rather than reading the PackageQA too
+        pkg_dict['qa'] = aggregate_qa_for_a_dataset(qa_objs)
         # resources
         qa_by_res_id = dict((a.resource_id, a) for a in qa_objs)
         for res in pkg_dict['resources']:
@@ -113,3 +121,20 @@ class QAPlugin(p.SingletonPlugin, p.toolkit.DefaultDatasetForm):
                 del qa_dict['package_id']
                 del qa_dict['resource_id']
                 res['qa'] = qa_dict
+
+    def after_update(self, context, pkg_dict):
+        # Resources may have been deleted, so update the dataset's aggregated
+        # QA, in the same transaction
+        update_package_qa(_package_id(context, pkg_dict))
+
+    def after_delete(self, context, pkg_dict):
+        package_qa = PackageQA.get(_package_id(context, pkg_dict))
+        if package_qa:
+            model.Session.delete(package_qa)
+
+
+def _package_id(context, pkg_dict):
+    '''Returns the id of the dataset being updated or deleted - pkg_dict may
+    give its name instead.'''
+    package = context.get('package') or model.Package.get(pkg_dict['id'])
+    return package.id
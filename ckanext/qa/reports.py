@@ -1,5 +1,6 @@
 from collections import Counter
 import copy
+import datetime
 try:
     from collections import OrderedDict  # from python 2.7
 except ImportError:
@@ -9,6 +10,7 @@ from ckan.common import _
 import ckan.model as model
 import ckan.plugins as p
 from ckanext.report import lib
+from ckanext.qa.model import PackageQA, QAHistory
 
 import logging
 
@@ -25,27 +27,21 @@ def openness_report(organization, include_sub_organizations=False):
 def openness_index(include_sub_organizations=False):
     '''Returns the counts of 5 stars of openness for all organizations.'''
 
-    context = {'model': model, 'session': model.Session, 'ignore_auth': True}
     total_score_counts = Counter()
     counts = {}
     # Get all the scores and build up the results by org
     for org in add_progress_bar(model.Session.query(model.Group)
             .filter(model.Group.type == 'organization')
             .filter(model.Group.state == 'active').all()):
-        scores = []
         # NB org.packages() misses out many - see:
         # http://redmine.dguteam.org.uk/issues/1844
-        pkgs = model.Session.query(model.Package) \
-                    .filter_by(owner_org=org.id) \
-                    .filter_by(state='active') \
-                    .all()
-        for pkg in pkgs:
-            try:
-                qa = p.toolkit.get_action('qa_package_openness_show')(context, {'id': pkg.id})
-            except p.toolkit.ObjectNotFound:
-                log.warning('No QA info for package %s', pkg.name)
-                return
-            scores.append(qa['openness_score'])
+        scores = [row[0] for row in
+                  model.Session.query(PackageQA.openness_score)
+                  .select_from(model.Package)
+                  .outerjoin(PackageQA,
+                             PackageQA.package_id == model.Package.id)
+                  .filter(model.Package.owner_org == org.id)
+                  .filter(model.Package.state == 'active')]
         score_counts = Counter(scores)
         total_score_counts += score_counts
         counts[org.name] = {
@@ -108,24 +104,22 @@ def openness_for_organization(organization=None, include_sub_organizations=False
     else:
         orgs = lib.go_down_tree(org)
 
-    context = {'model': model, 'session': model.Session, 'ignore_auth': True}
     score_counts = Counter()
     rows = []
     num_packages = 0
     for org in orgs:
         # NB org.packages() misses out many - see:
         # http://redmine.dguteam.org.uk/issues/1844
-        pkgs = model.Session.query(model.Package) \
-                    .filter_by(owner_org=org.id) \
-                    .filter_by(state='active') \
+        pkgs = model.Session.query(model.Package, PackageQA) \
+                    .outerjoin(PackageQA,
+                               PackageQA.package_id == model.Package.id) \
+                    .filter(model.Package.owner_org == org.id) \
+                    .filter(model.Package.state == 'active') \
                     .all()
         num_packages += len(pkgs)
-        for pkg in pkgs:
-            try:
-                qa = p.toolkit.get_action('qa_package_openness_show')(context, {'id': pkg.id})
-            except p.toolkit.ObjectNotFound:
-                log.warning('No QA info for package %s', pkg.name)
-                return
+        for pkg, package_qa in pkgs:
+            qa = package_qa.as_dict() if package_qa else \
+                {'openness_score': None, 'openness_score_reason': None}
             rows.append(OrderedDict((
                 ('dataset_name', pkg.name),
                 ('dataset_title', pkg.title),
@@ -149,9 +143,66 @@ def openness_for_organization(organization=None, include_sub_organizations=False
             'average_stars': average_stars,
             'num_packages_scored': len(rows),
             'num_packages': num_packages,
+            'score_counts_by_month': openness_by_month(orgs),
             }
 
 
+def openness_by_month(orgs, months=12, today=None):
+    '''Returns the counts of 5 stars of openness of the organizations\'
+    datasets at the end of each of the last few months (including this one,
+    so far), from the QA history. A dataset\'s score is the highest of its
+    resources\', as for the current scores.
+
+    :returns: list of dicts with keys: month (e.g. "2016-01"), score_counts
+    '''
+    today = today or datetime.date.today()
+    this_month = datetime.datetime(today.year, today.month, 1)
+    # the end of each month is the start of the next
+    month_ends = [_add_months(this_month, i)
+                  for i in range(2 - months, 2)]
+    history = model.Session.query(
+        QAHistory.package_id, QAHistory.resource_id, QAHistory.timestamp,
+        QAHistory.openness_score) \
+        .join(model.Package, model.Package.id == QAHistory.package_id) \
+        .filter(model.Package.owner_org.in_([org.id for org in orgs])) \
+        .filter(model.Package.state == 'active') \
+        .filter(QAHistory.timestamp < month_ends[-1]) \
+        .order_by(QAHistory.timestamp)
+    return score_counts_by_month(history, month_ends)
+
+
+def score_counts_by_month(history, month_ends):
+    '''Given the QA history (package_id, resource_id, timestamp, score) in
+    time order, returns the counts of dataset scores at each month end.'''
+    # the latest score of each resource, by dataset
+    scores = {}  # {package_id: {resource_id: score}}
+    results = []
+    month_ends = iter(month_ends)
+    month_end = next(month_ends)
+    for package_id, resource_id, timestamp, score in history:
+        while timestamp >= month_end:
+            results.append(_month_score_counts(month_end, scores))
+            month_end = next(month_ends)
+        scores.setdefault(package_id, {})[resource_id] = score
+    results.append(_month_score_counts(month_end, scores))
+    for month_end in month_ends:
+        results.append(_month_score_counts(month_end, scores))
+    return results
+
+
+def _month_score_counts(month_end, scores):
+    score_counts = Counter(max(resource_scores.values())
+                           for resource_scores in scores.values())
+    month = _add_months(month_end, -1)
+    return {'month': month.strftime('%Y-%m'),
+            'score_counts': jsonify_counter(score_counts)}
+
+
+def _add_months(date, months):
+    month_index = date.year * 12 + date.month - 1 + months
+    return date.replace(year=month_index // 12, month=month_index % 12 + 1)
+
+
 def openness_report_combinations():
     for organization in lib.all_organizations(include_none=True):
         for include_sub_organizations in (False, True):
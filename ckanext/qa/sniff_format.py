@@ -1,19 +1,30 @@
 import re
+import mmap
 import zipfile
+import tarfile
+import tempfile
+import struct
+import zlib
 import os
+import time
 from collections import defaultdict
+from contextlib import contextmanager
 import subprocess
 import StringIO
 
 import xlrd
 import magic
 import messytables
+from pylons import config
+
+from ckan.plugins import toolkit
 
 from ckanext.qa import lib
-from ckan.lib import helpers as ckan_helpers
+from ckanext.qa import metrics
 
 
-def sniff_file_format(filepath, log):
+@metrics.stage('sniff', reads=None)
+def sniff_file_format(filepath, log, archive_depth=0):
     '''For a given filepath, work out what file format it is.
 
     Returns a dict with format as a string, which is the format's canonical
@@ -27,20 +38,28 @@ def sniff_file_format(filepath, log):
 
     Note, log is a logger, either a Celery one or a standard Python logging
     one.
+
+    archive_depth is how many archives deep this file was found - it is set
+    when sniffing a file that was extracted from an archive.
     '''
     format_ = None
-    log.info('Sniffing file format of: %s', filepath)
+    log.debug('Sniffing file format of: %s', filepath)
     filepath_utf8 = filepath.encode('utf8') if isinstance(filepath, unicode) \
         else filepath
-    mime_type = magic.from_file(filepath_utf8, mime=True)
-    log.info('Magic detects file as: %s', mime_type)
+    mime_type = get_magic_mime_type(filepath_utf8)
+    log.debug('Magic detects file as: %s', mime_type)
     if mime_type:
         if mime_type == 'application/xml':
             with open(filepath) as f:
                 buf = f.read(5000)
             format_ = get_xml_variant_including_xml_declaration(buf, log)
         elif mime_type == 'application/zip':
-            format_ = get_zipped_format(filepath, log)
+            format_ = get_zipped_format(filepath, log, archive_depth)
+        elif mime_type == 'application/x-tar':
+            format_ = get_tarred_format(filepath, log, archive_depth)
+        elif mime_type in COMPRESSED_CONTAINERS:
+            format_ = get_compressed_format(filepath, mime_type, log,
+                                            archive_depth)
         elif mime_type in ('application/msword', 'application/vnd.ms-office'):
             # In the past Magic gives the msword mime-type for Word and other
             # MS Office files too, so use BSD File to be sure which it is.
@@ -68,9 +87,9 @@ def sniff_file_format(filepath, log):
         if format_:
             return format_
 
-        format_tuple = ckan_helpers.resource_formats().get(mime_type)
-        if format_tuple:
-            format_ = {'format': format_tuple[1]}
+        resource_format = lib.format_index().get(mime_type)
+        if resource_format:
+            format_ = {'format': resource_format.name}
 
         if not format_:
             if mime_type.startswith('text/'):
@@ -90,7 +109,7 @@ def sniff_file_format(filepath, log):
                         mime_type)
 
         if format_:
-            log.info('Mimetype translates to filetype: %s',
+            log.debug('Mimetype translates to filetype: %s',
                      format_['format'])
 
             if format_['format'] == 'TXT':
@@ -107,14 +126,12 @@ def sniff_file_format(filepath, log):
                 # XML files without the "<?xml ... ?>" tag end up here
                 elif is_xml_but_without_declaration(buf, log):
                     format_ = get_xml_variant_without_xml_declaration(buf, log)
-                elif is_ttl(buf, log):
+                elif is_ttl(buf, log) or file_has_ttl_prefix(filepath, log):
                     format_ = {'format': 'TTL'}
 
             elif format_['format'] == 'HTML':
                 # maybe it has RDFa in it
-                with open(filepath) as f:
-                    buf = f.read(100000)
-                if has_rdfa(buf, log):
+                if file_has_rdfa(filepath, log):
                     format_ = {'format': 'RDFa'}
 
     else:
@@ -130,6 +147,7 @@ def sniff_file_format(filepath, log):
         log.warning('Could not detect format of file: %s', filepath)
     return format_
 
+@metrics.stage('sniff.is_json')
 def is_json(buf, log):
     '''Returns whether this text buffer (potentially truncated) is in
     JSON format.'''
@@ -176,30 +194,32 @@ def is_json(buf, log):
                         state = state_stack.pop()
                     except IndexError:
                         # nothing to pop
-                        log.info('Not JSON - %i matches', number_of_matches)
+                        log.debug('Not JSON - %i matches', number_of_matches)
                         return False
                 break
         else:
             # no match
-            log.info('Not JSON - %i matches', number_of_matches)
+            log.debug('Not JSON - %i matches', number_of_matches)
             return False
         match_length = matcher.match(part_of_buf).end()
         #print "MATCHED %r %r %s" % (matcher.match(part_of_buf).string[:match_length], matcher.pattern, state_stack)
         pos += match_length
         number_of_matches += 1
         if number_of_matches > 5:
-            log.info('JSON detected: %i matches', number_of_matches)
+            log.debug('JSON detected: %i matches', number_of_matches)
             return True
 
-    log.info('JSON detected: %i matches', number_of_matches)
+    log.debug('JSON detected: %i matches', number_of_matches)
     return True
 
+@metrics.stage('sniff.is_csv')
 def is_csv(buf, log):
     '''If the buffer is a CSV file then return True.'''
     buf_rows = StringIO.StringIO(buf)
     table_set = messytables.CSVTableSet(buf_rows)
     return _is_spreadsheet(table_set, 'CSV', log)
 
+@metrics.stage('sniff.is_psv')
 def is_psv(buf, log):
     '''If the buffer is a PSV file then return True.'''
     buf_rows = StringIO.StringIO(buf)
@@ -225,7 +245,7 @@ def _is_spreadsheet(table_set, format, log):
                     cells_per_row = get_cells_per_row(num_cells, num_rows)
                     # over the long term, 2 columns is the minimum
                     if cells_per_row > 1.9:
-                        log.info('Is %s because %.1f cells per row (%i cells, %i rows)', \
+                        log.debug('Is %s because %.1f cells per row (%i cells, %i rows)', \
                                  format,
                                  get_cells_per_row(num_cells, num_rows),
                                  num_cells, num_rows)
@@ -236,34 +256,37 @@ def _is_spreadsheet(table_set, format, log):
     if num_cells > 3 or num_rows > 1:
         cells_per_row = get_cells_per_row(num_cells, num_rows)
         if cells_per_row > 1.5:
-            log.info('Is %s because %.1f cells per row (%i cells, %i rows)', \
+            log.debug('Is %s because %.1f cells per row (%i cells, %i rows)', \
                      format,
                      get_cells_per_row(num_cells, num_rows),
                      num_cells, num_rows)
             return True
-    log.info('Not %s - not enough valid cells per row '
+    log.debug('Not %s - not enough valid cells per row '
              '(%i cells, %i rows, %.1f cells per row)', \
              format, num_cells, num_rows, get_cells_per_row(num_cells, num_rows))
     return False
 
+@metrics.stage('sniff.is_html')
 def is_html(buf, log):
     '''If this buffer is HTML, return that format type, else None.'''
     xml_re = '.{0,3}\s*(<\?xml[^>]*>\s*)?(<!doctype[^>]*>\s*)?<html[^>]*>'
     match = re.match(xml_re, buf, re.IGNORECASE)
     if match:
-        log.info('HTML tag detected')
+        log.debug('HTML tag detected')
         return {'format': 'HTML'}
     log.debug('Not HTML')
 
+@metrics.stage('sniff.is_iati')
 def is_iati(buf, log):
     '''If this buffer is IATI format, return that format type, else None.'''
     xml_re = '.{0,3}\s*(<\?xml[^>]*>\s*)?(<!doctype[^>]*>\s*)?<iati-(activities|organisations)[^>]*>'
     match = re.match(xml_re, buf, re.IGNORECASE)
     if match:
-        log.info('IATI tag detected')
+        log.debug('IATI tag detected')
         return {'format': 'IATI'}
     log.debug('Not IATI')
 
+@metrics.stage('sniff.is_xml_but_without_declaration')
 def is_xml_but_without_declaration(buf, log):
     '''Decides if this is a buffer of XML, but missing the usual <?xml ...?>
     tag.'''
@@ -277,17 +300,19 @@ def is_xml_but_without_declaration(buf, log):
             log.debug('Not XML (without declaration) - unlikely length first tag: <%s %s>',
                         top_level_tag_name, top_level_tag_attributes)
             return False
-        log.info('XML detected - first tag name: <%s>', top_level_tag_name)
+        log.debug('XML detected - first tag name: <%s>', top_level_tag_name)
         return True
     log.debug('Not XML (without declaration) - tag not detected')
     return False
 
+@metrics.stage('sniff.get_xml_variant_including_xml_declaration')
 def get_xml_variant_including_xml_declaration(buf, log):
     '''If this buffer is in a format based on XML and has the <xml>
     declaration, return the format type.'''
     return get_xml_variant_without_xml_declaration(buf, log)
     log.debug('XML declaration not found: %s', buf)
 
+@metrics.stage('sniff.get_xml_variant_without_xml_declaration')
 def get_xml_variant_without_xml_declaration(buf, log):
     '''If this buffer is in a format based on XML, without any XML declaration
     or other boilerplate, return the format type.'''
@@ -307,10 +332,10 @@ def get_xml_variant_without_xml_declaration(buf, log):
     except GotFirstTag, e:
         top_level_tag_name = str(e).lower()
     except xml.sax.SAXException, e:
-        log.info('Sax parse error: %s %s', e, buf)
+        log.debug('Sax parse error: %s %s', e, buf)
         return {'format': 'XML'}
 
-    log.info('Top level tag detected as: %s', top_level_tag_name)
+    log.debug('Top level tag detected as: %s', top_level_tag_name)
     top_level_tag_name = top_level_tag_name.replace('rdf:rdf', 'rdf')
     top_level_tag_name = top_level_tag_name.replace('wms_capabilities', 'wms')  # WMS 1.3
     top_level_tag_name = top_level_tag_name.replace('wmt_ms_capabilities', 'wms')  # WMS 1.1.1
@@ -323,51 +348,169 @@ def get_xml_variant_without_xml_declaration(buf, log):
     if top_level_tag_name.lower() in ('coveragedescriptions', 'capabilities') and \
             'xmlns="http://www.opengis.net/wcs/' in buf:
         top_level_tag_name = 'wcs'
-    format_tuple = ckan_helpers.resource_formats().get(top_level_tag_name)
-    if format_tuple:
-        format_ = {'format': format_tuple[1]}
-        log.info('XML variant detected: %s', format_tuple[2])
+    resource_format = lib.format_index().get(top_level_tag_name)
+    if resource_format:
+        format_ = {'format': resource_format.name}
+        log.debug('XML variant detected: %s', resource_format.display_name)
         return format_
     log.warning('Did not recognise XML format: %s', top_level_tag_name)
     return {'format': 'XML'}
 
-def has_rdfa(buf, log):
-    '''If the buffer HTML contains RDFa then this returns True'''
+# The longest tag (or attribute value) that has_rdfa looks for attributes in
+RDFA_TAG_MAX_BYTES = 4096
+
+
+def _has_tag_attribute(buf, attribute, end):
+    '''Returns whether the buffer has an attribute (e.g. 'about="'), with a
+    value, inside an HTML tag, before "end".
+
+    Occurrences of the attribute are found with find(), and whether each is in
+    a tag is worked out from the last "<" or ">" since the one before, so
+    it takes linear time, however the file is made up. (A regex like
+    <[^>]+\sabout=... backtracks over every long run without a ">".)
+    '''
+    tag_start = None  # of the tag the last occurrence was in
+    searched_to = 0
+    pos = buf.find(attribute, 0, end)
+    while pos != -1:
+        lt = buf.rfind('<', searched_to, pos)
+        gt = buf.rfind('>', searched_to, pos)
+        if lt > gt:
+            tag_start = lt
+        elif gt > lt:
+            tag_start = None
+        searched_to = pos
+        value_start = pos + len(attribute)
+        if tag_start is not None and \
+                pos - tag_start <= RDFA_TAG_MAX_BYTES and \
+                buf[pos - 1].isspace():
+            value_end = buf.find('"', value_start,
+                                 min(value_start + RDFA_TAG_MAX_BYTES, end))
+            if value_end > value_start:
+                return True
+        pos = buf.find(attribute, value_start, end)
+    return False
+
+
+@metrics.stage('sniff.has_rdfa')
+def has_rdfa(buf, log, max_bytes=None):
+    '''If the buffer HTML contains RDFa then this returns True
+
+    The buffer can be a string or a mapped file (see mapped_file). Only the
+    first max_bytes are examined, if given.
+    '''
+    end = len(buf) if max_bytes is None else min(len(buf), max_bytes)
     # quick check for the key words
-    if 'about=' not in buf or 'property=' not in buf:
+    if buf.find('about=', 0, end) == -1 or \
+            buf.find('property=', 0, end) == -1:
         log.debug('Not RDFA')
         return False
 
     # more rigorous check for them as tag attributes
-    about_re = '<[^>]+\sabout="[^"]+"[^>]*>'
-    property_re = '<[^>]+\sproperty="[^"]+"[^>]*>'
-    # remove CR to catch tags spanning more than one line
-    #buf = re.sub('\r\n', ' ', buf)
-    if not re.search(about_re, buf):
+    if not _has_tag_attribute(buf, 'about="', end):
         log.debug('Not RDFA')
         return False
-    if not re.search(property_re, buf):
+    if not _has_tag_attribute(buf, 'property="', end):
         log.debug('Not RDFA')
         return False
-    log.info('RDFA tags found in HTML')
+    log.debug('RDFA tags found in HTML')
     return True
 
 
-def get_zipped_format(filepath, log):
+# How much of a file to search for markers of a format (RDFa attributes,
+# Turtle @prefix lines), by default. The file is memory-mapped, rather than
+# read into memory, so this can be much more than the detectors that parse
+# the start of a file look at.
+MARKER_SCAN_MAX_BYTES = 10 * 1024 * 1024
+
+
+def marker_scan_max_bytes():
+    return toolkit.asint(config.get('qa.sniff.marker_scan_max_bytes',
+                                    MARKER_SCAN_MAX_BYTES))
+
+
+@contextmanager
+def mapped_file(filepath):
+    '''Memory-maps a file (read-only), so that it can be searched with
+    find() and regexes like a string, without reading it all into memory.
+    An empty file (which can\'t be mapped) gives an empty string.'''
+    with open(filepath, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            yield ''
+            return
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield buf
+        finally:
+            buf.close()
+
+
+def file_has_rdfa(filepath, log):
+    '''Returns whether the HTML file contains RDFa, searching up to
+    qa.sniff.marker_scan_max_bytes of it.'''
+    with mapped_file(filepath) as buf:
+        return has_rdfa(buf, log, max_bytes=marker_scan_max_bytes())
+
+
+def file_has_ttl_prefix(filepath, log):
+    '''Returns whether the file has a Turtle @prefix or @base line,
+    searching up to qa.sniff.marker_scan_max_bytes of it.'''
+    with mapped_file(filepath) as buf:
+        return has_ttl_prefix(buf, log, max_bytes=marker_scan_max_bytes())
+
+
+# Limits on looking inside archives (zip, tar etc)
+ARCHIVE_MAX_MEMBERS = 10000
+# Only this much of a compressed tar is decompressed, looking for members
+ARCHIVE_MAX_BYTES = 100 * 1024 * 1024
+# When the filenames inside an archive don't reveal the format, the start of
+# the largest member is extracted and sniffed. This is how much of it (0 to
+# disable).
+ARCHIVE_SNIFF_MEMBER_BYTES = 5 * 1024 * 1024
+# How many levels of archives within archives to look inside
+ARCHIVE_MAX_DEPTH = 2
+
+# Formats which say nothing about the data they contain
+ARCHIVE_FORMATS = set(('ZIP', 'TAR', 'GZ', 'BZ2', 'XZ'))
+
+# Single compressed files, by mime type. The start of the file inside is
+# decompressed and sniffed, up to ARCHIVE_SNIFF_MEMBER_BYTES of it.
+COMPRESSED_CONTAINERS = {
+    'application/gzip': 'GZ',
+    'application/x-gzip': 'GZ',
+    'application/x-bzip2': 'BZ2',
+    'application/x-xz': 'XZ',
+    }
+# Gzip is decompressed this much of the file at a time
+COMPRESSED_READ_BYTES = 64 * 1024
+# Commands that write a decompressed file to stdout
+DECOMPRESS_COMMANDS = {
+    'BZ2': ['bzip2', '--decompress', '--stdout'],
+    'XZ': ['xz', '--decompress', '--stdout'],
+    }
+
+GTFS_FILENAMES = set(('agency.txt', 'stops.txt', 'routes.txt', 'trips.txt',
+                      'stop_times.txt', 'calendar.txt'))
+
+
+@metrics.stage('sniff.get_zipped_format', reads=None)
+def get_zipped_format(filepath, log, archive_depth=0):
     '''For a given zip file, return the format of file inside.
     For multiple files, choose by the most open, and then by the most
-    popular extension.'''
+    popular extension.
+
+    Only the zip's central directory is read, a record at a time, and only
+    the first ARCHIVE_MAX_MEMBERS are considered.'''
     # just check filename extension of each file inside
     try:
-        # note: Cannot use "with" with a zipfile before python 2.7
-        #       so we have to close it manually.
-        zip = zipfile.ZipFile(filepath, 'r')
-        try:
-            filepaths = zip.namelist()
-        finally:
-            zip.close()
+        with open(filepath, 'rb') as f:
+            summary = summarise_archive_members(iter_zip_members(f), log)
+            return get_archive_members_format(
+                summary, 'ZIP', lambda member, max_bytes:
+                read_zip_member(f, member, max_bytes),
+                archive_depth, log)
     except zipfile.BadZipfile, e:
-        log.info('Zip file open raised error %s: %s',
+        log.debug('Zip file open raised error %s: %s',
                  e, e.args)
         return
     except Exception, e:
@@ -375,59 +518,435 @@ def get_zipped_format(filepath, log):
                     e, e.args)
         return
 
+
+@metrics.stage('sniff.get_tarred_format', reads=None)
+def get_tarred_format(filepath, log, archive_depth=0, max_bytes=None):
+    '''For a given tar file (optionally compressed), return the format of
+    file inside, in the same way as get_zipped_format. Returns None if it is
+    not a tar file.
+
+    :param max_bytes: stop looking for members beyond this offset in the
+                      (uncompressed) tar. Set it for compressed tars, since
+                      getting to a member means decompressing everything
+                      before it.
+    '''
+    try:
+        tar = tarfile.open(filepath, 'r:*')
+    except tarfile.TarError, e:
+        log.debug('Not a tar file: %s', e)
+        return
+    except Exception, e:
+        log.warning('Tar file open raised exception %s: %s', e, e.args)
+        return
+    try:
+        summary = summarise_archive_members(
+            iter_tar_members(tar, max_bytes), log)
+        return get_archive_members_format(
+            summary, 'TAR', lambda member, max_bytes:
+            tar.extractfile(member).read(max_bytes),
+            archive_depth, log)
+    except Exception, e:
+        log.warning('Tar file read raised exception %s: %s', e, e.args)
+        return
+    finally:
+        tar.close()
+
+
+@metrics.stage('sniff.get_compressed_format', reads=None)
+def get_compressed_format(filepath, mime_type, log, archive_depth=0):
+    '''For a gzip, bzip2 or xz file, return the format of the file inside.
+
+    A tarball's members are examined like a zip's. Otherwise it is a single
+    compressed file. For gzip, the original filename stored in its header
+    may say what it is. Failing that, the start of it is decompressed and
+    sniffed.'''
+    container = COMPRESSED_CONTAINERS[mime_type]
+    format_ = get_tarred_format(filepath, log, archive_depth,
+                                max_bytes=ARCHIVE_MAX_BYTES)
+    if format_:
+        return format_
+    filename = None
+    if container == 'GZ':
+        filename = get_gzip_original_filename(filepath)
+        if filename:
+            extension = os.path.splitext(filename)[-1][1:].lower()
+            resource_format = lib.format_index().get(extension)
+            if resource_format and \
+                    resource_format.name not in ARCHIVE_FORMATS:
+                log.debug('Gzipped file format detected: %s',
+                         resource_format.display_name)
+                return {'format': resource_format.name,
+                        'container': container}
+            log.debug('Gzipped file of unknown extension: "%s" (%s)',
+                     extension, filename)
+        else:
+            log.debug('Gzip has no original filename')
+    if not filename:
+        # e.g. data.csv.bz2 -> data.csv
+        filename = os.path.splitext(os.path.basename(filepath))[0]
+    inner_format = sniff_archive_member(
+        (filename, None, None), lambda member, max_bytes:
+        read_compressed_prefix(filepath, container, max_bytes),
+        archive_depth, log)
+    if inner_format:
+        return {'format': inner_format['format'],
+                'container': container}
+
+
+def read_compressed_prefix(filepath, container, max_bytes):
+    '''Returns the start of the decompressed content of a gzip, bzip2 or xz
+    file, up to max_bytes. Only as much of the file is decompressed as is
+    needed for that.
+
+    A small file can decompress to a huge amount (a "decompression bomb"),
+    so the decompressor's output is limited to max_bytes, rather than
+    limiting how much of the file is read.
+    '''
+    if container == 'GZ':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = []
+        length = 0
+        with open(filepath, 'rb') as f:
+            while length < max_bytes:
+                data = f.read(COMPRESSED_READ_BYTES)
+                if not data:
+                    break
+                # with max_length, any compressed data left over is kept in
+                # unconsumed_tail, but by then there is enough output
+                chunk = decompressor.decompress(data, max_bytes - length)
+                chunks.append(chunk)
+                length += len(chunk)
+        return ''.join(chunks)
+    # Python 2's bz2 decompressor has no limit on its output, and it has no
+    # lzma module, so these are decompressed by the command-line tools, and
+    # only max_bytes of their output is read.
+    if isinstance(filepath, unicode):
+        filepath = filepath.encode('utf8')
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(
+            DECOMPRESS_COMMANDS[container] + [filepath],
+            stdout=subprocess.PIPE, stderr=devnull)
+    try:
+        return process.stdout.read(max_bytes)
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+
+
+def get_gzip_original_filename(filepath):
+    '''Returns the original filename stored in the header of a gzip file, or
+    None if there is not one.'''
+    with open(filepath, 'rb') as f:
+        header = f.read(10)
+        if len(header) < 10 or header[:2] != '\x1f\x8b':
+            return
+        flags = ord(header[3])
+        if flags & 4:
+            # FEXTRA
+            extra_length = struct.unpack('<H', f.read(2) or '\0\0')[0]
+            f.read(extra_length)
+        if not flags & 8:
+            # no FNAME
+            return
+        filename = f.read(1024).split('\0')[0]
+        return filename or None
+
+
+def summarise_archive_members(members, log, max_members=None):
+    '''Aggregates the filenames of the members of an archive, keeping only
+    counts rather than a list of them all.
+
+    :param members: iterable of tuples (filepath, size, member), where member
+                    is whatever is needed to read it from the archive
+    :param max_members: how many members to consider (default
+                        ARCHIVE_MAX_MEMBERS)
+    :returns: tuple (extension_counts, gtfs_filenames, largest_member), where
+              largest_member is the (filepath, size, member) of the biggest
+              file, or None if there are no files
+    '''
+    max_members = max_members or ARCHIVE_MAX_MEMBERS
+    extension_counts = defaultdict(int)  # extension: number_of_files
+    gtfs_filenames = set()
+    largest_member = None
+    for index, member in enumerate(members):
+        if index >= max_members:
+            log.debug('Archive has more than %i members - ignoring the rest',
+                     max_members)
+            break
+        filepath, size = member[:2]
+        if filepath.endswith('/'):
+            # directory
+            continue
+        extension = os.path.splitext(filepath)[-1][1:].lower()
+        extension_counts[extension] += 1
+        filename = os.path.basename(filepath)
+        if filename in GTFS_FILENAMES:
+            gtfs_filenames.add(filename)
+        if largest_member is None or size > largest_member[1]:
+            largest_member = member
+    return dict(extension_counts), gtfs_filenames, largest_member
+
+
+def get_archive_members_format(summary, container, read_member,
+                               archive_depth, log):
+    '''Given the summary of an archive's members (from
+    summarise_archive_members), return the format of the file inside.
+
+    If the extensions don't say, then the largest member is sniffed.
+
+    :param read_member: function(member, max_bytes) returning the start of
+                        a member's uncompressed content
+    '''
+    extension_counts, gtfs_filenames, largest_member = summary
     # Shapefile check - a Shapefile is a zip containing specific files:
     # .shp, .dbf and .shx amongst others
-    extensions = set([f.split('.')[-1].lower() for f in filepaths])
-    if len(extensions & set(('shp', 'dbf', 'shx'))) == 3:
-        log.info('Shapefile detected')
+    if len(set(extension_counts) & set(('shp', 'dbf', 'shx'))) == 3:
+        log.debug('Shapefile detected')
         return {'format': 'SHP'}
 
     # GTFS check - a GTFS is a zip which containing specific filenames
-    filenames = set((os.path.basename(f) for f in filepaths))
-    if not (set(('agency.txt', 'stops.txt', 'routes.txt', 'trips.txt',
-                 'stop_times.txt', 'calendar.txt')) - set(filenames)):
-        log.info('GTFS detected')
+    if gtfs_filenames == GTFS_FILENAMES:
+        log.debug('GTFS detected')
         return {'format': 'GTFS'}
 
+    format_ = get_format_by_extension_counts(extension_counts, container, log)
+    if (not format_ or format_['format'] in ARCHIVE_FORMATS) and \
+            largest_member:
+        inner_format = sniff_archive_member(largest_member, read_member,
+                                            archive_depth, log)
+        if inner_format:
+            format_ = {'format': inner_format['format'],
+                       'container': container}
+    if not format_:
+        log.debug('%s has no known extensions', container.capitalize())
+        return {'format': container}
+    return format_
+
+
+def get_format_by_extension_counts(extension_counts, container, log):
+    '''Returns the format that is the most open and then the most popular,
+    given the counts of the extensions of files in an archive, or None if
+    none are known.'''
     top_score = 0
     top_scoring_extension_counts = defaultdict(int)  # extension: number_of_files
-    for filepath in filepaths:
-        extension = os.path.splitext(filepath)[-1][1:].lower()
-        format_tuple = ckan_helpers.resource_formats().get(extension)
-        if format_tuple:
-            score = lib.resource_format_scores().get(format_tuple[1])
+    format_index = lib.format_index()
+    for extension, count in extension_counts.items():
+        resource_format = format_index.get(extension)
+        if resource_format:
+            score = resource_format.score
             if score is not None and score > top_score:
                 top_score = score
                 top_scoring_extension_counts = defaultdict(int)
             if score == top_score:
-                top_scoring_extension_counts[extension] += 1
+                top_scoring_extension_counts[extension] += count
         else:
-            log.info('Zipped file of unknown extension: "%s" (%s)',
-                     extension, filepath)
+            log.debug('%s files of unknown extension: "%s"',
+                     count, extension)
     if not top_scoring_extension_counts:
-        log.info('Zip has no known extensions: %s', filepath)
-        return {'format': 'ZIP'}
+        return
 
     top_scoring_extension_counts = sorted(top_scoring_extension_counts.items(),
                                           key=lambda x: x[1])
     top_extension = top_scoring_extension_counts[-1][0]
-    log.info('Zip file\'s most popular extension is "%s" (All extensions: %r)',
-             top_extension, top_scoring_extension_counts)
-    format_tuple = ckan_helpers.resource_formats()[top_extension]
-    format_ = {'format': format_tuple[1],
-               'container': 'ZIP'}
-    log.info('Zipped file format detected: %s', format_tuple[2])
+    log.debug('%s file\'s most popular extension is "%s" (All extensions: %r)',
+             container.capitalize(), top_extension,
+             top_scoring_extension_counts)
+    resource_format = format_index.get(top_extension)
+    format_ = {'format': resource_format.name,
+               'container': container}
+    log.debug('%s file format detected: %s', container.capitalize(),
+             resource_format.display_name)
     return format_
 
 
+def sniff_archive_member(member, read_member, archive_depth, log):
+    '''Sniffs the start of a file that is inside an archive. Returns its
+    format dict, or None.'''
+    filepath, size, member_ = member
+    if not ARCHIVE_SNIFF_MEMBER_BYTES or archive_depth >= ARCHIVE_MAX_DEPTH:
+        return
+    try:
+        data = read_member(member_, ARCHIVE_SNIFF_MEMBER_BYTES)
+    except Exception, e:
+        log.debug('Could not read "%s" from the archive: %s', filepath, e)
+        return
+    if not data:
+        return
+    log.debug('Sniffing "%s" from inside the archive (%i of %s bytes)',
+             filepath, len(data), 'unknown' if size is None else size)
+    with tempfile.NamedTemporaryFile(
+            suffix=os.path.splitext(filepath)[-1]) as f:
+        f.write(data)
+        f.flush()
+        return sniff_file_format(f.name, log, archive_depth=archive_depth + 1)
+
+
+_zip_end_record = struct.Struct('<4s4H2IH')
+_zip64_end_locator = struct.Struct('<4sIQI')
+_zip64_end_record = struct.Struct('<4sQ2H2I4Q')
+_zip_central_dir_record = struct.Struct('<4s6H3I5H2I')
+_zip_local_file_header = struct.Struct('<4s5H3I2H')
+
+
+def iter_zip_members(f):
+    '''Reads a zip file's central directory one record at a time, yielding
+    (filepath, size, member) for each member, where member is what
+    read_zip_member needs to read it.
+
+    Unlike zipfile.ZipFile, it doesn't create a ZipInfo object for every
+    member up-front, so looking at huge archives is cheap.
+
+    :param f: the zip file, opened in binary mode
+    '''
+    f.seek(0, 2)
+    file_size = f.tell()
+    tail_size = min(file_size, _zip_end_record.size + 65535)  # max comment
+    f.seek(file_size - tail_size)
+    tail = f.read(tail_size)
+    end_pos = tail.rfind('PK\x05\x06')
+    if end_pos == -1 or tail_size - end_pos < _zip_end_record.size:
+        raise zipfile.BadZipfile('File is not a zip file')
+    fields = _zip_end_record.unpack(
+        tail[end_pos:end_pos + _zip_end_record.size])
+    num_members, cd_size, cd_offset = fields[4:7]
+    end_offset = file_size - tail_size + end_pos
+    if 0xFFFF == num_members or 0xFFFFFFFF in (cd_size, cd_offset):
+        # Zip64
+        locator_offset = end_offset - _zip64_end_locator.size
+        if locator_offset < 0:
+            raise zipfile.BadZipfile('Zip64 locator not found')
+        f.seek(locator_offset)
+        locator = _zip64_end_locator.unpack(f.read(_zip64_end_locator.size))
+        if locator[0] != 'PK\x06\x07':
+            raise zipfile.BadZipfile('Zip64 locator not found')
+        # the locator's offset of the Zip64 end record doesn't allow for
+        # prepended data, so it is read from just before the locator (as
+        # zipfile does), and its actual offset used to work out the
+        # central directory's below
+        end_offset = locator_offset - _zip64_end_record.size
+        if end_offset < 0:
+            raise zipfile.BadZipfile('Zip64 end of central directory not found')
+        f.seek(end_offset)
+        record = f.read(_zip64_end_record.size)
+        if len(record) != _zip64_end_record.size or \
+                record[:4] != 'PK\x06\x06':
+            raise zipfile.BadZipfile('Zip64 end of central directory not found')
+        num_members, cd_size, cd_offset = \
+            _zip64_end_record.unpack(record)[7:10]
+    # allow for data prepended to the zip, e.g. a self-extracting archive
+    concat = end_offset - cd_size - cd_offset
+    if concat < 0:
+        raise zipfile.BadZipfile('Bad central directory offset')
+    f.seek(cd_offset + concat)
+    for i in xrange(num_members):
+        record = f.read(_zip_central_dir_record.size)
+        if len(record) != _zip_central_dir_record.size or \
+                record[:4] != 'PK\x01\x02':
+            raise zipfile.BadZipfile('Bad central directory record')
+        fields = _zip_central_dir_record.unpack(record)
+        flags, method = fields[3:5]
+        compress_size, size = fields[8:10]
+        filename_length, extra_length, comment_length = fields[10:13]
+        header_offset = fields[16]
+        filepath = f.read(filename_length)
+        extra = f.read(extra_length)
+        f.read(comment_length)
+        if 0xFFFFFFFF in (size, compress_size, header_offset):
+            size, compress_size, header_offset = _zip64_extra(
+                extra, size, compress_size, header_offset)
+        yield filepath, size, \
+            (method, flags, compress_size, header_offset + concat)
+
+
+def _zip64_extra(extra, size, compress_size, header_offset):
+    '''Returns the values that were too large for a zip central directory
+    record, from its Zip64 extra field.'''
+    values = [size, compress_size, header_offset]
+    pos = 0
+    while pos + 4 <= len(extra):
+        header_id, length = struct.unpack('<HH', extra[pos:pos + 4])
+        if header_id == 1:
+            data = extra[pos + 4:pos + 4 + length]
+            data_pos = 0
+            for i, value in enumerate(values):
+                if value == 0xFFFFFFFF:
+                    if data_pos + 8 > len(data):
+                        raise zipfile.BadZipfile('Corrupt Zip64 extra field')
+                    values[i] = struct.unpack(
+                        '<Q', data[data_pos:data_pos + 8])[0]
+                    data_pos += 8
+            break
+        pos += 4 + length
+    return tuple(values)
+
+
+def read_zip_member(f, member, max_bytes):
+    '''Returns up to max_bytes of the uncompressed content of a zip member.
+
+    :param member: as yielded by iter_zip_members
+    '''
+    method, flags, compress_size, header_offset = member
+    if flags & 1:
+        raise ValueError('Zip member is encrypted')
+    f.seek(header_offset)
+    header = f.read(_zip_local_file_header.size)
+    if len(header) != _zip_local_file_header.size or \
+            header[:4] != 'PK\x03\x04':
+        raise zipfile.BadZipfile('Bad local file header')
+    filename_length, extra_length = _zip_local_file_header.unpack(header)[9:]
+    f.seek(filename_length + extra_length, 1)
+    if method == zipfile.ZIP_STORED:
+        return f.read(min(compress_size, max_bytes))
+    if method != zipfile.ZIP_DEFLATED:
+        raise ValueError('Unsupported zip compression method: %s' % method)
+    decompressor = zlib.decompressobj(-15)
+    chunks = []
+    length = 0
+    remaining = compress_size
+    while remaining and length < max_bytes:
+        data = f.read(min(remaining, 64 * 1024))
+        if not data:
+            break
+        remaining -= len(data)
+        chunk = decompressor.decompress(data, max_bytes - length)
+        chunks.append(chunk)
+        length += len(chunk)
+    return ''.join(chunks)
+
+
+def iter_tar_members(tar, max_bytes=None):
+    '''Yields (filepath, size, member) for each file in an open TarFile.
+
+    Unlike TarFile.getmembers(), it doesn't keep every TarInfo object, and
+    it stops before going beyond max_bytes into the tar.'''
+    while True:
+        member = tar.next()
+        if member is None:
+            return
+        # TarFile keeps a list of all the members it has read - not needed
+        tar.members = []
+        if member.isfile():
+            yield member.name, member.size, member
+        if max_bytes and member.offset_data + member.size > max_bytes:
+            return
+
+
+@metrics.stage('sniff.magic', reads=None)
+def get_magic_mime_type(filepath):
+    return magic.from_file(filepath, mime=True)
+
+
+@metrics.stage('sniff.is_excel', reads=None)
 def is_excel(filepath, log):
     try:
         xlrd.open_workbook(filepath)
     except Exception, e:
-        log.info('Not Excel - failed to load: %s %s', e, e.args)
+        log.debug('Not Excel - failed to load: %s %s', e, e.args)
         return False
     else:
-        log.info('Excel file opened successfully')
+        log.debug('Excel file opened successfully')
         return True
 
 
@@ -445,6 +964,7 @@ def check_output(*popenargs, **kwargs):
         raise Exception('Non-zero exit status %s: %s' % (retcode, output))
     return output
 
+@metrics.stage('sniff.run_bsd_file', reads=None)
 def run_bsd_file(filepath, log):
     '''Run the BSD command-line tool "file" to determine file type. Returns
     a format dict or None if it fails.'''
@@ -461,37 +981,212 @@ def run_bsd_file(filepath, log):
                       }
         if app_name in format_map:
             extension = format_map[app_name]
-            format_tuple = ckan_helpers.resource_formats()[extension]
-            log.info('"file" detected file format: %s',
-                     format_tuple[2])
-            return {'format': format_tuple[1]}
+            resource_format = lib.format_index().get(extension)
+            log.debug('"file" detected file format: %s',
+                     resource_format.display_name)
+            return {'format': resource_format.name}
     match = re.search(': ESRI Shapefile', result)
     if match:
         format_ = {'format': 'SHP'}
-        log.info('"file" detected file format: %s',
+        log.debug('"file" detected file format: %s',
                  format_['format'])
         return format_
-    log.info('"file" could not determine file format of "%s": %s',
+    log.debug('"file" could not determine file format of "%s": %s',
              filepath, result)
 
 
-def is_ttl(buf, log):
-    '''If the buffer is a Turtle RDF file then return True.'''
-    # Turtle spec: "Turtle documents may have the strings '@prefix' or '@base' (case dependent) near the beginning of the document."
-    at_re = '^@(prefix|base) '
-    match = re.search(at_re, buf, re.MULTILINE)
-    if match:
-        log.info('Turtle RDF detected - @prefix or @base')
+# Limits on the work is_ttl does looking for triples, so that pathological
+# input (e.g. long unclosed strings) cannot stall a worker.
+TTL_MAX_BYTES = 10000
+TTL_MAX_SECONDS = 0.5
+
+
+@metrics.stage('sniff.is_ttl')
+def is_ttl(buf, log, max_bytes=TTL_MAX_BYTES, max_seconds=TTL_MAX_SECONDS):
+    '''If the buffer is a Turtle RDF file then return True.
+
+    Only the first max_bytes of the buffer are examined, and the search for
+    triples gives up after max_seconds.
+    '''
+    buf = buf[:max_bytes]
+    if has_ttl_prefix(buf, log):
         return True
 
     # Alternatively look for several triples
     num_required_triples = 5
-    ignore, num_replacements = turtle_regex().subn('', buf, num_required_triples)
-    if num_replacements >= num_required_triples:
-        log.info('Turtle RDF detected - %s triples' % num_replacements)
+    deadline = time.time() + max_seconds if max_seconds else None
+    num_triples = count_turtle_triples(buf, num_required_triples, deadline)
+    if num_triples >= num_required_triples:
+        log.debug('Turtle RDF detected - %s triples', num_triples)
         return True
 
-    log.debug('Not Turtle RDF - triples not detected (%i)' % num_replacements)
+    log.debug('Not Turtle RDF - triples not detected (%i)', num_triples)
+
+
+# Turtle spec: "Turtle documents may have the strings '@prefix' or '@base'
+# (case dependent) near the beginning of the document."
+_ttl_prefix_re = re.compile('^@(prefix|base) ', re.MULTILINE)
+
+
+@metrics.stage('sniff.has_ttl_prefix')
+def has_ttl_prefix(buf, log, max_bytes=None):
+    '''Returns whether the buffer has a Turtle @prefix or @base line.
+
+    The buffer can be a string or a mapped file (see mapped_file). Only the
+    first max_bytes are examined, if given.
+    '''
+    end = len(buf) if max_bytes is None else min(len(buf), max_bytes)
+    if _ttl_prefix_re.search(buf, 0, end):
+        log.debug('Turtle RDF detected - @prefix or @base')
+        return True
+    return False
+
+
+# Tokens for count_turtle_triples. None of these have nested quantifiers, so
+# each match attempt takes time proportional to the length of the token.
+_ttl_iri_re = re.compile(r'<[^\s<>"{}|^`\\]*>')
+_ttl_blank_node_re = re.compile(r'_:[A-Za-z0-9_][A-Za-z0-9_\-]*')
+_ttl_number_re = re.compile(
+    r'[+-]?([0-9]+(\.[0-9]+)?|\.[0-9]+)([eE][+-]?[0-9]+)?')
+_ttl_boolean_re = re.compile(r'true|false')
+_ttl_language_re = re.compile(r'@[A-Za-z]+(-[A-Za-z0-9]+)*')
+_ttl_datatype_re = re.compile(
+    r'\^\^(<[^\s<>"{}|^`\\]*>|[A-Za-z][\w\-]*(\.[\w\-]+)*:[\w\-]*(\.[\w\-]+)*)')
+_ttl_other_re = re.compile(r'\S+')
+_ttl_whitespace = ' \t\r\n'
+_ttl_delimiters = ' \t\r\n;,.'
+
+# count_turtle_triples states - what the statement is expecting next
+_TTL_SUBJECT, _TTL_PREDICATE, _TTL_OBJECT, _TTL_END = range(4)
+
+
+def count_turtle_triples(buf, max_triples=None, deadline=None):
+    '''Counts the Turtle triples in the buffer, in a single linear pass.
+
+    Each RDF term may be in the forms listed for turtle_regex(). Triples
+    are counted when terminated by "." (end of statement), ";" (the
+    subject is repeated with another predicate-object) or "," (another
+    object). Anything else that is not a term (e.g. prefixed names,
+    nested blank nodes, collections) resets the statement.
+
+    :param max_triples: stop counting once this number is reached
+    :param deadline: stop counting once time.time() passes this
+    :returns: number of triples found (int)
+    '''
+    length = len(buf)
+    pos = 0
+    state = _TTL_SUBJECT
+    num_triples = 0
+    num_tokens = 0
+    while pos < length:
+        char = buf[pos]
+        if char in _ttl_whitespace:
+            pos += 1
+            continue
+        num_tokens += 1
+        if deadline and not num_tokens % 64 and time.time() > deadline:
+            break
+
+        # punctuation
+        if char in ';,.':
+            next_char = buf[pos + 1:pos + 2]
+            if char == '.' and next_char.isdigit():
+                pass  # a number like .12
+            else:
+                pos += 1
+                if state == _TTL_END:
+                    num_triples += 1
+                    if max_triples and num_triples >= max_triples:
+                        break
+                    state = {';': _TTL_PREDICATE, ',': _TTL_OBJECT,
+                             '.': _TTL_SUBJECT}[char]
+                elif state == _TTL_PREDICATE and char in ';.':
+                    # e.g. trailing "; ." is allowed
+                    state = _TTL_PREDICATE if char == ';' else _TTL_SUBJECT
+                else:
+                    state = _TTL_SUBJECT
+                continue
+        if char == '#':
+            # comment to the end of the line
+            end = buf.find('\n', pos)
+            pos = end if end != -1 else length
+            state = _TTL_SUBJECT
+            continue
+
+        # RDF term
+        end = _ttl_term_end(buf, pos)
+        if end is None:
+            # an unclosed long string - nothing after it can be a term
+            break
+        if end == -1:
+            # not a term - skip over the non-whitespace
+            pos = _ttl_other_re.match(buf, pos).end()
+            state = _TTL_SUBJECT
+            continue
+        pos = end
+        if state == _TTL_END:
+            # too many terms for a triple - take this as a new subject
+            state = _TTL_PREDICATE
+        else:
+            state += 1
+    return num_triples
+
+
+def _ttl_term_end(buf, pos):
+    '''Returns the position of the end of the RDF term that starts at pos,
+    or -1 if there is no term there, or None if there is an unclosed long
+    string.'''
+    char = buf[pos]
+    if char == '<':
+        match = _ttl_iri_re.match(buf, pos)
+        return match.end() if match else -1
+    if char in '"\'':
+        end = _ttl_string_end(buf, pos)
+        if end is None or end == -1:
+            return end
+        match = _ttl_language_re.match(buf, end) or \
+            _ttl_datatype_re.match(buf, end)
+        return match.end() if match else end
+    for term_re in (_ttl_blank_node_re, _ttl_number_re, _ttl_boolean_re):
+        match = term_re.match(buf, pos)
+        if match:
+            end = match.end()
+            # bare words must be followed by a delimiter
+            if end == len(buf) or buf[end] in _ttl_delimiters:
+                return end
+            return -1
+    return -1
+
+
+def _ttl_string_end(buf, pos):
+    '''Returns the position after the closing quote of the string literal
+    that starts at pos, or -1 if a short string does not close on the same
+    line, or None if a long string does not close at all.'''
+    quote = buf[pos]
+    if buf[pos:pos + 3] == quote * 3:
+        end = _ttl_find_unescaped(buf, quote * 3, pos + 3, len(buf))
+        return end + 3 if end != -1 else None
+    line_end = buf.find('\n', pos)
+    if line_end == -1:
+        line_end = len(buf)
+    end = _ttl_find_unescaped(buf, quote, pos + 1, line_end)
+    return end + 1 if end != -1 else -1
+
+
+def _ttl_find_unescaped(buf, quote, start, end):
+    '''Like buf.find(quote, start, end), but skipping backslash-escaped
+    quotes.'''
+    while True:
+        found = buf.find(quote, start, end)
+        if found == -1:
+            return -1
+        num_backslashes = 0
+        while buf[found - num_backslashes - 1] == '\\':
+            num_backslashes += 1
+        if not num_backslashes % 2:
+            return found
+        start = found + 1
+
 
 turtle_regex_ = None
 def turtle_regex():
@@ -512,6 +1207,9 @@ def turtle_regex():
      @prefix already detected for them to be used.
          prefix:term  :blank_prefix
      does not support nested blank nodes, collection, sameas ('a' token)
+
+    NB is_ttl uses count_turtle_triples instead, because this regex can
+    backtrack catastrophically on some input.
     '''
     global turtle_regex_
     if not turtle_regex_:
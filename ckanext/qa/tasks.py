@@ -4,7 +4,10 @@ Berners-Lee\'s five stars of openness
 '''
 import datetime
 import json
+import logging
 import os
+import re
+import time
 import traceback
 import urlparse
 import routes
@@ -13,9 +16,9 @@ from ckan.common import _
 from ckan.lib import celery_app
 from ckan.lib import i18n
 from ckan.plugins import toolkit
-import ckan.lib.helpers as ckan_helpers
 from ckanext.qa.sniff_format import sniff_file_format
 from ckanext.qa import lib
+from ckanext.qa import metrics
 from ckanext.archiver.model import Archival, Status
 
 
@@ -73,18 +76,21 @@ def load_translations(lang):
     registry.register(translator, fakepylons.translator)
 
 @celery_app.celery.task(name="qa.update_package")
-def update_package(ckan_ini_filepath, package_id):
+def update_package(ckan_ini_filepath, package_id, queued_at=None):
     """
     Given a package, calculates an openness score for each of its resources.
     It is more efficient to call this than 'update' for each resource.
 
+    queued_at is the time.time() that the task was queued, for metrics.
+
     Returns None
     """
     log = update_package.get_logger()
     load_config(ckan_ini_filepath)
 
     try:
-        update_package_(package_id, log)
+        with metrics.task_run('qa.update_package', queued_at):
+            update_package_(package_id, log)
     except Exception, e:
         log.error('Exception occurred during QA update_package: %s: %s',
                   e.__class__.__name__,  unicode(e))
@@ -93,6 +99,7 @@ def update_package(ckan_ini_filepath, package_id):
 
 def update_package_(package_id, log):
     from ckan import model
+    task_run = metrics.current_task_run() or metrics.TaskRun('')
     package = model.Package.get(package_id)
     if not package:
         raise QAError('Package ID not found: %s' % package_id)
@@ -101,22 +108,25 @@ def update_package_(package_id, log):
              len(package.resources))
 
     for resource in package.resources:
-        qa_result = resource_score(resource, log)
-        log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result, resource,
-                 resource.url)
-        save_qa_result(resource, qa_result, log)
-        log.info('CKAN updated with openness score')
+        with task_run.span('score'):
+            qa_result = resource_score(resource, log)
+        with task_run.span('save'):
+            save_qa_result(resource, qa_result, log)
+        task_run.increment('resources_scored')
 
     # Refresh the index for this dataset, so that it contains the latest
     # qa info
-    _update_search_index(package.id, log)
+    with task_run.span('index'):
+        _update_search_index(package.id, log)
 
 
 @celery_app.celery.task(name="qa.update")
-def update(ckan_ini_filepath, resource_id):
+def update(ckan_ini_filepath, resource_id, queued_at=None):
     """
     Given a resource, calculates an openness score.
 
+    queued_at is the time.time() that the task was queued, for metrics.
+
     Returns a JSON dict with keys:
 
         'openness_score': score (int)
@@ -125,7 +135,8 @@ def update(ckan_ini_filepath, resource_id):
     log = update.get_logger()
     load_config(ckan_ini_filepath)
     try:
-        update_resource_(resource_id, log)
+        with metrics.task_run('qa.update', queued_at):
+            update_resource_(resource_id, log)
     except Exception, e:
         log.error('Exception occurred during QA update_resource: %s: %s',
                   e.__class__.__name__,  unicode(e))
@@ -134,14 +145,15 @@ def update(ckan_ini_filepath, resource_id):
 
 def update_resource_(resource_id, log):
     from ckan import model
+    task_run = metrics.current_task_run() or metrics.TaskRun('')
     resource = model.Resource.get(resource_id)
     if not resource:
         raise QAError('Resource ID not found: %s' % resource_id)
-    qa_result = resource_score(resource, log)
-    log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result, resource,
-             resource.url)
-    save_qa_result(resource, qa_result, log)
-    log.info('CKAN updated with openness score')
+    with task_run.span('score'):
+        qa_result = resource_score(resource, log)
+    with task_run.span('save'):
+        save_qa_result(resource, qa_result, log)
+    task_run.increment('resources_scored')
 
     if toolkit.check_ckan_version(max_version='2.2.99'):
         package = resource.resource_group.package
@@ -150,7 +162,8 @@ def update_resource_(resource_id, log):
     if package:
         # Refresh the index for this dataset, so that it contains the latest
         # qa info
-        _update_search_index(package.id, log)
+        with task_run.span('index'):
+            _update_search_index(package.id, log)
     else:
         log.warning('Resource not connected to a package. Res: %r', resource)
     return json.dumps(qa_result)
@@ -173,32 +186,79 @@ def format_get(key):
     :param key: string
     :returns: format string
     '''
-    format_tuple = ckan_helpers.resource_formats().get(key.lower())
-    if not format_tuple:
+    format_ = lib.format_index().get(key)
+    if not format_:
         return
-    return format_tuple[1]  # short name
+    return format_.name  # short name
 
 
-def resource_score(resource, log):
+def resource_score(resource, log, archivals=None):
     """
     Score resource on Sir Tim Berners-Lee\'s five stars of openness.
 
+    archivals is an optional dict of resource_id: Archival, for when they have
+    been read in bulk. Otherwise the resource\'s archival is looked up.
+
     Returns a dict with keys:
 
         'openness_score': score (int)
         'openness_score_reason': the reason for the score (string)
         'format': format of the data (string)
         'archival_timestamp': time of the archival that this result is based on (iso string)
+        'format_scores_version': version of the format scores table used (string)
+        'timings': the stages of scoring it (format detectors etc), with
+                   their duration, bytes read and verdict (list of dicts)
 
     Raises QAError for reasonable errors
     """
+    start = time.time()
+    with metrics.tracing() as trace:
+        result = resource_score_(resource, log, archivals)
+    seconds = time.time() - start
+    trace.record('score', seconds,
+                 verdict='%s:%s' % (result['format'], result['openness_score']))
+    result['timings'] = trace.as_list()
+    metrics.record_trace(trace)
+    log_resource_score(log, resource, result, seconds)
+    return result
+
+
+def log_resource_score(log, resource, result, seconds):
+    '''
+    Logs a single record (at INFO level) summarising the scoring of a
+    resource. The details of how it was scored are logged at DEBUG level.
+
+    The summary is also given to log handlers as the record's "qa"
+    attribute, for structured (e.g. JSON) logging.
+    '''
+    if not log.isEnabledFor(logging.INFO):
+        return
+    summary = {
+        'resource_id': resource.id,
+        'url': resource.url,
+        'openness_score': result['openness_score'],
+        'format': result['format'],
+        'reason': result['openness_score_reason'],
+        'seconds': seconds,
+        }
+    log.info('Openness score of resource %s: %s format=%s (%.3fs) %s',
+             resource.id, result['openness_score'], result['format'],
+             seconds, result['openness_score_reason'],
+             extra={'qa': summary})
+
+
+def resource_score_(resource, log, archivals=None):
     score = 0
     score_reason = ''
     format_ = None
+    format_scores_version = lib.resource_format_scores_version()
 
     try:
         score_reasons = []  # a list of strings detailing how we scored it
-        archival = Archival.get_for_resource(resource_id=resource.id)
+        if archivals is not None:
+            archival = archivals.get(resource.id)
+        else:
+            archival = Archival.get_for_resource(resource_id=resource.id)
         if not resource:
             raise QAError('Could not find resource "%s"' % resource.id)
 
@@ -242,7 +302,7 @@ def resource_score(resource, log):
         score_reason = _('License not open')
         score = 0
 
-    log.info('Score: %s Reason: %s', score, score_reason)
+    log.debug('Score: %s Reason: %s', score, score_reason)
 
     archival_updated = archival.updated.isoformat() \
         if archival and archival.updated else None
@@ -250,7 +310,8 @@ def resource_score(resource, log):
         'openness_score': score,
         'openness_score_reason': score_reason,
         'format': format_,
-        'archival_timestamp': archival_updated
+        'archival_timestamp': archival_updated,
+        'format_scores_version': format_scores_version,
     }
 
     return result
@@ -285,6 +346,7 @@ def broken_link_error_message(archival):
     return ' '.join(messages)
 
 
+@metrics.stage('score.link_broken', reads=None)
 def score_if_link_broken(archival, resource, score_reasons, log):
     '''
     Looks to see if the archiver said it was broken, and if so, writes to
@@ -300,10 +362,12 @@ def score_if_link_broken(archival, resource, score_reasons, log):
         # Score 0 since we are sure the link is currently broken
         score_reasons.append(broken_link_error_message(archival))
         format_ = get_qa_format(resource.id)
-        log.info('Archiver says link is broken. Previous format: %r' % format_)
+        log.debug('Archiver says link is broken. Previous format: %r',
+                  format_)
         return (0, format_)
     return (None, None)
 
+@metrics.stage('score.sniffing_data', reads=None)
 def score_by_sniffing_data(archival, resource, score_reasons, log):
     '''
     Looks inside a data file\'s contents to determine its format and score.
@@ -326,7 +390,7 @@ def score_by_sniffing_data(archival, resource, score_reasons, log):
     else:
         if filepath:
             sniffed_format = sniff_file_format(filepath, log)
-            score = lib.resource_format_scores().get(sniffed_format['format']) \
+            score = lib.format_index().score(sniffed_format['format']) \
                 if sniffed_format else None
             if sniffed_format:
                 score_reasons.append(_('Content of file appeared to be format "%s" which receives openness score: %s.') % (sniffed_format['format'], score))
@@ -350,6 +414,7 @@ def score_by_sniffing_data(archival, resource, score_reasons, log):
                 return (None, None)
 
 
+@metrics.stage('score.url_extension', reads=None)
 def score_by_url_extension(resource, score_reasons, log):
     '''
     Looks at the URL for a resource to determine its format and score.
@@ -366,9 +431,10 @@ def score_by_url_extension(resource, score_reasons, log):
         score_reasons.append(_('Could not determine a file extension in the URL.'))
         return (None, None)
     for extension in extension_variants_:
-        format_ = format_get(extension)
-        if format_:
-            score = lib.resource_format_scores().get(format_)
+        resource_format = lib.format_index().get(extension)
+        if resource_format:
+            format_ = resource_format.name
+            score = resource_format.score
             if score:
                 score_reasons.append(_('URL extension "%s" relates to format "%s" and receives score: %s.') % (extension, format_, score))
                 return score, format_
@@ -399,6 +465,7 @@ def extension_variants(url):
     return results
 
 
+@metrics.stage('score.format_field', reads=None)
 def score_by_format_field(resource, score_reasons, log):
     '''
     Looks at the format field of a resource to determine its format and score.
@@ -414,15 +481,14 @@ def score_by_format_field(resource, score_reasons, log):
     if not format_field:
         score_reasons.append(_('Format field is blank.'))
         return (None, None)
-    format_tuple = ckan_helpers.resource_formats().get(format_field.lower()) or \
-        ckan_helpers.resource_formats().get(lib.munge_format_to_be_canonical(format_field))
-    if not format_tuple:
+    resource_format = lib.format_index().get(format_field, munge=True)
+    if not resource_format:
         score_reasons.append(_('Format field "%s" does not correspond to a known format.') % format_field)
         return (None, None)
-    score = lib.resource_format_scores().get(format_tuple[1])
+    score = resource_format.score
     score_reasons.append(_('Format field "%s" receives score: %s.') %
                          (format_field, score))
-    return (score, format_tuple[1])
+    return (score, resource_format.name)
 
 
 def _update_search_index(package_id, log):
@@ -439,28 +505,279 @@ def _update_search_index(package_id, log):
     log.info('Search indexed %s', package['name'])
 
 
+def _update_search_index_in_batches(package_ids, log, batch_size=100):
+    '''
+    Tells CKAN to update its search index for the given packages, committing
+    to the index once per batch, rather than once per package.
+    '''
+    from ckan import model
+    from ckan.lib.search.index import PackageSearchIndex
+    package_index = PackageSearchIndex()
+    context_ = {'model': model, 'ignore_auth': True, 'session': model.Session,
+                'use_cache': False, 'validate': False}
+    package_ids = list(package_ids)
+    for i in range(0, len(package_ids), batch_size):
+        for package_id in package_ids[i:i + batch_size]:
+            package = toolkit.get_action('package_show')(
+                context_, {'id': package_id})
+            package_index.index_package(package, defer_commit=True)
+        package_index.commit()
+        log.info('Search indexed %i/%i datasets',
+                 min(i + batch_size, len(package_ids)), len(package_ids))
+
+
+def _format_score_reasons():
+    '''Returns the reasons that resource_score gives when a resource\'s score
+    is its format\'s score. In each, the score is the last parameter.'''
+    return (
+        _('Content of file appeared to be format "%s" which receives openness score: %s.'),
+        _('URL extension "%s" relates to format "%s" and receives score: %s.'),
+        _('Format field "%s" receives score: %s.'),
+        )
+
+
+def rescore_qa_by_format(qa, format_index, log):
+    '''
+    Updates a QA result for a change to the format scores table, using its
+    stored format and reason, rather than looking at the resource again.
+
+    Only results whose score was their format's score can be rescored like
+    this. The sentence in the reason that gave the score is updated with the
+    new score.
+
+    Return values:
+      * True if the score was changed
+      * False if it did not need changing, including when the score is not
+        the format's (e.g. the license is not open)
+      * None if it cannot be rescored like this, so needs a full QA update,
+        including when the reason that gave the score is not recognised
+    '''
+    reason = qa.openness_score_reason or ''
+    if not qa.openness_score or not qa.format:
+        # a score of 0 is for a broken link or a license that is not open,
+        # and without a format the score can't have been a format's
+        return False
+    # find the (last) sentence of the reason that gave the score
+    score_match = None
+    for template in _format_score_reasons():
+        parts = [re.escape(part) for part in template.split('%s')]
+        regex = '(.*?)'.join(parts[:-1]) + '(\d+)' + parts[-1]
+        for match in re.finditer(regex, reason):
+            if int(match.group(match.lastindex)) == qa.openness_score and \
+                    (not score_match or match.start() > score_match.start()):
+                score_match = match
+    if not score_match:
+        if _('Could not understand the file format, therefore score is 1.') \
+                in reason:
+            return False
+        # e.g. the reason is in another language, or is worded as an older
+        # version did, so whether the score was the format's is not known
+        log.info('Could not find the reason for the score, so it needs a '
+                 'full QA update: %r', qa)
+        return None
+    new_score = format_index.score(qa.format)
+    if new_score is None:
+        log.info('Format %s no longer has a score: %r', qa.format, qa)
+        return None
+    if new_score == qa.openness_score:
+        return False
+    score_group = score_match.lastindex
+    qa.openness_score_reason = reason[:score_match.start(score_group)] + \
+        unicode(new_score) + reason[score_match.end(score_group):]
+    qa.openness_score = new_score
+    return True
+
+
+def iter_resource_id_pages(page_size):
+    '''
+    Yields lists of the ids of all active resources (of active datasets),
+    page_size at a time. Pages are read by keyset (the id after the last
+    one), rather than offset, so each is a quick indexed query.
+    '''
+    from ckan import model
+    last_id = None
+    while True:
+        q = model.Session.query(model.Resource.id)
+        if toolkit.check_ckan_version(max_version='2.2.99'):
+            q = q.join(model.ResourceGroup)
+        q = q.join(model.Package) \
+            .filter(model.Resource.state == 'active') \
+            .filter(model.Package.state == 'active')
+        if last_id:
+            q = q.filter(model.Resource.id > last_id)
+        resource_ids = [row[0] for row in
+                        q.order_by(model.Resource.id).limit(page_size)]
+        if not resource_ids:
+            return
+        yield resource_ids
+        last_id = resource_ids[-1]
+
+
+# Whether this process is a worker of a pool running score_resources
+_in_score_resources_worker = False
+
+
+def init_score_resources_worker():
+    '''Initializes a process of a multiprocessing pool running
+    score_resources.'''
+    global _in_score_resources_worker
+    # The parent disposes of its database connections before creating the
+    # pool, so this process makes its own.
+    from ckan import model
+    model.Session.remove()
+    _in_score_resources_worker = True
+
+
+def score_resources(resource_ids):
+    '''
+    Scores the given resources, returning a list of
+    (resource_id, package_id, qa_result). Their archivals are read in one
+    query. Resources that fail to be scored are logged and left out.
+
+    It doesn\'t save the results (see save_qa_results_in_bulk), so it can be
+    run in a multiprocessing pool.
+    '''
+    from ckan import model
+    log = logging.getLogger('ckanext.qa.tasks')
+    resources = model.Session.query(model.Resource) \
+        .filter(model.Resource.id.in_(resource_ids)) \
+        .all()
+    archivals = dict((archival.resource_id, archival) for archival in
+                     model.Session.query(Archival)
+                     .filter(Archival.resource_id.in_(resource_ids)))
+    results = []
+    for resource in resources:
+        try:
+            qa_result = resource_score(resource, log, archivals=archivals)
+        except Exception, e:
+            log.error('Could not score resource %s: %s: %s', resource.id,
+                      e.__class__.__name__, unicode(e))
+            continue
+        if toolkit.check_ckan_version(max_version='2.2.99'):
+            package_id = resource.resource_group.package_id
+        else:
+            package_id = resource.package_id
+        results.append((resource.id, package_id, qa_result))
+    if _in_score_resources_worker:
+        # don't hold a connection between chunks
+        model.Session.remove()
+    return results
+
+
+def save_qa_results_in_bulk(results, log):
+    """
+    Saves the results of score_resources to the qa table. It finds the
+    existing rows in one query, then updates them all in one statement and
+    inserts the new ones in another, rather than a query and update per
+    resource as save_qa_result does.
+    """
+    import ckan.model as model
+    from sqlalchemy import bindparam
+    from ckanext.qa.model import QA, QAHistory, QAChange, FormatScores, \
+        make_uuid, update_package_qa, qa_change_rows, lock_qa_changes
+
+    if not results:
+        return
+    # so that a task saving a result at the same time (save_qa_result) can't
+    # also insert a row for a resource that has none yet
+    lock_qa_changes()
+    now = datetime.datetime.now()
+    qa_table = QA.__table__
+    resource_ids = [resource_id for resource_id, package_id, qa_result
+                    in results]
+    existing_qas = dict(
+        (resource_id, (qa_id, dict(openness_score=openness_score,
+                                   format=format_,
+                                   openness_score_reason=reason)))
+        for resource_id, qa_id, openness_score, format_, reason in
+        model.Session.query(QA.resource_id, QA.id, QA.openness_score,
+                            QA.format, QA.openness_score_reason)
+        .filter(QA.resource_id.in_(resource_ids)))
+    updates = []
+    inserts = []
+    history_rows = []
+    change_rows = []
+    format_scores_versions = set()
+    for resource_id, package_id, qa_result in results:
+        values = dict((key, qa_result[key]) for key in (
+            'openness_score', 'openness_score_reason', 'format',
+            'archival_timestamp'))
+        values['format_scores_version'] = \
+            qa_result.get('format_scores_version')
+        values['updated'] = now
+        format_scores_versions.add(values['format_scores_version'])
+        qa_id, before = existing_qas.get(resource_id, (None, None))
+        if qa_id:
+            values['qa_id'] = qa_id
+            updates.append(values)
+        else:
+            values.update(id=make_uuid(), resource_id=resource_id,
+                          package_id=package_id, created=now)
+            inserts.append(values)
+        history, change = qa_change_rows(
+            resource_id, package_id, now, before,
+            dict((key, values[key]) for key in (
+                'openness_score', 'format', 'openness_score_reason')))
+        if history:
+            history_rows.append(history)
+        if change:
+            change_rows.append(change)
+    if updates:
+        model.Session.execute(
+            qa_table.update().where(qa_table.c.id == bindparam('qa_id')),
+            updates)
+    if inserts:
+        model.Session.execute(qa_table.insert(), inserts)
+    if history_rows:
+        model.Session.execute(QAHistory.__table__.insert(), history_rows)
+    if change_rows:
+        model.Session.execute(QAChange.__table__.insert(), change_rows)
+    for package_id in set(package_id for resource_id, package_id, qa_result
+                          in results):
+        update_package_qa(package_id)
+    current_version = lib.resource_format_scores_version()
+    if current_version in format_scores_versions:
+        FormatScores.record(current_version, lib.resource_format_scores())
+    model.Session.commit()
+    log.info('QA results saved: %i updated, %i added', len(updates),
+             len(inserts))
+
+
 def save_qa_result(resource, qa_result, log):
     """
     Saves the results of the QA check to the qa table.
     """
     import ckan.model as model
-    from ckanext.qa.model import QA
+    from ckanext.qa.model import QA, FormatScores, update_package_qa, \
+        record_qa_change, qa_change_fields, lock_qa_changes
 
     now = datetime.datetime.now()
 
+    # so that no other task or bulk save also adds a row for the resource
+    lock_qa_changes()
     qa = QA.get_for_resource(resource.id)
     if not qa:
         qa = QA.create(resource.id)
         model.Session.add(qa)
+        before = None
     else:
-        log.info(u'QA from before: %r', qa)
+        log.debug(u'QA from before: %r', qa)
+        before = qa_change_fields(qa)
 
     for key in ('openness_score', 'openness_score_reason', 'format'):
         setattr(qa, key, qa_result[key])
     qa.archival_timestamp = qa_result['archival_timestamp']
+    qa.format_scores_version = qa_result.get('format_scores_version')
     qa.updated = now
+    if qa.format_scores_version and \
+            qa.format_scores_version == lib.resource_format_scores_version():
+        # keep a copy of this scores table, to compare with future versions
+        FormatScores.record(qa.format_scores_version,
+                            lib.resource_format_scores())
+    record_qa_change(qa, before)
+    update_package_qa(qa.package_id)
 
     model.Session.commit()
 
-    log.info('QA results updated ok')
+    log.debug('QA results updated ok')
     return qa  # for tests
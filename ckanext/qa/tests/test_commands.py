@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import multiprocessing
+import StringIO
+
+from nose.tools import assert_equal
+
+from ckanext.qa.commands import iter_filepaths, sniff_files
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+class TestSniffCommand:
+    @classmethod
+    def setup_class(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(cls.tmp_dir, 'sub'))
+        for filename, dir_ in (('311011.csv', ''),
+                               ('August-2010.xls', 'sub'),
+                               ('jobs.xml', 'sub')):
+            shutil.copy(os.path.join(DATA_DIR, filename),
+                        os.path.join(cls.tmp_dir, dir_, filename))
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def path(self, *parts):
+        return os.path.join(self.tmp_dir, *parts)
+
+    def test_iter_filepaths_directory(self):
+        assert_equal(list(iter_filepaths([self.tmp_dir], None)),
+                     [self.path('311011.csv'),
+                      self.path('sub', 'August-2010.xls'),
+                      self.path('sub', 'jobs.xml')])
+
+    def test_iter_filepaths_glob(self):
+        assert_equal(list(iter_filepaths([self.path('sub', '*.xls')], None)),
+                     [self.path('sub', 'August-2010.xls')])
+
+    def test_iter_filepaths_stdin(self):
+        stdin = StringIO.StringIO('%s\n\n%s\n' % (self.path('311011.csv'),
+                                                  self.path('sub')))
+        assert_equal(list(iter_filepaths(['-'], stdin)),
+                     [self.path('311011.csv'),
+                      self.path('sub', 'August-2010.xls'),
+                      self.path('sub', 'jobs.xml')])
+
+    def test_sniff_files(self):
+        results = list(sniff_files(iter_filepaths([self.tmp_dir], None)))
+        assert_equal([(result['format'], result['container'])
+                      for result in results],
+                     [('CSV', None), ('XLS', None), ('XML', None)])
+        assert results[0]['seconds'] >= 0
+
+    def test_sniff_files_in_pool(self):
+        pool = multiprocessing.Pool(2)
+        try:
+            results = list(sniff_files(iter_filepaths([self.tmp_dir], None),
+                                       pool))
+        finally:
+            pool.terminate()
+        assert_equal(sorted((os.path.basename(result['path']),
+                             result['format']) for result in results),
+                     [('311011.csv', 'CSV'), ('August-2010.xls', 'XLS'),
+                      ('jobs.xml', 'XML')])
+
+    def test_sniff_missing_file(self):
+        results = list(sniff_files([self.path('missing.csv')]))
+        assert_equal(results[0]['format'], None)
+        assert 'error' in results[0], results
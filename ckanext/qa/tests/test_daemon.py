@@ -0,0 +1,81 @@
+import datetime
+
+from nose.tools import assert_equal
+from pylons import config
+from ckan import model
+try:
+    from ckan.tests.helpers import reset_db
+    from ckan.tests import factories as ckan_factories
+except ImportError:
+    from ckan.new_tests.helpers import reset_db
+    from ckan.new_tests import factories as ckan_factories
+
+from ckanext.qa import daemon
+from ckanext.qa import model as qa_model
+from ckanext.archiver import model as archiver_model
+from ckanext.archiver.model import Archival
+
+
+class TestDaemon(object):
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def setup(self):
+        self.original_config = dict(config)
+        config['qa.daemon.delay'] = '0'
+
+    def teardown(self):
+        config.clear()
+        config.update(self.original_config)
+
+    def _archive(self, resource_id, updated):
+        archival = Archival.create(resource_id)
+        archival.updated = updated
+        model.Session.add(archival)
+        model.Session.commit()
+
+    def test_scores_archived_resources(self):
+        dataset = ckan_factories.Dataset(resources=[
+            {'url': 'http://example.com/1.csv'}])
+        resource_id = dataset['resources'][0]['id']
+        updated = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        self._archive(resource_id, updated)
+
+        daemon.run(once=True)
+
+        qa = qa_model.QA.get_for_resource(resource_id)
+        assert qa
+        assert_equal(qa.package_id, dataset['id'])
+        watermark = qa_model.Watermark.get('archival')
+        assert_equal((watermark.timestamp, watermark.key),
+                     (updated, resource_id))
+
+        # when run again, it has nothing to do
+        scored = []
+        score = daemon.score
+        daemon.score = lambda resource_ids, pool=None: \
+            scored.append(resource_ids) or []
+        try:
+            daemon.run(once=True)
+        finally:
+            daemon.score = score
+        assert_equal(scored, [])
+
+    def test_read_changes_with_the_same_time(self):
+        updated = datetime.datetime(2016, 1, 1)
+        resource_ids = sorted(
+            ckan_factories.Resource()['id'] for i in range(3))
+        for resource_id in resource_ids:
+            self._archive(resource_id, updated)
+        until = datetime.datetime(2016, 1, 2)
+        start = (datetime.datetime(2015, 1, 1), u'')
+
+        changes = daemon.read_changes('archival', start, until, limit=2)
+        assert_equal(changes, [(updated, resource_ids[0]),
+                               (updated, resource_ids[1])])
+        changes = daemon.read_changes('archival', changes[-1], until,
+                                      limit=2)
+        assert_equal(changes, [(updated, resource_ids[2])])
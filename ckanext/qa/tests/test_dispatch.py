@@ -0,0 +1,141 @@
+from nose.tools import assert_equal
+from pylons import config
+from ckan import model
+try:
+    from ckan.tests.helpers import reset_db
+    from ckan.tests import factories as ckan_factories
+except ImportError:
+    from ckan.new_tests.helpers import reset_db
+    from ckan.new_tests import factories as ckan_factories
+
+from ckanext.qa import dispatch
+from ckanext.qa import lib
+from ckanext.qa import model as qa_model
+from ckanext.qa.model import PendingTask
+from ckanext.archiver import model as archiver_model
+
+
+class TestDispatch(object):
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def setup(self):
+        self.original_config = dict(config)
+        config['qa.dispatch.max_queue_length'] = '10'
+        config.pop('qa.shards', None)
+        dispatch._queue_lengths = None
+        self.broker_lengths = {}
+        self.queued = []
+        self._broker_queue_length = dispatch.broker_queue_length
+        self._create_task = lib.create_qa_update_package_task
+        dispatch.broker_queue_length = self.broker_lengths.get
+        lib.create_qa_update_package_task = \
+            lambda package, queue: self.queued.append((package.name, queue))
+        for pending in model.Session.query(PendingTask):
+            model.Session.delete(pending)
+        model.Session.commit()
+
+    def teardown(self):
+        dispatch.broker_queue_length = self._broker_queue_length
+        lib.create_qa_update_package_task = self._create_task
+        config.clear()
+        config.update(self.original_config)
+
+    def test_queued_when_room(self):
+        self.broker_lengths['bulk'] = 9
+        dataset = ckan_factories.Dataset()
+
+        queued = dispatch.dispatch_package_task(
+            model.Package.get(dataset['id']), 'bulk')
+
+        assert queued
+        assert_equal(self.queued, [(dataset['name'], 'bulk')])
+        assert_equal(PendingTask.count(), 0)
+
+    def test_pending_when_full(self):
+        self.broker_lengths['bulk'] = 9
+        dataset1 = ckan_factories.Dataset()
+        dataset2 = ckan_factories.Dataset()
+
+        for dataset in (dataset1, dataset2, dataset2):
+            dispatch.dispatch_package_task(
+                model.Package.get(dataset['id']), 'bulk')
+
+        # the first fills the queue (going by the tasks sent)
+        assert_equal(self.queued, [(dataset1['name'], 'bulk')])
+        assert_equal([pending.package_id
+                      for pending in PendingTask.get_next(10)],
+                     [dataset2['id']])
+
+    def test_queued_when_room_again(self):
+        self.broker_lengths['bulk'] = 10
+        dataset = ckan_factories.Dataset()
+        package = model.Package.get(dataset['id'])
+        dispatch.dispatch_package_task(package, 'bulk')
+        assert_equal(PendingTask.count(), 1)
+
+        dispatch._queue_lengths = None
+        self.broker_lengths['bulk'] = 0
+        dispatch.dispatch_package_task(package, 'bulk')
+
+        assert_equal(self.queued, [(dataset['name'], 'bulk')])
+        assert_equal(PendingTask.count(), 0)
+
+    def test_no_pending_when_disabled(self):
+        config['qa.dispatch.max_queue_length'] = '0'
+        self.broker_lengths['bulk'] = 1000000
+        dataset = ckan_factories.Dataset()
+        pending_checks = []
+        any_pending = PendingTask.any
+        PendingTask.any = classmethod(lambda cls: pending_checks.append(1))
+        try:
+            queued = dispatch.dispatch_package_task(
+                model.Package.get(dataset['id']), 'bulk')
+        finally:
+            PendingTask.any = any_pending
+
+        assert queued
+        assert_equal(self.queued, [(dataset['name'], 'bulk')])
+        assert_equal(pending_checks, [])
+        assert_equal(PendingTask.count(), 0)
+
+    def test_session_left_alone(self):
+        self.broker_lengths['bulk'] = 10
+        dataset = ckan_factories.Dataset()
+        package = model.Package.get(dataset['id'])
+        package.title = u'Changed by the archiver'
+
+        dispatch.dispatch_package_task(package, 'bulk')
+
+        assert package in model.Session.dirty
+        model.Session.rollback()
+
+    def test_unknown_queue_length(self):
+        dataset = ckan_factories.Dataset()
+
+        assert dispatch.dispatch_package_task(
+            model.Package.get(dataset['id']), 'bulk')
+
+    def test_drain(self):
+        self.broker_lengths['bulk'] = 100
+        self.broker_lengths['priority'] = 9
+        datasets = [ckan_factories.Dataset() for i in range(3)]
+        for dataset, queue in zip(datasets, ('bulk', 'priority', 'priority')):
+            dispatch.dispatch_package_task(
+                model.Package.get(dataset['id']), queue)
+        assert_equal(self.queued, [(datasets[1]['name'], 'priority')])
+        self.queued[:] = []
+
+        # the broker has caught up with the priority queue
+        dispatch._queue_lengths = None
+        self.broker_lengths['priority'] = 0
+        num_queued = dispatch.drain_pending_tasks(10)
+
+        assert_equal(num_queued, 1)
+        assert_equal(self.queued, [(datasets[2]['name'], 'priority')])
+        assert_equal([pending.package_id
+                      for pending in PendingTask.get_next(10)],
+                     [datasets[0]['id']])
@@ -0,0 +1,65 @@
+from nose.tools import assert_equal
+
+from ckanext.qa import helpers
+
+
+class TestOpennessStarsHtml(object):
+    def setup(self):
+        self.renders = []
+        self._render = helpers.tk.render
+        self._get_lang = helpers.i18n.get_lang
+        helpers.tk.render = self.render
+        helpers.i18n.get_lang = lambda: 'en'
+        helpers.stars_cache().clear()
+
+    def teardown(self):
+        helpers.tk.render = self._render
+        helpers.i18n.get_lang = self._get_lang
+
+    def render(self, template, extra_vars):
+        self.renders.append((template, extra_vars))
+        return '%s %s' % (template, extra_vars['openness_score'])
+
+    def qa(self, **kwargs):
+        qa = {'openness_score': 3,
+              'openness_score_reason': u'Detected as CSV',
+              'format': 'CSV',
+              'updated': '2015-11-19T16:54:49.436434'}
+        qa.update(kwargs)
+        return qa
+
+    def test_renders_only_fields_used(self):
+        html = helpers.qa_openness_stars_resource_html({'qa': self.qa()})
+
+        assert_equal(html, 'qa/openness_stars.html 3')
+        assert_equal(self.renders, [
+            ('qa/openness_stars.html',
+             {'openness_score': 3,
+              'openness_score_reason': u'Detected as CSV',
+              'updated': '2015-11-19T16:54:49.436434'})])
+
+    def test_rendered_once_for_same_qa(self):
+        for i in range(3):
+            helpers.qa_openness_stars_resource_html({'qa': self.qa()})
+        helpers.qa_openness_stars_dataset_html({'qa': self.qa()})
+
+        assert_equal([template for template, extra_vars in self.renders],
+                     ['qa/openness_stars.html',
+                      'qa/openness_stars_brief.html'])
+
+    def test_rendered_again_for_different_qa(self):
+        helpers.qa_openness_stars_resource_html({'qa': self.qa()})
+        helpers.qa_openness_stars_resource_html(
+            {'qa': self.qa(openness_score_reason=u'Detected as JSON')})
+        helpers.qa_openness_stars_resource_html(
+            {'qa': self.qa(updated='2015-11-20T10:00:00')})
+        helpers.i18n.get_lang = lambda: 'fr'
+        helpers.qa_openness_stars_resource_html({'qa': self.qa()})
+
+        assert_equal(len(self.renders), 4)
+
+    def test_no_qa(self):
+        html = helpers.qa_openness_stars_resource_html({})
+
+        assert_equal(html, '<!-- No qa info for this resource -->')
+        assert_equal(self.renders, [])
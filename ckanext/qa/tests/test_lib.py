@@ -0,0 +1,249 @@
+import os
+import json
+import shutil
+import tempfile
+import time
+
+from nose.tools import assert_equal
+from pylons import config
+
+from ckanext.qa import lib
+from ckanext.qa.lib import FormatIndex, ResourceFormat
+
+
+class TestFormatIndex:
+    @classmethod
+    def setup_class(cls):
+        # in the form returned by ckan's resource_formats()
+        csv = ['text/csv', 'CSV', 'Comma Separated Values File']
+        xls = ['application/vnd.ms-excel', 'XLS', 'MS Excel File']
+        atom = ['application/atom+xml', 'Atom Feed', 'Atom Feed']
+        resource_formats = {
+            'text/csv': csv, 'csv': csv, 'comma separated values file': csv,
+            'application/vnd.ms-excel': xls, 'xls': xls,
+            'ms excel file': xls, 'excel': xls,
+            'application/atom+xml': atom, 'atom feed': atom,
+            }
+        scores = {'CSV': 3, 'Atom Feed': 3, 'GTFS': 3}
+        cls.index = FormatIndex(resource_formats, scores)
+
+    def test_get_by_extension(self):
+        assert_equal(self.index.get('csv'),
+                     ResourceFormat('CSV', 'Comma Separated Values File',
+                                    'text/csv', 3))
+
+    def test_get_by_mimetype(self):
+        assert_equal(self.index.get('application/vnd.ms-excel').name, 'XLS')
+
+    def test_get_by_alternative_name(self):
+        assert_equal(self.index.get('Excel').name, 'XLS')
+
+    def test_get_is_case_insensitive(self):
+        assert_equal(self.index.get('Atom Feed').name, 'Atom Feed')
+
+    def test_get_unknown(self):
+        assert_equal(self.index.get('zar'), None)
+
+    def test_get_munged(self):
+        assert_equal(self.index.get('.CSV '), None)
+        assert_equal(self.index.get('.CSV ', munge=True).name, 'CSV')
+
+    def test_score_is_none_when_not_configured(self):
+        assert_equal(self.index.get('xls').score, None)
+
+    def test_score_by_name(self):
+        assert_equal(self.index.score('Atom Feed'), 3)
+        # formats can be scored without being in resource_formats()
+        assert_equal(self.index.score('GTFS'), 3)
+        assert_equal(self.index.score('XLS'), None)
+
+
+class TestResourceFormatScoresReload:
+    @classmethod
+    def setup_class(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.json_filepath = os.path.join(cls.tmp_dir, 'scores.json')
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def setup(self):
+        self.original_config = dict(config)
+        config['qa.resource_format_openness_scores_json'] = self.json_filepath
+        config['qa.resource_format_openness_scores_check_interval'] = '0'
+        lib._RESOURCE_FORMAT_SCORES = None
+        lib._RESOURCE_FORMAT_SCORES_VERSION = None
+        lib._resource_format_scores_file = None
+
+    def teardown(self):
+        config.clear()
+        config.update(self.original_config)
+        lib._RESOURCE_FORMAT_SCORES = None
+        lib._RESOURCE_FORMAT_SCORES_VERSION = None
+        lib._resource_format_scores_file = None
+
+    def _write_scores(self, scores, mtime):
+        with open(self.json_filepath, 'w') as f:
+            f.write(json.dumps([['_comment', 'test']] + scores))
+        os.utime(self.json_filepath, (mtime, mtime))
+
+    def test_reload_when_changed(self):
+        self._write_scores([['CSV', 3]], mtime=1000)
+        assert_equal(lib.resource_format_scores(), {'CSV': 3})
+        version = lib.resource_format_scores_version()
+
+        self._write_scores([['CSV', 4]], mtime=2000)
+        assert_equal(lib.resource_format_scores(), {'CSV': 4})
+        assert lib.resource_format_scores_version() != version
+
+    def test_unchanged_content_keeps_version(self):
+        self._write_scores([['CSV', 3]], mtime=1000)
+        scores = lib.resource_format_scores()
+        version = lib.resource_format_scores_version()
+
+        self._write_scores([['CSV', 3]], mtime=2000)
+        assert lib.resource_format_scores() is scores
+        assert_equal(lib.resource_format_scores_version(), version)
+
+    def test_invalid_file_keeps_scores(self):
+        self._write_scores([['CSV', 3]], mtime=1000)
+        scores = lib.resource_format_scores()
+        version = lib.resource_format_scores_version()
+
+        with open(self.json_filepath, 'w') as f:
+            f.write('[["CSV", 4')
+        os.utime(self.json_filepath, (2000, 2000))
+        assert lib.resource_format_scores() is scores
+        assert_equal(lib.resource_format_scores_version(), version)
+
+        self._write_scores([['CSV', 4]], mtime=3000)
+        assert_equal(lib.resource_format_scores(), {'CSV': 4})
+
+    def test_not_checked_within_interval(self):
+        config['qa.resource_format_openness_scores_check_interval'] = '3600'
+        self._write_scores([['CSV', 3]], mtime=1000)
+        assert_equal(lib.resource_format_scores(), {'CSV': 3})
+
+        self._write_scores([['CSV', 4]], mtime=2000)
+        assert_equal(lib.resource_format_scores(), {'CSV': 3})
+
+    def test_format_index_follows_reload(self):
+        self._write_scores([['CSV', 3]], mtime=1000)
+        index = lib.FormatIndex({}, lib.resource_format_scores())
+        assert_equal(index.score('CSV'), 3)
+        self._write_scores([['CSV', 4]], mtime=2000)
+        assert lib.resource_format_scores() is not index.scores
+
+
+def test_changed_format_scores():
+    assert_equal(lib.changed_format_scores({'CSV': 3, 'XLS': 2, 'PDF': 1},
+                                           {'CSV': 3, 'XLS': 3, 'TTL': 5}),
+                 set(['XLS', 'PDF', 'TTL']))
+
+
+class TestLRUCache:
+    def make_cache(self, max_size):
+        return lib.LRUCache(max_size)
+
+    def test_get_and_set(self):
+        cache = self.make_cache(10)
+        assert_equal(cache.get('a'), None)
+        cache.set('a', {'x': 1})
+        assert_equal(cache.get('a'), {'x': 1})
+        assert_equal(cache.get('b', 'default'), 'default')
+
+    def test_least_recently_used_is_evicted(self):
+        cache = self.make_cache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert_equal(len(cache), 2)
+        assert_equal(cache.get('a'), 1)
+        assert_equal(cache.get('b'), None)
+        assert_equal(cache.get('c'), 3)
+
+    def test_ttl(self):
+        cache = self.make_cache(10)
+        cache.set('a', 1, ttl=0.05)
+        cache.set('b', 2)
+        assert_equal(cache.get('a'), 1)
+        time.sleep(0.1)
+        assert_equal(cache.get('a'), None)
+        assert_equal(cache.get('b'), 2)
+
+    def test_clear(self):
+        cache = self.make_cache(10)
+        cache.set('a', 1)
+        cache.clear()
+        assert_equal(cache.get('a'), None)
+
+
+class TestSqliteCache(TestLRUCache):
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_cache(self, max_size):
+        return lib.SqliteCache(os.path.join(self.tmp_dir, 'cache.sqlite'),
+                               max_size)
+
+    def test_shared_by_instances(self):
+        self.make_cache(10).set('a', [1, 2])
+        assert_equal(self.make_cache(10).get('a'), [1, 2])
+
+    def test_unusable_file_is_a_miss(self):
+        cache = self.make_cache(10)
+        cache.filepath = os.path.join(self.tmp_dir, 'missing', 'cache.sqlite')
+        cache.set('a', 1)
+        assert_equal(cache.get('a'), None)
+
+
+class TestHashRing:
+    keys = ['%08x-dataset' % i for i in range(2000)]
+
+    def assignments(self, ring):
+        return dict((key, ring.get(key)) for key in self.keys)
+
+    def test_all_shards_used(self):
+        ring = lib.HashRing(['node1', 'node2', 'node3'])
+        counts = {}
+        for shard in self.assignments(ring).values():
+            counts[shard] = counts.get(shard, 0) + 1
+        assert_equal(sorted(counts), ['node1', 'node2', 'node3'])
+        # roughly a third each
+        assert min(counts.values()) > len(self.keys) / 5, counts
+
+    def test_adding_a_shard_moves_few_keys(self):
+        before = self.assignments(lib.HashRing(['node1', 'node2', 'node3']))
+        after = self.assignments(lib.HashRing(['node1', 'node2', 'node3',
+                                               'node4']))
+        moved = [key for key in self.keys if before[key] != after[key]]
+        # about a quarter should move, and only to the new shard
+        assert len(moved) < len(self.keys) * 0.35, len(moved)
+        assert_equal(set(after[key] for key in moved), set(['node4']))
+
+    def test_no_shards(self):
+        assert_equal(lib.HashRing([]).get('dataset'), None)
+
+
+class TestShardQueue:
+    def setup(self):
+        self.original_config = dict(config)
+
+    def teardown(self):
+        config.clear()
+        config.update(self.original_config)
+
+    def test_not_sharded(self):
+        config.pop('qa.shards', None)
+        assert_equal(lib.shard_queue('bulk', 'dataset'), 'bulk')
+
+    def test_sharded(self):
+        config['qa.shards'] = 'node1 node2'
+        ring = lib.HashRing(['node1', 'node2'])
+        assert_equal(lib.shard_queue('bulk', 'dataset'),
+                     'bulk-%s' % ring.get('dataset'))
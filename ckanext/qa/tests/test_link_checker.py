@@ -1,6 +1,9 @@
 import logging
 from functools import wraps
+import datetime
 import json
+import threading
+import time
 from urllib import urlencode
 try:
     from ckan.tests.helpers import reset_db, assert_in
@@ -13,6 +16,7 @@ except ImportError:
     from ckan.tests import BaseCase, url_for, CreateTestData, assert_in
     from ckan.tests import TestController as ControllerTestCase
 from nose.tools import assert_raises, assert_equal
+from ckan import model
 
 from ckanext.archiver.tasks import (update_package,
                                     download,
@@ -22,8 +26,20 @@ from ckanext.archiver.tasks import (update_package,
                                     LinkCheckerError,
                                     CkanError,
                                    )
+from ckanext.archiver import model as archiver_model
+from ckanext.archiver.model import Archival
+from ckanext.qa import model as qa_model
+from ckanext.qa.model import QA
 
-from mock_remote_server import MockEchoTestServer
+from ckanext.qa.controllers import (check_concurrently,
+                                    link_check_cache,
+                                    normalise_url,
+                                    url_host,
+                                    LinkCheckerController,
+                                    LINK_CHECKER_DEADLINE_ERROR,
+                                    LINK_CHECKER_ERROR,
+                                    )
+from mock_remote_server import MockEchoTestServer, MockTimeoutTestServer
 
 # enable celery logging for when you run nosetests -s
 log = logging.getLogger('ckanext.archiver.tasks')
@@ -48,10 +64,18 @@ class TestLinkChecker(ControllerTestCase):
     """
     Tests for link checker task
     """
+    def setup(self):
+        link_check_cache().clear()
+
     def check_link(self, url):
         result = self.app.get('/qa/link_checker?%s' % urlencode({'url': url}))
         return json.loads(result.body)[0]
 
+    def check_links(self, urls):
+        result = self.app.get('/qa/link_checker?%s' %
+                              urlencode([('url', url) for url in urls]))
+        return json.loads(result.body)
+
     @with_mock_url('?status=200')
     def test_url_working_but_formatless(self, url):
         result = self.check_link(url)
@@ -136,3 +160,221 @@ class TestLinkChecker(ControllerTestCase):
         result = self.check_link(url)
         print result
         assert_equal(result['url_errors'], [])
+
+    def test_multiple_urls_in_order(self):
+        with MockEchoTestServer().serve() as serveraddr:
+            urls = ['%s/file.csv' % serveraddr,
+                    '%s/?status=404' % serveraddr,
+                    '%s/file.txt' % serveraddr,
+                    '%s/?status=200;content-type=text/csv' % serveraddr]
+            results = self.check_links(urls)
+        assert_equal([result['format'] for result in results],
+                     ['CSV', '', 'TXT', 'CSV'])
+        assert_equal(results[1]['url_errors'],
+                     ['Server returned HTTP error status: 404 Not Found'])
+
+    def test_deadline_returns_partial_results(self):
+        from pylons import config
+        config['qa.link_checker.deadline'] = '0.5'
+        try:
+            with MockEchoTestServer().serve() as echo_addr:
+                with MockTimeoutTestServer(3).serve() as slow_addr:
+                    start = time.time()
+                    results = self.check_links(['%s/file.csv' % echo_addr,
+                                                '%s/file.txt' % slow_addr])
+                    duration = time.time() - start
+        finally:
+            del config['qa.link_checker.deadline']
+        assert duration < 2.5, duration
+        assert_equal(results[0]['format'], 'CSV')
+        assert_equal(results[0]['url_errors'], [])
+        assert_equal(results[1]['url_errors'], [LINK_CHECKER_DEADLINE_ERROR])
+
+    def test_exception_is_not_a_timeout(self):
+        def check_link_uncached(self, url):
+            raise ValueError('Bad url')
+        original = LinkCheckerController._check_link_uncached
+        LinkCheckerController._check_link_uncached = check_link_uncached
+        try:
+            result = self.check_link('http://example.com/file.csv')
+        finally:
+            LinkCheckerController._check_link_uncached = original
+        assert_equal(result['url_errors'], [LINK_CHECKER_ERROR % 'Bad url'])
+
+    def test_result_is_cached(self):
+        with MockEchoTestServer().serve() as serveraddr:
+            url = '%s/file.csv' % serveraddr
+            result = self.check_link(url)
+        assert_equal(result['format'], 'CSV')
+        # the server has stopped, so this comes from the cache
+        assert_equal(self.check_link(' %s#top' % url), result)
+
+    def test_error_is_cached_for_less_time(self):
+        from pylons import config
+        config['qa.link_checker.cache_error_ttl'] = '0'
+        try:
+            with MockEchoTestServer().serve() as serveraddr:
+                url = '%s/file.csv?status=503' % serveraddr
+                self.check_link(url)
+                assert_equal(len(link_check_cache()), 0)
+                self.check_link('%s/file.csv' % serveraddr)
+                assert_equal(len(link_check_cache()), 1)
+        finally:
+            del config['qa.link_checker.cache_error_ttl']
+
+
+class TestLinkCheckerArchival(ControllerTestCase):
+    """
+    Tests for taking link checker results from the archival of a resource
+    """
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def setup(self):
+        link_check_cache().clear()
+
+    def check_link(self, url):
+        result = self.app.get('/qa/link_checker?%s' % urlencode({'url': url}))
+        return json.loads(result.body)[0]
+
+    def _archived_resource(self, url, archived_ago, qa_format=None):
+        dataset = ckan_factories.Dataset(resources=[{'url': url}])
+        res_id = dataset['resources'][0]['id']
+        archival = Archival.create(res_id)
+        archival.is_broken = False
+        archival.updated = datetime.datetime.now() - archived_ago
+        archival.mimetype = u'text/csv'
+        archival.size = 1234
+        model.Session.add(archival)
+        if qa_format:
+            qa = QA.create(res_id)
+            qa.format = qa_format
+            qa.archival_timestamp = archival.updated
+            model.Session.add(qa)
+        model.Session.commit()
+
+    def test_recent_archival_is_used(self):
+        # nothing is listening at this url
+        url = 'http://localhost:1/data.xls'
+        self._archived_resource(url, datetime.timedelta(hours=1),
+                                qa_format=u'CSV')
+        result = self.check_link(url)
+        assert_equal(result['url_errors'], [])
+        assert_equal(result['format'], 'CSV')
+        assert_equal(result['mimetype'], 'text/csv')
+        assert_equal(result['size'], '1234')
+
+    def test_format_from_mimetype_without_qa(self):
+        url = 'http://localhost:1/data'
+        self._archived_resource(url, datetime.timedelta(hours=1))
+        result = self.check_link(url)
+        assert_equal(result['format'], 'CSV')
+
+    def test_old_archival_is_not_used(self):
+        url = 'http://localhost:1/old.csv'
+        self._archived_resource(url, datetime.timedelta(days=30),
+                                qa_format=u'CSV')
+        result = self.check_link(url)
+        assert result['url_errors'], result
+
+
+class TestCheckConcurrently(object):
+    def test_results_in_order(self):
+        def slow_square(x):
+            time.sleep(0.01 * (5 - x))
+            return x * x
+        assert_equal(check_concurrently(slow_square, range(5), max_workers=5),
+                     [0, 1, 4, 9, 16])
+
+    def test_empty(self):
+        assert_equal(check_concurrently(len, []), [])
+
+    def test_max_workers(self):
+        running = []
+        lock = threading.Lock()
+        def record(x):
+            with lock:
+                running.append(1)
+                max_running[0] = max(max_running[0], len(running))
+            time.sleep(0.02)
+            with lock:
+                running.pop()
+            return x
+        max_running = [0]
+        assert_equal(check_concurrently(record, range(10), max_workers=3),
+                     range(10))
+        assert_equal(max_running[0], 3)
+
+    def test_max_per_key(self):
+        running = {}
+        max_running = {}
+        lock = threading.Lock()
+        def record(url):
+            host = url_host(url)
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                max_running[host] = max(max_running.get(host, 0),
+                                        running[host])
+            time.sleep(0.02)
+            with lock:
+                running[host] -= 1
+            return url
+        urls = ['http://a.com/%s' % i for i in range(6)] + \
+               ['b.com/%s' % i for i in range(6)]
+        results = check_concurrently(record, urls, key=url_host,
+                                     max_workers=6, max_per_key=2)
+        assert_equal(results, urls)
+        assert_equal(max_running, {'a.com': 2, 'b.com': 2})
+
+    def test_timeout_gives_partial_results(self):
+        def sleep(seconds):
+            time.sleep(seconds)
+            return seconds
+        start = time.time()
+        results = check_concurrently(sleep, [0, 2, 0], max_workers=3,
+                                     timeout=0.2)
+        assert time.time() - start < 1
+        assert_equal(results, [0, None, 0])
+
+    def test_timeout_drops_calls_not_started(self):
+        started = []
+        def sleep(seconds):
+            started.append(seconds)
+            time.sleep(seconds)
+            return seconds
+        results = check_concurrently(sleep, [0.3, 0, 0], max_workers=1,
+                                     timeout=0.1)
+        assert_equal(results, [None, None, None])
+        time.sleep(0.5)
+        assert_equal(started, [0.3])
+
+    def test_exception_gives_none(self):
+        def check(x):
+            if x == 1:
+                raise ValueError('bad')
+            return x
+        assert_equal(check_concurrently(check, [0, 1, 2]), [0, None, 2])
+
+    def test_on_error(self):
+        def check(x):
+            if x == 1:
+                raise ValueError('bad')
+            return x
+        on_error = lambda arg, e: 'Error with %s: %s' % (arg, e)
+        assert_equal(check_concurrently(check, [0, 1, 2], on_error=on_error),
+                     [0, 'Error with 1: bad', 2])
+
+
+def test_url_host():
+    assert_equal(url_host('http://Example.com:8080/a.csv'), 'example.com:8080')
+    assert_equal(url_host('www.example.com/a.csv'), 'www.example.com')
+
+
+def test_normalise_url():
+    assert_equal(normalise_url(' HTTP://Example.com/A.csv?x=Y#top '),
+                 'http://example.com/A.csv?x=Y')
+    assert_equal(normalise_url('www.example.com/a.csv'),
+                 'http://www.example.com/a.csv')
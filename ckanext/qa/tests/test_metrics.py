@@ -0,0 +1,242 @@
+import os
+import time
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+from pylons import config
+
+from ckanext.qa import metrics
+from ckanext.qa.metrics import (Registry, tracing, current_trace, stage,
+                                summarise_verdict)
+
+
+@stage('test.detector')
+def detector(buf, log):
+    return 'csv' in buf
+
+
+@stage('test.scorer', reads=None)
+def scorer(resource, log):
+    return (3, 'CSV')
+
+
+class TestTracing:
+    def test_stage_is_recorded(self):
+        with tracing() as trace:
+            assert current_trace() is trace
+            detector('a,csv,file', None)
+            scorer(None, None)
+        assert_equal(current_trace(), None)
+        stages = trace.as_list()
+        assert_equal([stage_['stage'] for stage_ in stages],
+                     ['test.detector', 'test.scorer'])
+        assert_equal(stages[0]['bytes_read'], 10)
+        assert_equal(stages[0]['verdict'], True)
+        assert 'bytes_read' not in stages[1]
+        assert_equal(stages[1]['verdict'], 'CSV:3')
+        assert stages[0]['seconds'] >= 0
+
+    def test_not_recorded_without_trace(self):
+        assert_equal(detector('abc', None), False)
+        assert_equal(current_trace(), None)
+
+    def test_nested_trace_is_separate(self):
+        with tracing() as outer:
+            with tracing() as inner:
+                detector('abc', None)
+            assert current_trace() is outer
+        assert_equal(len(inner.stages), 1)
+        assert_equal(len(outer.stages), 0)
+
+
+def test_summarise_verdict():
+    assert_equal(summarise_verdict({'format': 'CSV', 'container': 'ZIP'}),
+                 'CSV')
+    assert_equal(summarise_verdict((None, None)), None)
+    assert_equal(summarise_verdict((0, 'CSV')), 'CSV:0')
+    assert_equal(summarise_verdict(False), False)
+    assert_equal(summarise_verdict(None), None)
+
+
+class TestRegistry:
+    def test_counter(self):
+        registry = Registry()
+        registry.increment('stage_total', labels={'stage': 'a'})
+        registry.increment('stage_total', 2, labels={'stage': 'a'})
+        registry.increment('stage_total', labels={'stage': 'b'})
+        assert_equal(registry.counters[('stage_total', (('stage', 'a'),))], 3)
+        assert_equal(registry.counters[('stage_total', (('stage', 'b'),))], 1)
+
+    def test_prometheus_text(self):
+        registry = Registry()
+        registry.increment('stage_total', labels={'stage': 'is_csv',
+                                                  'outcome': 'hit'})
+        registry.observe('stage_seconds', 0.003, labels={'stage': 'is_csv'})
+        registry.observe('stage_seconds', 2, labels={'stage': 'is_csv'})
+        lines = registry.prometheus_text().splitlines()
+        assert '# TYPE ckanext_qa_stage_total counter' in lines
+        assert 'ckanext_qa_stage_total{outcome="hit",stage="is_csv"} 1' \
+            in lines
+        assert '# TYPE ckanext_qa_stage_seconds histogram' in lines
+        assert 'ckanext_qa_stage_seconds_bucket{stage="is_csv",le="0.001"} 0' \
+            in lines
+        assert 'ckanext_qa_stage_seconds_bucket{stage="is_csv",le="0.005"} 1' \
+            in lines
+        assert 'ckanext_qa_stage_seconds_bucket{stage="is_csv",le="+Inf"} 2' \
+            in lines
+        assert 'ckanext_qa_stage_seconds_count{stage="is_csv"} 2' in lines
+
+
+class TestRecordTrace:
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.original_config = dict(config)
+        self.original_registry = metrics.registry
+        metrics.registry = Registry()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+        config.clear()
+        config.update(self.original_config)
+        metrics.configure()
+        metrics.registry = self.original_registry
+
+    def test_prometheus_textfile(self):
+        config['qa.metrics.prometheus_textfile'] = \
+            os.path.join(self.tmp_dir, 'qa-{pid}.prom')
+        metrics.configure()
+        with tracing() as trace:
+            detector('a,csv', None)
+            detector('abc', None)
+        metrics.record_trace(trace)
+        filepath = os.path.join(self.tmp_dir, 'qa-%s.prom' % os.getpid())
+        with open(filepath) as f:
+            lines = f.read().splitlines()
+        assert 'ckanext_qa_stage_total{outcome="hit",stage="test.detector"} 1' \
+            in lines, lines
+        assert 'ckanext_qa_stage_total{outcome="miss",stage="test.detector"} 1' \
+            in lines, lines
+        assert 'ckanext_qa_stage_bytes_read_total{stage="test.detector"} 8' \
+            in lines, lines
+
+    def test_prometheus_textfile_is_throttled(self):
+        config['qa.metrics.prometheus_textfile'] = \
+            os.path.join(self.tmp_dir, 'qa-{pid}.prom')
+        metrics.configure()
+        filepath = os.path.join(self.tmp_dir, 'qa-%s.prom' % os.getpid())
+        for i in range(3):
+            with tracing() as trace:
+                detector('a,csv', None)
+            metrics.record_trace(trace)
+            if i == 0:
+                first_text = open(filepath).read()
+        assert_equal(open(filepath).read(), first_text)
+
+        metrics.sinks()[0].written -= 15
+        metrics.flush()
+        assert 'ckanext_qa_stage_total{outcome="hit",' \
+            'stage="test.detector"} 3' in open(filepath).read()
+
+    def test_sinks_are_kept(self):
+        config['qa.metrics.sinks'] = \
+            'ckanext.qa.tests.test_metrics:RecordingSink'
+        metrics.configure()
+        sinks = metrics.sinks()
+        del config['qa.metrics.sinks']
+        assert metrics.sinks() is sinks
+        assert_equal(metrics.configure(), [])
+
+
+class RecordingSink(metrics.Sink):
+    tasks = []
+
+    def __init__(self, config):
+        pass
+
+    def record_task(self, task_run):
+        self.tasks.append(task_run)
+
+
+class TestTaskRun:
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.original_config = dict(config)
+        RecordingSink.tasks = []
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+        config.clear()
+        config.update(self.original_config)
+        metrics.configure()
+
+    def test_spans_and_counts(self):
+        config['qa.metrics.sinks'] = \
+            'ckanext.qa.tests.test_metrics:RecordingSink'
+        metrics.configure()
+        with metrics.task_run('qa.update_package',
+                              queued_at=time.time() - 10) as run:
+            assert metrics.current_task_run() is run
+            with run.span('score'):
+                time.sleep(0.01)
+            run.increment('resources_scored')
+            run.increment('resources_scored')
+        assert_equal(metrics.current_task_run(), None)
+        assert_equal(len(RecordingSink.tasks), 1)
+        task_run = RecordingSink.tasks[0]
+        assert_equal(task_run['task'], 'qa.update_package')
+        assert_equal(task_run['outcome'], 'ok')
+        assert task_run['queue_wait'] >= 10, task_run
+        assert task_run['spans']['score'] >= 0.01, task_run
+        assert task_run['seconds'] >= task_run['spans']['score'], task_run
+        assert_equal(task_run['counts']['resources_scored'], 2)
+
+    def test_error(self):
+        config['qa.metrics.sinks'] = \
+            'ckanext.qa.tests.test_metrics:RecordingSink'
+        metrics.configure()
+        try:
+            with metrics.task_run('qa.update'):
+                raise ValueError()
+        except ValueError:
+            pass
+        assert_equal(RecordingSink.tasks[0]['outcome'], 'error')
+        assert_equal(RecordingSink.tasks[0]['queue_wait'], None)
+
+    def test_task_store(self):
+        filepath = os.path.join(self.tmp_dir, 'metrics.sqlite')
+        config['qa.metrics.task_store'] = filepath
+        metrics.configure()
+        with metrics.task_run('qa.update') as run:
+            run.increment('resources_scored')
+        runs = metrics.TaskStore(filepath).get_since(time.time() - 60)
+        assert_equal([run['task'] for run in runs], ['qa.update'])
+        assert_equal(metrics.TaskStore(filepath).get_since(time.time() + 60),
+                     [])
+
+
+def test_percentile():
+    assert_equal(metrics.percentile([], 0.5), None)
+    assert_equal(metrics.percentile([3, 1, 2], 0.5), 2)
+    assert_equal(metrics.percentile(range(1, 101), 0.95), 95)
+    assert_equal(metrics.percentile([5], 0.95), 5)
+
+
+def test_summarise_task_runs():
+    runs = [{'task': 'qa.update_package', 'started': 0, 'queue_wait': 2,
+             'seconds': 4, 'outcome': 'ok',
+             'spans': {'score': 3, 'index': 1},
+             'counts': {'resources_scored': 2}},
+            {'task': 'qa.update_package', 'started': 1, 'queue_wait': None,
+             'seconds': 6, 'outcome': 'error',
+             'spans': {'score': 5},
+             'counts': {'resources_scored': 1}},
+            ]
+    summary = metrics.summarise_task_runs(runs)['qa.update_package']
+    assert_equal(summary['runs'], 2)
+    assert_equal(summary['errors'], 1)
+    assert_equal(summary['queue_wait']['mean'], 2)
+    assert_equal(summary['seconds']['max'], 6)
+    assert_equal(summary['spans']['score']['total'], 8)
+    assert_equal(summary['spans']['score']['share'], 0.8)
+    assert_equal(summary['counts'], {'resources_scored': 3})
@@ -0,0 +1,233 @@
+import logging
+import datetime
+
+from nose.tools import assert_equal, assert_raises
+from ckan import model
+from ckan.plugins import toolkit
+try:
+    from ckan.tests.helpers import reset_db
+    from ckan.tests import factories as ckan_factories
+except ImportError:
+    from ckan.new_tests.helpers import reset_db
+    from ckan.new_tests import factories as ckan_factories
+
+import ckanext.qa.tasks
+from ckanext.qa import model as qa_model
+from ckanext.qa.logic import action
+from ckanext.archiver import model as archiver_model
+
+log = logging.getLogger(__name__)
+
+
+class TestPackageQA(object):
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def _save_qa(self, resource_id, score, updated_day):
+        resource = model.Resource.get(resource_id)
+        qa_result = {
+            'openness_score': score,
+            'openness_score_reason': 'Scores %s' % score,
+            'format': 'CSV',
+            'archival_timestamp': None,
+            }
+        qa = ckanext.qa.tasks.save_qa_result(resource, qa_result, log)
+        qa.updated = datetime.datetime(2016, 1, updated_day)
+        qa_model.update_package_qa(qa.package_id)
+        model.Session.commit()
+
+    def _dataset(self):
+        return ckan_factories.Dataset(resources=[
+            {'url': 'http://example.com/1.csv'},
+            {'url': 'http://example.com/2.csv'}])
+
+    def test_aggregated_when_saved(self):
+        dataset = self._dataset()
+        self._save_qa(dataset['resources'][0]['id'], 3, updated_day=2)
+        self._save_qa(dataset['resources'][1]['id'], 1, updated_day=5)
+
+        package_qa = qa_model.PackageQA.get(dataset['id'])
+        assert_equal(package_qa.as_dict(), {
+            'openness_score': 3,
+            'openness_score_reason': 'Scores 3',
+            'updated': '2016-01-05T00:00:00'})
+
+    def test_resource_deleted(self):
+        dataset = self._dataset()
+        self._save_qa(dataset['resources'][0]['id'], 3, updated_day=2)
+        self._save_qa(dataset['resources'][1]['id'], 1, updated_day=5)
+
+        model.Resource.get(dataset['resources'][0]['id']).state = 'deleted'
+        qa_model.update_package_qa(dataset['id'])
+        model.Session.commit()
+
+        package_qa = qa_model.PackageQA.get(dataset['id'])
+        assert_equal(package_qa.openness_score, 1)
+
+    def test_all_resources_deleted(self):
+        dataset = self._dataset()
+        self._save_qa(dataset['resources'][0]['id'], 3, updated_day=2)
+
+        for res in dataset['resources']:
+            model.Resource.get(res['id']).state = 'deleted'
+        qa_model.update_package_qa(dataset['id'])
+        model.Session.commit()
+
+        assert_equal(qa_model.PackageQA.get(dataset['id']), None)
+
+    def test_same_as_aggregate_qa_for_a_dataset(self):
+        dataset = self._dataset()
+        self._save_qa(dataset['resources'][0]['id'], 2, updated_day=8)
+        self._save_qa(dataset['resources'][1]['id'], 2, updated_day=3)
+
+        assert_equal(
+            qa_model.PackageQA.get(dataset['id']).as_dict(),
+            qa_model.aggregate_qa_for_a_dataset(
+                qa_model.QA.get_for_package(dataset['id'])))
+
+
+    def test_shown_without_package_qa(self):
+        # e.g. QA from before the table was populated
+        dataset = self._dataset()
+        self._save_qa(dataset['resources'][0]['id'], 3, updated_day=2)
+        model.Session.delete(qa_model.PackageQA.get(dataset['id']))
+        model.Session.commit()
+
+        dataset = toolkit.get_action('package_show')(
+            {'ignore_auth': True}, {'id': dataset['id']})
+        assert_equal(dataset['qa']['openness_score'], 3)
+        assert_equal(dataset['resources'][0]['qa']['openness_score'], 3)
+        assert_equal(
+            action.qa_package_openness_show(
+                {'model': model, 'session': model.Session,
+                 'ignore_auth': True},
+                {'id': dataset['id']})['openness_score'], 3)
+
+
+class TestQAHistory(object):
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def _save_qa(self, resource, score, format_='CSV', reason='Reason'):
+        qa_result = {
+            'openness_score': score,
+            'openness_score_reason': reason,
+            'format': format_,
+            'archival_timestamp': None,
+            }
+        return ckanext.qa.tasks.save_qa_result(resource, qa_result, log)
+
+    def test_only_changes_recorded(self):
+        resource_dict = ckan_factories.Resource()
+        resource = model.Resource.get(resource_dict['id'])
+
+        self._save_qa(resource, 3)
+        self._save_qa(resource, 3, reason='Another reason')
+        self._save_qa(resource, 3, format_='TSV')
+        self._save_qa(resource, 0)
+
+        history = qa_model.QAHistory.get_for_resource(resource.id)
+        assert_equal([(h.openness_score, h.format) for h in history],
+                     [(3, 'CSV'), (3, 'TSV'), (0, 'TSV')])
+
+    def test_bulk_save_records_changes(self):
+        resource_dict = ckan_factories.Resource()
+        resource = model.Resource.get(resource_dict['id'])
+        qa = self._save_qa(resource, 2, format_='XLS')
+        qa_result = {
+            'openness_score': 3,
+            'openness_score_reason': 'Reason',
+            'format': 'CSV',
+            'archival_timestamp': None,
+            }
+        for i in range(2):
+            ckanext.qa.tasks.save_qa_results_in_bulk(
+                [(resource.id, qa.package_id, qa_result)], log)
+
+        history = qa_model.QAHistory.get_for_resource(resource.id)
+        assert_equal([(h.openness_score, h.format) for h in history],
+                     [(2, 'XLS'), (3, 'CSV')])
+
+    def test_time_range(self):
+        resource_dict = ckan_factories.Resource()
+        resource = model.Resource.get(resource_dict['id'])
+        for day, score in ((1, 1), (2, 2), (3, 3)):
+            model.Session.add(qa_model.QAHistory(
+                resource_id=resource.id,
+                package_id=resource_dict['package_id'],
+                timestamp=datetime.datetime(2016, 1, day),
+                openness_score=score, format=u'CSV'))
+        model.Session.commit()
+
+        history = qa_model.QAHistory.get_for_package(
+            resource_dict['package_id'],
+            since=datetime.datetime(2016, 1, 2),
+            until=datetime.datetime(2016, 1, 3))
+        assert_equal([h.openness_score for h in history], [2])
+
+
+class TestQAChange(object):
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def _save_qa(self, resource, score, format_='CSV', reason='Reason'):
+        qa_result = {
+            'openness_score': score,
+            'openness_score_reason': reason,
+            'format': format_,
+            'archival_timestamp': None,
+            }
+        return ckanext.qa.tasks.save_qa_result(resource, qa_result, log)
+
+    def _changes_since(self, **data_dict):
+        context = {'model': model, 'session': model.Session,
+                   'ignore_auth': True}
+        return action.qa_changes_since(context, data_dict)
+
+    def test_changes_since(self):
+        cursor = self._changes_since()['cursor']
+        resource_dict = ckan_factories.Resource()
+        resource = model.Resource.get(resource_dict['id'])
+
+        self._save_qa(resource, 3)
+        self._save_qa(resource, 3)
+        self._save_qa(resource, 3, reason='Another reason')
+        self._save_qa(resource, 2, format_='XLS')
+
+        result = self._changes_since(cursor=cursor, limit=2)
+        assert_equal([(change['previous_openness_score'],
+                       change['openness_score'],
+                       change['openness_score_reason'])
+                      for change in result['changes']],
+                     [(None, 3, 'Reason'), (3, 3, 'Another reason')])
+        assert result['more']
+
+        result = self._changes_since(cursor=result['cursor'])
+        assert_equal([(change['previous_format'], change['format'])
+                      for change in result['changes']],
+                     [('CSV', 'XLS')])
+        assert not result['more']
+
+        result = self._changes_since(cursor=result['cursor'])
+        assert_equal(result['changes'], [])
+
+    def test_changes_since_is_for_sysadmins(self):
+        sysadmin = ckan_factories.Sysadmin()
+        user = ckan_factories.User()
+        for user_name in ('', user['name']):
+            context = {'model': model, 'session': model.Session,
+                       'user': user_name}
+            assert_raises(toolkit.NotAuthorized,
+                          action.qa_changes_since, context, {})
+        context = {'model': model, 'session': model.Session,
+                   'user': sysadmin['name']}
+        assert 'changes' in action.qa_changes_since(context, {})
@@ -0,0 +1,25 @@
+import datetime
+
+from nose.tools import assert_equal
+
+from ckanext.qa.reports import score_counts_by_month
+
+
+def test_score_counts_by_month():
+    history = [
+        ('dataset1', 'res1', datetime.datetime(2015, 12, 5), 3),
+        ('dataset1', 'res2', datetime.datetime(2016, 1, 5), 1),
+        ('dataset2', 'res3', datetime.datetime(2016, 2, 10), 2),
+        ('dataset1', 'res1', datetime.datetime(2016, 2, 11), 0),
+        ]
+    month_ends = [datetime.datetime(2016, 2, 1),
+                  datetime.datetime(2016, 3, 1),
+                  datetime.datetime(2016, 4, 1)]
+
+    counts = score_counts_by_month(history, month_ends)
+
+    assert_equal(counts, [
+        {'month': '2016-01', 'score_counts': {'3': 1}},
+        {'month': '2016-02', 'score_counts': {'1': 1, '2': 1}},
+        {'month': '2016-03', 'score_counts': {'1': 1, '2': 1}},
+        ])
@@ -1,9 +1,26 @@
 import os
 import logging
+import random
+import time
+import shutil
+import tempfile
+import zipfile
+import tarfile
+import gzip
+import bz2
+import StringIO
 
 from nose.tools import assert_equal
 
-from ckanext.qa.sniff_format import sniff_file_format, is_json, is_ttl, turtle_regex
+from ckanext.qa.metrics import tracing
+from ckanext.qa.sniff_format import (sniff_file_format, is_json, is_ttl,
+                                     has_rdfa, mapped_file,
+                                     file_has_ttl_prefix,
+                                     turtle_regex, count_turtle_triples,
+                                     iter_zip_members, read_zip_member,
+                                     summarise_archive_members,
+                                     get_gzip_original_filename,
+                                     read_compressed_prefix)
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('ckan.sniff')
@@ -28,16 +45,24 @@ class TestSniffFormat:
         expected_format = format_extension
         sniffed_format = sniff_file_format(filepath, log)
         assert sniffed_format, expected_format
-        expected_format_without_zip = expected_format.replace('.zip', '')
-        assert_equal(sniffed_format['format'].lower(), expected_format_without_zip)
-
         expected_container = None
         if expected_format.endswith('.zip'):
             expected_container = 'ZIP'
-        elif expected_format.endswith('.gzip'):
-            expected_container = 'ZIP'  # lumped together with zip for simplicity now
+        elif expected_format.endswith(('.gz', '.gzip')):
+            expected_container = 'GZ'  # gzip is a container of its own
+        if expected_container:
+            expected_format = expected_format.rsplit('.', 1)[0]
+        assert_equal(sniffed_format['format'].lower(), expected_format)
         assert_equal(sniffed_format.get('container'), expected_container)
 
+    def test_sniff_is_traced(self):
+        with tracing() as trace:
+            self.check_format('csv', '311011.csv')
+        stages = [stage['stage'] for stage in trace.stages]
+        assert 'sniff.magic' in stages, stages
+        assert_equal(stages[-1], 'sniff')
+        assert_equal(trace.stages[-1]['verdict'], 'CSV')
+
     #def test_all(self):
     #    for format_extension, filepath in self.fixture_files:
     #        self.assert_file_has_format_sniffed_correctly(format_extension, filepath)
@@ -170,6 +195,168 @@ class TestSniffFormat:
     def test_atom1(self):
         self.check_format('atom feed', 'SG_HumanHealthSafety.atom_feed')
 
+class TestArchives:
+    @classmethod
+    def setup_class(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def _zip(self, filename, members, compression=zipfile.ZIP_DEFLATED,
+             allow_zip64=False):
+        filepath = os.path.join(self.tmp_dir, filename)
+        zip = zipfile.ZipFile(filepath, 'w', compression, allow_zip64)
+        for member_filename, content in members:
+            zip.writestr(member_filename, content)
+        zip.close()
+        return filepath
+
+    def _tar(self, filename, members, mode='w:gz'):
+        filepath = os.path.join(self.tmp_dir, filename)
+        tar = tarfile.open(filepath, mode)
+        for member_filename, content in members:
+            info = tarfile.TarInfo(member_filename)
+            info.size = len(content)
+            tar.addfile(info, StringIO.StringIO(content))
+        tar.close()
+        return filepath
+
+    def test_iter_zip_members_matches_zipfile(self):
+        for filename in os.listdir(self.fixture_data_dir):
+            if not filename.endswith('.zip'):
+                continue
+            filepath = os.path.join(self.fixture_data_dir, filename)
+            with open(filepath, 'rb') as f:
+                filepaths = [member[0] for member in iter_zip_members(f)]
+            assert_equal(filepaths, zipfile.ZipFile(filepath).namelist())
+
+    def test_iter_zip_members_with_prepended_data(self):
+        filepath = self._zip('sfx.zip', [('a.csv', 'a,b\n1,2\n')])
+        sfx_filepath = os.path.join(self.tmp_dir, 'sfx.exe')
+        with open(sfx_filepath, 'wb') as f:
+            f.write('MZ' + '\0' * 1000 + open(filepath, 'rb').read())
+        with open(sfx_filepath, 'rb') as f:
+            members = list(iter_zip_members(f))
+            assert_equal([member[0] for member in members], ['a.csv'])
+            assert_equal(read_zip_member(f, members[0][2], 1000),
+                         'a,b\n1,2\n')
+
+    def test_iter_zip_members_zip64_with_prepended_data(self):
+        # more members than the end record can count, so it is Zip64
+        filepath = self._zip('sfx64.zip', [('%s.csv' % i, 'a,b\n1,2\n')
+                                           for i in xrange(0x10000)],
+                             zipfile.ZIP_STORED, allow_zip64=True)
+        sfx_filepath = os.path.join(self.tmp_dir, 'sfx64.exe')
+        with open(sfx_filepath, 'wb') as f:
+            f.write('MZ' + '\0' * 1000 + open(filepath, 'rb').read())
+        with open(sfx_filepath, 'rb') as f:
+            members = list(iter_zip_members(f))
+            assert_equal(len(members), 0x10000)
+            assert_equal(members[-1][0], '65535.csv')
+            assert_equal(read_zip_member(f, members[-1][2], 1000),
+                         'a,b\n1,2\n')
+
+    def test_read_zip_member_is_bounded(self):
+        for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            filepath = self._zip('big.zip', [('big.csv', 'a,b\n' * 100000)],
+                                 compression)
+            with open(filepath, 'rb') as f:
+                member = list(iter_zip_members(f))[0][2]
+                assert_equal(len(read_zip_member(f, member, 1000)), 1000)
+
+    def test_summarise_archive_members(self):
+        members = [('dir/', 0, None), ('dir/a.csv', 10, 'a'),
+                   ('b.csv', 30, 'b'), ('c.XLS', 20, 'c'),
+                   ('agency.txt', 1, 'd')]
+        extension_counts, gtfs_filenames, largest_member = \
+            summarise_archive_members(iter(members), log)
+        assert_equal(extension_counts, {'csv': 2, 'xls': 1, 'txt': 1})
+        assert_equal(gtfs_filenames, set(['agency.txt']))
+        assert_equal(largest_member, ('b.csv', 30, 'b'))
+
+    def test_summarise_archive_members_max_members(self):
+        members = (('%s.csv' % i, 1, None) for i in xrange(100000))
+        extension_counts, _, _ = summarise_archive_members(members, log,
+                                                           max_members=10)
+        assert_equal(extension_counts, {'csv': 10})
+
+    def test_zip_many_members(self):
+        filepath = self._zip('many.zip', [('%s.csv' % i, '')
+                                          for i in xrange(20000)])
+        assert_equal(sniff_file_format(filepath, log),
+                     {'format': 'CSV', 'container': 'ZIP'})
+
+    def test_zip_member_without_extension_is_sniffed(self):
+        filepath = self._zip('noext.zip', [('data', 'a,b,c\n1,2,3\n' * 20),
+                                           ('README', 'Some data')])
+        assert_equal(sniff_file_format(filepath, log),
+                     {'format': 'CSV', 'container': 'ZIP'})
+
+    def test_nested_zip(self):
+        inner_filepath = self._zip('inner.zip', [('data.csv', 'a,b\n1,2\n')])
+        filepath = self._zip('outer.zip', [
+            ('inner.zip', open(inner_filepath, 'rb').read())])
+        assert_equal(sniff_file_format(filepath, log),
+                     {'format': 'CSV', 'container': 'ZIP'})
+
+    def test_tar_gz(self):
+        filepath = self._tar('data.tar.gz', [('a.csv', 'a,b\n1,2\n'),
+                                             ('b.csv', 'a,b\n1,2\n'),
+                                             ('README.txt', 'Some data')])
+        assert_equal(sniff_file_format(filepath, log),
+                     {'format': 'CSV', 'container': 'TAR'})
+
+    def test_tar(self):
+        filepath = self._tar('data.tar', [('a.csv', 'a,b\n1,2\n')], 'w')
+        assert_equal(sniff_file_format(filepath, log),
+                     {'format': 'CSV', 'container': 'TAR'})
+
+    def test_gzip_original_filename(self):
+        filepath = os.path.join(self.tmp_dir, 'data.csv.gz')
+        gzip_file = gzip.open(filepath, 'wb')
+        gzip_file.write('a,b\n1,2\n')
+        gzip_file.close()
+        assert_equal(get_gzip_original_filename(filepath), 'data.csv')
+        assert_equal(sniff_file_format(filepath, log),
+                     {'format': 'CSV', 'container': 'GZ'})
+
+    def _gzip(self, filename, content):
+        filepath = os.path.join(self.tmp_dir, filename)
+        with open(filepath, 'wb') as f:
+            # no original filename in the header
+            gzip_file = gzip.GzipFile(filename='', mode='wb', fileobj=f)
+            gzip_file.write(content)
+            gzip_file.close()
+        return filepath
+
+    def _bz2(self, filename, content):
+        filepath = os.path.join(self.tmp_dir, filename)
+        with open(filepath, 'wb') as f:
+            f.write(bz2.compress(content))
+        return filepath
+
+    def test_gzip_sniffed(self):
+        filepath = self._gzip('data', 'a,b,c\n1,2,3\n' * 20)
+        assert_equal(get_gzip_original_filename(filepath), None)
+        assert_equal(sniff_file_format(filepath, log),
+                     {'format': 'CSV', 'container': 'GZ'})
+
+    def test_bz2_sniffed(self):
+        filepath = self._bz2('data.json.bz2', '[{"a": 1}, {"a": 2}]')
+        assert_equal(sniff_file_format(filepath, log),
+                     {'format': 'JSON', 'container': 'BZ2'})
+
+    def test_read_compressed_prefix_is_bounded(self):
+        content = 'a,b\n' * (10 * 1024 * 1024)
+        for filepath, container in ((self._gzip('big.gz', content), 'GZ'),
+                                    (self._bz2('big.bz2', content), 'BZ2')):
+            assert_equal(read_compressed_prefix(filepath, container, 1000),
+                         content[:1000])
+
+
 def test_is_json():
     assert is_json('5', log)
     assert is_json('-5', log)
@@ -231,3 +418,156 @@ def test_is_ttl__num_triples():
     assert not is_ttl('\n'.join([triple]*2), log)
     assert is_ttl('\n'.join([triple]*5), log)
 
+
+def test_count_turtle_triples():
+    template = '<subject> <predicate> %s .'
+    assert_equal(count_turtle_triples(template % '<url>'), 1)
+    assert_equal(count_turtle_triples(template % '"a literal"'), 1)
+    assert_equal(count_turtle_triples(template % '"translation"@ru'), 1)
+    assert_equal(count_turtle_triples(template % '"literal type"^^<http://www.w3.org/2001/XMLSchema#string>'), 1)
+    assert_equal(count_turtle_triples(template % '"literal typed with prefix"^^xsd:string'), 1)
+    assert_equal(count_turtle_triples(template % "'single quotes'"), 1)
+    assert_equal(count_turtle_triples(template % '"escaped \\" quote"'), 1)
+    assert_equal(count_turtle_triples(template % '"""triple \n quotes"""'), 1)
+    assert_equal(count_turtle_triples(template % '-4.2E-9'), 1)
+    assert_equal(count_turtle_triples(template % '.12'), 1)
+    assert_equal(count_turtle_triples(template % 'false'), 1)
+    assert_equal(count_turtle_triples(template % '_:blank_node'), 1)
+    assert_equal(count_turtle_triples('<s> <p> <o> ;\n <p> <o> .'), 2)
+    assert_equal(count_turtle_triples('<s> <p> <o>, <o2>; <p> <o>.'), 3)
+    assert_equal(count_turtle_triples('<s> <p> <o>; .'), 1)
+    assert_equal(count_turtle_triples('# <s> <p> <o> .\n<s> <p> <o> .'), 1)
+    assert_equal(count_turtle_triples(template % 'word'), 0)
+    assert_equal(count_turtle_triples(template % 'prefix:node'), 0)
+    assert_equal(count_turtle_triples('<s> <p> "unclosed .\n<s> <p> <o> .'), 1)
+    assert_equal(count_turtle_triples('<s> <p> <o> .\n' * 10, max_triples=5), 5)
+
+
+def write_temp_file(content, suffix):
+    f = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+    f.write(content)
+    f.close()
+    return f.name
+
+
+def test_rdfa_after_first_100kb():
+    html = '<html><body>\n' + '<p>Some text</p>\n' * 20000 + \
+        '<div about="http://example.com/a"><span property="dc:title">A' \
+        '</span></div>\n</body></html>'
+    filepath = write_temp_file(html, '.html')
+    try:
+        assert_equal(sniff_file_format(filepath, log), {'format': 'RDFa'})
+    finally:
+        os.remove(filepath)
+
+
+def test_has_rdfa__mapped_file_byte_budget():
+    html = '<html>' + ' ' * 1000 + \
+        '<div about="http://example.com/a" property="dc:title">A</div>'
+    filepath = write_temp_file(html, '.html')
+    try:
+        with mapped_file(filepath) as buf:
+            assert has_rdfa(buf, log)
+            assert not has_rdfa(buf, log, max_bytes=1000)
+    finally:
+        os.remove(filepath)
+
+
+def test_has_rdfa__attributes_in_tags():
+    assert has_rdfa('<div about="a"><p\nproperty="b">', log)
+    assert not has_rdfa('<div>about="a" property="b"</div>', log)
+    assert not has_rdfa('<div about="" property="b">', log)
+    assert not has_rdfa('<div xabout="a" property="b">', log)
+
+
+def test_has_rdfa__adversarial_inputs_are_fast():
+    # runs without a ">", which a regex like <[^>]+\sabout=... would
+    # backtrack over from every "<"
+    size = 1024 * 1024
+    bufs = [
+        ('<a ' * size)[:size] + 'about="x" property="y"',
+        ('< about="x' * size)[:size] + ' property="y"',
+        ('<p about="x" property="' * size)[:size],
+        ]
+    worst_time = 0
+    for buf in bufs:
+        start = time.time()
+        has_rdfa(buf, log)
+        worst_time = max(worst_time, time.time() - start)
+    assert worst_time < 0.5, worst_time
+
+
+def test_file_has_ttl_prefix():
+    filepath = write_temp_file('# a comment\n' * 10000 +
+                               '@prefix dc: <http://purl.org/dc/terms/> .\n',
+                               '.ttl')
+    try:
+        assert not is_ttl(open(filepath).read(10000), log)
+        assert file_has_ttl_prefix(filepath, log)
+    finally:
+        os.remove(filepath)
+
+
+def test_mapped_file__empty():
+    filepath = write_temp_file('', '.html')
+    try:
+        with mapped_file(filepath) as buf:
+            assert not has_rdfa(buf, log)
+    finally:
+        os.remove(filepath)
+
+
+def adversarial_turtle_buffers(seed=0, num_random=200):
+    '''Yields buffers designed to make a backtracking triple matcher slow.'''
+    size = 10000
+    yield '"' + 'a' * size
+    yield '"""' + 'a ;' * (size / 3)
+    yield ';' * size
+    yield ' ;' * (size / 2)
+    yield '<s> <p> "' * (size / 9)
+    yield ('"a ' * (size / 3)) + '\n'
+    yield '<' * size
+    yield '\\"' * (size / 2)
+    yield '"' + '\\' * size + '"'
+    yield '_:a ' * (size / 4)
+    yield '1.' * (size / 2)
+    yield '<s> <p> <o>' * (size / 11)
+    # random mixes of turtle syntax fragments
+    fragments = ['<s>', '<p', '>', '"', "'", '"""', "'''", '\\', '@en',
+                 '^^', 'xsd:string', '_:b', '1', '.', ';', ',', ' ', '\n',
+                 '#', 'true', 'a']
+    rand = random.Random(seed)
+    for i in range(num_random):
+        buf = []
+        length = 0
+        while length < size:
+            fragment = rand.choice(fragments) * rand.randint(1, 50)
+            buf.append(fragment)
+            length += len(fragment)
+        yield ''.join(buf)[:size]
+
+
+def test_is_ttl__adversarial_inputs_are_fast():
+    # The worst case for any one buffer must stay well under the time
+    # budget, because the scanner is linear, not because the budget cut it
+    # short.
+    worst_time = 0
+    for buf in adversarial_turtle_buffers():
+        start = time.time()
+        is_ttl(buf, log, max_seconds=None)
+        worst_time = max(worst_time, time.time() - start)
+    assert worst_time < 0.1, worst_time
+
+
+def test_is_ttl__byte_budget():
+    triples = '<s> <p> <o> .\n' * 5
+    assert is_ttl(triples, log)
+    assert not is_ttl(' ' * 10000 + triples, log)
+    assert is_ttl(' ' * 10000 + triples, log, max_bytes=20000)
+
+
+def test_is_ttl__time_budget():
+    # with an already passed deadline it gives up at the first time check
+    num_triples = count_turtle_triples('<s> <p> <o> .\n' * 1000,
+                                       deadline=time.time() - 1)
+    assert num_triples < 1000, num_triples
@@ -17,6 +17,7 @@ except ImportError:
     from ckan.tests import BaseCase
 
 import ckanext.qa.tasks
+import ckanext.qa.lib
 from ckanext.qa.tasks import resource_score, extension_variants
 import ckanext.archiver
 import ckanext.archiver.tasks
@@ -134,6 +135,33 @@ class TestResourceScore(BaseCase):
         assert result['format'] == 'CSV', result
         assert result['archival_timestamp'] == TODAY_STR, result
 
+    def test_timings(self):
+        set_sniffed_format('CSV')
+        result = resource_score(self._test_resource(), log)
+        stages = [stage['stage'] for stage in result['timings']]
+        assert_equal(stages, ['score.link_broken', 'score.sniffing_data',
+                              'score'])
+        assert_equal(result['timings'][1]['verdict'], 'CSV:3')
+
+    def test_logs_summary(self):
+        set_sniffed_format('CSV')
+        records = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+        summary_log = logging.getLogger('ckanext.qa.tests.summary')
+        summary_log.setLevel(logging.INFO)
+        summary_log.addHandler(Handler())
+
+        resource = self._test_resource()
+        resource_score(resource, summary_log)
+
+        assert_equal(len(records), 1)
+        assert_equal(records[0].qa['resource_id'], resource.id)
+        assert_equal(records[0].qa['openness_score'], 3)
+        assert_equal(records[0].qa['format'], 'CSV')
+
     def test_not_archived(self):
         result = resource_score(self._test_resource(archived=False, cached=False, format=None), log)
         # falls back on previous QA data detailing failed attempts
@@ -301,6 +329,33 @@ class TestSaveQaResult(object):
         assert_equal(qa.archival_timestamp, qa_result['archival_timestamp'])
         assert qa.updated, qa.updated
 
+    def test_format_scores_version(self):
+        resource_dict = ckan_factories.Resource()
+        resource = model.Resource.get(resource_dict['id'])
+        version = ckanext.qa.lib.resource_format_scores_version()
+        qa_result = self.get_qa_result(format_scores_version=version)
+
+        qa = ckanext.qa.tasks.save_qa_result(resource, qa_result, log)
+
+        assert_equal(qa.format_scores_version, version)
+        assert_equal(qa_model.FormatScores.get_scores(version),
+                     ckanext.qa.lib.resource_format_scores())
+
+
+class TestQARepr(object):
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        qa_model.init_tables(model.meta.engine)
+
+    def test_repr_needs_no_query(self):
+        qa = qa_model.QA(package_id=u'package-id', resource_id=u'res-id',
+                         openness_score=3, format=u'CSV',
+                         openness_score_reason=u'Detected as CSV')
+
+        assert_equal(repr(qa), '<QA score=3 format=CSV '
+                     '/dataset/package-id/resource/res-id Detected as CSV>')
+
 
 class TestUpdatePackage(object):
     @classmethod
@@ -348,3 +403,131 @@ class TestUpdateResource(object):
         assert qa
         assert_equal(qa.openness_score, 0)
         assert_equal(qa.openness_score_reason, 'License not open')
+
+
+class TestScoreResourcesInBulk(object):
+    @classmethod
+    def setup_class(cls):
+        reset_db()
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def test_score_and_save(self):
+        resource = {
+            'url': 'http://example.com/file.csv',
+            'title': 'Some data',
+            'format': '',
+            }
+        dataset = ckan_factories.Dataset(resources=[resource])
+        resource_id = dataset['resources'][0]['id']
+
+        results = ckanext.qa.tasks.score_resources([resource_id])
+        assert_equal([(r[0], r[1]) for r in results],
+                     [(resource_id, dataset['id'])])
+        ckanext.qa.tasks.save_qa_results_in_bulk(results, log)
+
+        qa = qa_model.QA.get_for_resource(resource_id)
+        assert qa
+        assert_equal(qa.package_id, dataset['id'])
+        assert_equal(qa.openness_score, 0)
+        assert_equal(qa.openness_score_reason, 'License not open')
+
+    def test_save_updates_existing_result(self):
+        resource_dict = ckan_factories.Resource()
+        resource = model.Resource.get(resource_dict['id'])
+        qa = ckanext.qa.tasks.save_qa_result(
+            resource, TestSaveQaResult.get_qa_result(), log)
+        qa_id = qa.id
+        results = [(resource.id, qa.package_id,
+                    TestSaveQaResult.get_qa_result(
+                        openness_score=2, format='XLS'))]
+
+        ckanext.qa.tasks.save_qa_results_in_bulk(results, log)
+
+        model.Session.expire_all()
+        qas = model.Session.query(qa_model.QA) \
+            .filter_by(resource_id=resource.id).all()
+        assert_equal([(qa.id, qa.openness_score, qa.format) for qa in qas],
+                     [(qa_id, 2, 'XLS')])
+
+    def test_score_leaves_the_session_of_the_main_process(self):
+        resource_id = ckan_factories.Resource()['id']
+        resource = model.Resource.get(resource_id)
+
+        ckanext.qa.tasks.score_resources([resource_id])
+
+        assert resource in model.Session
+
+    def test_resource_id_pages(self):
+        dataset = ckan_factories.Dataset(resources=[
+            {'url': 'http://example.com/%s.csv' % i} for i in range(3)])
+        resource_ids = set(res['id'] for res in dataset['resources'])
+
+        pages = list(ckanext.qa.tasks.iter_resource_id_pages(page_size=2))
+
+        assert all(len(page) <= 2 for page in pages)
+        ids = [id_ for page in pages for id_ in page]
+        assert_equal(ids, sorted(ids))
+        assert resource_ids <= set(ids)
+
+
+class TestRescoreQaByFormat(object):
+    @classmethod
+    def setup_class(cls):
+        cls.format_index = ckanext.qa.lib.FormatIndex(
+            {}, {'CSV': 4, 'XLS': 2, 'TXT': 1})
+
+    def _qa(self, score, reason, format_='CSV'):
+        qa = qa_model.QA()
+        qa.openness_score = score
+        qa.openness_score_reason = reason
+        qa.format = format_
+        return qa
+
+    def test_sniffed(self):
+        qa = self._qa(3, 'Content of file appeared to be format "CSV" which receives openness score: 3.')
+        assert_equal(ckanext.qa.tasks.rescore_qa_by_format(qa, self.format_index, log), True)
+        assert_equal(qa.openness_score, 4)
+        assert_equal(qa.openness_score_reason, 'Content of file appeared to be format "CSV" which receives openness score: 4.')
+
+    def test_url_extension(self):
+        qa = self._qa(3, 'The format of the file was not recognized from its contents. URL extension "csv" relates to format "CSV" and receives score: 3.')
+        assert_equal(ckanext.qa.tasks.rescore_qa_by_format(qa, self.format_index, log), True)
+        assert_equal(qa.openness_score, 4)
+        assert_equal(qa.openness_score_reason, 'The format of the file was not recognized from its contents. URL extension "csv" relates to format "CSV" and receives score: 4.')
+
+    def test_format_field(self):
+        qa = self._qa(3, 'Could not determine a file extension in the URL. Format field "csv" receives score: 3.')
+        assert_equal(ckanext.qa.tasks.rescore_qa_by_format(qa, self.format_index, log), True)
+        assert_equal(qa.openness_score, 4)
+        assert qa.openness_score_reason.endswith('Format field "csv" receives score: 4.'), qa.openness_score_reason
+
+    def test_unchanged(self):
+        qa = self._qa(2, 'Format field "XLS" receives score: 2.', 'XLS')
+        assert_equal(ckanext.qa.tasks.rescore_qa_by_format(qa, self.format_index, log), False)
+        assert_equal(qa.openness_score, 2)
+
+    def test_license_not_open(self):
+        qa = self._qa(0, 'License not open')
+        assert_equal(ckanext.qa.tasks.rescore_qa_by_format(qa, self.format_index, log), False)
+        assert_equal(qa.openness_score, 0)
+
+    def test_broken_link(self):
+        qa = self._qa(0, 'File could not be downloaded. Reason: Download error.')
+        assert_equal(ckanext.qa.tasks.rescore_qa_by_format(qa, self.format_index, log), False)
+
+    def test_format_not_understood(self):
+        qa = self._qa(1, 'URL extension "xyz" is an unknown format. Could not understand the file format, therefore score is 1.')
+        assert_equal(ckanext.qa.tasks.rescore_qa_by_format(qa, self.format_index, log), False)
+        assert_equal(qa.openness_score, 1)
+
+    def test_reason_not_recognised(self):
+        # e.g. in another language
+        qa = self._qa(3, u'Le champ format "csv" re\xe7oit le score : 3.')
+        assert_equal(ckanext.qa.tasks.rescore_qa_by_format(qa, self.format_index, log), None)
+        assert_equal(qa.openness_score, 3)
+
+    def test_format_no_longer_scored(self):
+        qa = self._qa(3, 'Format field "PSV" receives score: 3.', 'PSV')
+        assert_equal(ckanext.qa.tasks.rescore_qa_by_format(qa, self.format_index, log), None)
+        assert_equal(qa.openness_score, 3)